@@ -0,0 +1,77 @@
+"""latency of the top-N and frequency reads: sql (rollups) vs the columnar engine
+
+usage: python -m benchmarks.analytics --sizes 10000 100000 [--db sqlite:///bench.db]
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+from sqlalchemy import func
+
+from app import app
+from benchmarks.ingestion import synthetic_pages
+from lib import engine
+from lib.database import DbHelper, clear_user_cache
+from lib.interning import clear_track_interners
+from lib.migrations import upgrade_schema
+from lib.models import Scrobble, db
+
+READS = (
+    ('top tracks', lambda h, s, e: h.get_top_tracks_for_period(s, e, 10)),
+    ('top albums', lambda h, s, e: h.get_top_albums_for_period(s, e, 10)),
+    ('frequency days', lambda h, s, e: h.get_track_count_in_period(s, e, 'days')),
+    ('frequency hours', lambda h, s, e: h.get_track_count_in_period(s, e, 'hours')),
+    ('frequency weekdays', lambda h, s, e: h.get_track_count_in_period(s, e, 'weekdays')),
+)
+
+
+def best_of(read, helper: DbHelper, start: datetime, end: datetime, repeat: int=5) -> float:
+    timings = []
+    for _ in range(repeat):
+        began = time.perf_counter()
+        read(helper, start, end)
+        timings.append(time.perf_counter() - began)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--db', default='sqlite:///benchmarks/analytics.db')
+    args = parser.parse_args()
+    if not engine.available():
+        raise SystemExit('numpy is needed for the columnar engine')
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.db
+    with app.app_context():
+        for size in args.sizes:
+            db.session.remove()
+            db.drop_all()
+            upgrade_schema()
+            clear_user_cache()
+            clear_track_interners()
+            engine.get_columnar_store().clear()
+            helper = DbHelper('bench_analytics')
+            helper.add_user_to_db()
+            for page in synthetic_pages(size):
+                helper.bulk_write_scrobbles_to_db(page)
+            start, end = db.session.query(func.min(Scrobble.datetime), func.max(Scrobble.datetime)).one()
+            app.config['COLUMNAR_ENGINE'] = True
+            began = time.perf_counter()
+            helper._columns()
+            print(f'{size:>7} rows | columnar load: {(time.perf_counter()-began)*1000:9.1f} ms')
+            for name, read in READS:
+                app.config['COLUMNAR_ENGINE'] = False
+                sql = best_of(read, helper, start, end)
+                app.config['COLUMNAR_ENGINE'] = True
+                columnar = best_of(read, helper, start, end)
+                print(f'{size:>7} rows | {name:<18}: sql {sql*1000:8.1f} ms, columnar {columnar*1000:8.1f} ms')
+        app.config['COLUMNAR_ENGINE'] = False
+        db.session.remove()
+        db.drop_all()
+    if args.db.startswith('sqlite:///') and os.path.exists(args.db[len('sqlite:///'):]):
+        os.remove(args.db[len('sqlite:///'):])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""end to end benchmark: imports synthetic histories from a mock lastfm server through /update, then measures
+p50/p99 latency of the read endpoints and the process' peak memory, against sqlite.
+Results are written as json (with the commit they were measured at) and can be compared with an earlier run.
+
+usage: python -m benchmarks.harness --users 3 --scrobbles 100000 --latency 0.02 [--compare old.json]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import time
+from datetime import datetime
+from typing import Any, Dict, List
+
+from app import app
+from benchmarks.histories import histories
+from benchmarks.mock_lastfm import MockLastFM
+from lib.database import clear_user_cache
+from lib.interning import clear_track_interners
+from lib.lastfm import LastFMHelper
+from lib.models import db
+
+ENDPOINTS = {
+    "scrobbles": ('', {"limit": 200}),
+    "top-tracks": ('/top-tracks', {"limit": 10}),
+    "top-albums": ('/top-albums', {"limit": 10}),
+    "top-artists": ('/top-artists', {"limit": 10}),
+    "frequency": ('/frequency', {"scale": "days"}),
+    "summary": ('/summary', {"limit": 10}),
+}
+WINDOW_DAYS = (7, 30, 365)
+
+
+def git_commit() -> Dict[str,Any]:
+    def git(*args):
+        return subprocess.run(('git',) + args, capture_output=True, text=True, check=True).stdout.strip()
+    try:
+        return {"commit": git('rev-parse', 'HEAD'), "dirty": bool(git('status', '--porcelain', '--untracked-files=no'))}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+
+def peak_rss_mb() -> float:
+    #kilobytes on linux, bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (2**20 if platform.system() == 'Darwin' else 2**10), 1)
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered)-1, int(round(p/100 * (len(ordered)-1))))]
+
+
+def latency_summary(seconds: List[float]) -> Dict[str,Any]:
+    ms = [ s*1000 for s in seconds ]
+    return {"requests": len(ms), "p50_ms": round(percentile(ms, 50), 2), "p99_ms": round(percentile(ms, 99), 2),
+        "mean_ms": round(sum(ms)/len(ms), 2), "max_ms": round(max(ms), 2)}
+
+
+def run(users: int=3, scrobbles: int=10000, catalog: int=20000, zipf: float=1.1, seed: int=0, latency: float=0.0,
+        requests: int=50, db_path: str='benchmarks/harness.db', cache: bool=False, rate: float=1000) -> Dict[str,Any]:
+    """imports `users` histories of `scrobbles` plays and reads them `requests` times per endpoint"""
+    if os.path.exists(db_path): os.remove(db_path)
+    overrides = {
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{db_path}',
+        'TESTING': True,
+        'RESULTS_CACHE_BACKEND': 'lru' if cache else 'none',
+        'LASTFM_REQUESTS_PER_SECOND': rate,
+        'LASTFM_REQUEST_BURST': rate,
+    }
+    saved = { key: app.config.get(key) for key in overrides }
+    app.config.update(overrides)
+    reset()
+    try:
+        return _run(users, scrobbles, catalog, zipf, seed, latency, requests, cache)
+    finally:
+        app.config.update(saved)
+        reset()
+        if os.path.exists(db_path): os.remove(db_path)
+
+
+def reset() -> None:
+    """drops the per process state built from the config being swapped"""
+    for extension in ('results_cache', 'lastfm_rate_limiter'):
+        app.extensions.pop(extension, None)
+    with app.app_context():
+        db.session.remove()
+    clear_user_cache()
+    clear_track_interners()
+
+
+def _run(users: int, scrobbles: int, catalog: int, zipf: float, seed: int, latency: float, requests: int,
+        cache: bool) -> Dict[str,Any]:
+    generated = histories(users, scrobbles, catalog, zipf, seed)
+    client = app.test_client()
+    results: Dict[str,Any] = {
+        **git_commit(),
+        "date": datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "config": {"users": users, "scrobbles": scrobbles, "catalog": catalog, "zipf": zipf, "seed": seed,
+            "latency": latency, "requests": requests, "cache": cache,
+            "fetch_workers": app.config.get('LASTFM_FETCH_WORKERS'), "bulk": app.config.get('BULK_INGESTION'),
+            "columnar": app.config.get('COLUMNAR_ENGINE')},
+    }
+    api = LastFMHelper.lastfm_api
+    with MockLastFM(generated, latency) as mock:
+        LastFMHelper.lastfm_api = mock.url
+        try:
+            imports = []
+            for history in generated:
+                began = time.perf_counter()
+                r = client.get(f'/scrobbles/{history.user}/update')
+                elapsed = time.perf_counter() - began
+                if r.status_code != 200: raise RuntimeError(f'import of {history.user} failed: {r.get_data(as_text=True)}')
+                imports.append({"user": history.user, "rows": r.json["new scrobbles"], "pages": r.json["pages"],
+                    "seconds": round(elapsed, 3), "rows_per_second": round(r.json["new scrobbles"]/elapsed, 1)})
+            rows = sum(i["rows"] for i in imports)
+            seconds = sum(i["seconds"] for i in imports)
+            results["import"] = {"rows": rows, "seconds": round(seconds, 3), "rows_per_second": round(rows/seconds, 1),
+                "lastfm_requests": mock.requests, "lastfm_bytes": mock.bytes_sent, "users": imports}
+        finally:
+            LastFMHelper.lastfm_api = api
+    results["peak_rss_mb_after_import"] = peak_rss_mb()
+
+    rng = random.Random(seed)
+    endpoints: Dict[str,Any] = {}
+    for name, (path, params) in ENDPOINTS.items():
+        timings = []
+        for _ in range(requests):
+            history = rng.choice(generated)
+            days = rng.choice(WINDOW_DAYS)
+            first, last = history.timestamps[0], history.timestamps[-1]
+            end = rng.randint(min(first + days*86400, last), last)
+            query = dict(params, start=str(datetime.fromtimestamp(end - days*86400)), end=str(datetime.fromtimestamp(end)))
+            began = time.perf_counter()
+            r = client.get(f'/scrobbles/{history.user}{path}', query_string=query)
+            timings.append(time.perf_counter() - began)
+            if r.status_code != 200: raise RuntimeError(f'{name} failed: {r.get_data(as_text=True)}')
+        endpoints[name] = latency_summary(timings)
+    results["endpoints"] = endpoints
+    results["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+
+def compare(current: Dict[str,Any], baseline: Dict[str,Any]) -> List[str]:
+    """current / baseline ratios of the import throughput and endpoint latencies"""
+    def ratio(now, then):
+        return f'{now/then:.2f}x' if then else 'n/a'
+    lines = [f'vs {str(baseline.get("commit"))[:10]}: import {current["import"]["rows_per_second"]:,.0f} rows/s '
+        f'({ratio(current["import"]["rows_per_second"], baseline["import"]["rows_per_second"])})']
+    for name, now in current["endpoints"].items():
+        then = baseline.get("endpoints", {}).get(name)
+        if then is None: continue
+        lines.append(f'  {name:<12} p50 {now["p50_ms"]:8.2f} ms ({ratio(now["p50_ms"], then["p50_ms"])}), '
+            f'p99 {now["p99_ms"]:8.2f} ms ({ratio(now["p99_ms"], then["p99_ms"])})')
+    lines.append(f'  peak rss {current["peak_rss_mb"]} MB ({ratio(current["peak_rss_mb"], baseline.get("peak_rss_mb"))})')
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=3)
+    parser.add_argument('--scrobbles', type=int, default=10000, help='per user')
+    parser.add_argument('--catalog', type=int, default=20000, help='distinct tracks')
+    parser.add_argument('--zipf', type=float, default=1.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every lastfm request')
+    parser.add_argument('--requests', type=int, default=50, help='per endpoint')
+    parser.add_argument('--rate', type=float, default=1000, help='lastfm requests per second allowed')
+    parser.add_argument('--cache', action='store_true', help='keep the results cache on')
+    parser.add_argument('--db', default='benchmarks/harness.db')
+    parser.add_argument('--output', default=None, help='defaults to benchmarks/results/<commit>.json')
+    parser.add_argument('--compare', default=None, help='an earlier results file')
+    args = parser.parse_args()
+
+    app.logger.setLevel(logging.WARNING)
+    results = run(args.users, args.scrobbles, args.catalog, args.zipf, args.seed, args.latency,
+        args.requests, args.db, args.cache, args.rate)
+    output = args.output or os.path.join('benchmarks', 'results', f'{(results["commit"] or "unknown")[:10]}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    imported = results["import"]
+    print(f'import: {imported["rows"]} rows in {imported["seconds"]}s -> {imported["rows_per_second"]:,.0f} rows/s')
+    for name, summary in results["endpoints"].items():
+        print(f'{name:<12}: p50 {summary["p50_ms"]:8.2f} ms, p99 {summary["p99_ms"]:8.2f} ms')
+    print(f'peak rss: {results["peak_rss_mb"]} MB, results in {output}')
+    if args.compare:
+        with open(args.compare) as f:
+            print('\n'.join(compare(results, json.load(f))))
+
+
+if __name__ == '__main__':
+    main()
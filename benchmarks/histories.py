@@ -0,0 +1,61 @@
+"""deterministic synthetic listening histories, shaped like lastfm's `user.getRecentTracks` pages"""
+import math
+import random
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import Any, Dict, List, Optional
+
+#histories end before any real sync window so imports see all of them, and results don't depend on the date
+END_TIMESTAMP = 1560000000
+
+
+def track_entry(track: int, timestamp: int) -> Dict[str,Any]:
+    """a `recenttracks.track` item, tracks share albums (10 tracks) and artists (50 tracks)"""
+    return {
+        "name": f'track {track}',
+        "artist": {"mbid": "", "#text": f'artist {track//50}'},
+        "album": {"mbid": "", "#text": f'album {track//10}'},
+        "streamable": "0",
+        "url": f'https://www.last.fm/music/artist+{track//50}/_/track+{track}',
+        "mbid": "",
+        "image": [ {"size": size, "#text": ""} for size in ('small', 'medium', 'large', 'extralarge') ],
+        "date": {"uts": str(timestamp), "#text": ""},
+    }
+
+
+class History:
+    """`scrobbles` plays of a `catalog` of tracks, ranked by a per user shuffle and played with zipf(`zipf`)
+    frequencies, 30s to 10min apart and ending at `end`. The same (user, seed) always gives the same history.
+    """
+
+    def __init__(self, user: str, scrobbles: int, catalog: int=20000, zipf: float=1.1,
+            end: int=END_TIMESTAMP, seed: int=0) -> None:
+        rng = random.Random(f'{user}:{seed}')
+        self.user = user
+        favourites = rng.sample(range(catalog), catalog)
+        weights = list(accumulate(1 / (rank+1)**zipf for rank in range(catalog)))
+        self.tracks = array('i', ( favourites[rank] for rank in rng.choices(range(catalog), cum_weights=weights, k=scrobbles) ))
+        gaps = [ rng.randint(30, 600) for _ in range(scrobbles) ]
+        first = end - sum(gaps)
+        #ascending, so a from/to window is a bisect
+        self.timestamps = array('q', ( first + offset for offset in accumulate(gaps) ))
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def page(self, page: int=1, limit: int=50, from_ts: Optional[int]=None, to_ts: Optional[int]=None) -> Dict[str,Any]:
+        """the `user.getRecentTracks` response, newest first, `from`/`to` are inclusive"""
+        lo = bisect_left(self.timestamps, from_ts) if from_ts is not None else 0
+        hi = bisect_right(self.timestamps, to_ts) if to_ts is not None else len(self)
+        total = max(0, hi - lo)
+        newest = hi - (page-1)*limit
+        indexes = range(newest-1, max(lo, newest-limit)-1, -1)
+        return {"recenttracks": {
+            "track": [ track_entry(self.tracks[i], self.timestamps[i]) for i in indexes ],
+            "@attr": {"user": self.user, "page": str(page), "perPage": str(limit),
+                "totalPages": str(max(1, math.ceil(total/limit))), "total": str(total)}}}
+
+
+def histories(users: int, scrobbles: int, catalog: int=20000, zipf: float=1.1, seed: int=0) -> List[History]:
+    return [ History(f'bench_user_{i}', scrobbles, catalog, zipf, seed=seed) for i in range(users) ]
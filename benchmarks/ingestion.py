@@ -0,0 +1,65 @@
+"""compares ingestion throughput (rows/sec) of the row by row and bulk write paths
+
+usage: python -m benchmarks.ingestion --scrobbles 20000 [--db sqlite:///bench.db]
+"""
+import argparse
+import os
+import random
+import time
+from typing import List
+
+from app import app
+from lib.database import DbHelper, clear_user_cache
+from lib.interning import clear_track_interners
+from lib.migrations import upgrade_schema
+from lib.models import db
+from lib.records import ParsedScrobble
+
+PAGE_SIZE = 200
+
+
+def synthetic_pages(count: int, distinct_tracks: int=2000, start: int=1262304000) -> List[List[ParsedScrobble]]:
+    rng = random.Random(42)
+    weights = [ 1/(rank+1) for rank in range(distinct_tracks) ]
+    picks = rng.choices(range(distinct_tracks), weights=weights, k=count)
+    scrobbles = [
+        ParsedScrobble(start + i*180, f'track {p}', f'album {p//10}', f'artist {p//50}')
+        for i, p in enumerate(picks)
+    ]
+    return [ scrobbles[i:i+PAGE_SIZE] for i in range(0, count, PAGE_SIZE) ]
+
+
+def run(write, pages: List[List[ParsedScrobble]]) -> float:
+    start = time.perf_counter()
+    for page in pages:
+        write(page)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scrobbles', type=int, default=20000)
+    parser.add_argument('--db', default='sqlite:///benchmarks/ingestion.db')
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.db
+    with app.app_context():
+        for mode in ('row', 'bulk'):
+            #fresh schema per mode so the bulk run doesn't reuse tracks written by the row run
+            db.session.remove()
+            db.drop_all()
+            upgrade_schema()
+            clear_user_cache()
+            clear_track_interners()
+            helper = DbHelper(f'bench_{mode}')
+            helper.add_user_to_db()
+            write = helper.write_scrobbles_to_db if mode == 'row' else helper.bulk_write_scrobbles_to_db
+            elapsed = run(write, synthetic_pages(args.scrobbles))
+            print(f'{mode:>5}: {args.scrobbles} scrobbles in {elapsed:.2f}s -> {args.scrobbles/elapsed:,.0f} rows/sec')
+        db.drop_all()
+    if args.db.startswith('sqlite:///') and os.path.exists(args.db[len('sqlite:///'):]):
+        os.remove(args.db[len('sqlite:///'):])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""decode throughput of lastfm recent track pages and encode throughput of api responses, per json library
+
+usage: python -m benchmarks.json_codec --pages 2000
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+
+from app import app
+from benchmarks.parsing import synthetic_recent_tracks
+from lib import fastjson
+
+
+def decoders():
+    yield 'json', json.loads
+    for name in ('ujson', 'orjson'):
+        try:
+            yield name, __import__(name).loads
+        except ImportError:
+            pass
+
+
+def page_bodies(pages: int):
+    return [ json.dumps({"recenttracks": {"track": tracks, "@attr": {
+        "user": "bench", "page": str(i+1), "perPage": "200", "totalPages": str(pages), "total": str(pages*200)}}}).encode()
+        for i, tracks in enumerate(synthetic_recent_tracks(pages)) ]
+
+
+def scrobbles_response(count: int):
+    """the shape of /scrobbles/<user>, datetimes included"""
+    start = datetime(2019,1,1)
+    return {"start": start, "end": start + timedelta(days=30), "scrobbles": [
+        {"track": f'track {i % 500}', "album": f'album {i % 50}', "artist": f'artist {i % 10}',
+         "date": start + timedelta(minutes=3*i)} for i in range(count) ]}
+
+
+def timed(fn, items):
+    began = time.perf_counter()
+    for item in items:
+        fn(item)
+    return time.perf_counter() - began
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=2000)
+    parser.add_argument('--responses', type=int, default=200)
+    args = parser.parse_args()
+
+    bodies = page_bodies(args.pages)
+    size = sum(len(b) for b in bodies)
+    for name, loads in decoders():
+        elapsed = timed(loads, bodies)
+        print(f'decode {name:>7}: {len(bodies)} pages ({size/2**20:,.1f} MiB) in {elapsed:.2f}s -> {size/2**20/elapsed:,.1f} MiB/s')
+
+    responses = [ scrobbles_response(1000) ] * args.responses
+    with app.app_context():
+        for name, fast in (('flask', False), ('fast', True)):
+            app.config['FAST_JSON'] = fast
+            elapsed = timed(fastjson.jsonify, responses)
+            print(f'encode {name:>7}: {args.responses} responses of 1000 scrobbles in {elapsed:.2f}s -> {args.responses/elapsed:,.0f} responses/sec')
+        app.config['FAST_JSON'] = True
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""a local stand in for the lastfm api serving synthetic histories, with injected latency
+
+usage: python -m benchmarks.mock_lastfm --users 3 --scrobbles 100000 --port 8099 --latency 0.05
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Optional
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.histories import History, histories
+
+
+class MockLastFM:
+    """serves `user.getRecentTracks` for `histories` on 127.0.0.1, every request sleeps `latency`
+    (plus up to `jitter`) seconds first. Unknown users get lastfm's error 6."""
+
+    def __init__(self, histories: Iterable[History], latency: float=0.0, jitter: float=0.0, port: int=0) -> None:
+        self.histories: Dict[str,History] = { h.user: h for h in histories }
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}/2.0/'
+
+    def _handler(self):
+        mock = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                params = { k: v[0] for k, v in parse_qs(urlparse(self.path).query).items() }
+                status, body = mock.respond(params)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        return Handler
+
+    def respond(self, params: Dict[str,str]):
+        """(status, json body) for the query `params`"""
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        history = self.histories.get(params.get('user', ''))
+        if params.get('method') != 'user.getRecentTracks':
+            status, doc = 400, {"error": 3, "message": "Invalid Method"}
+        elif history is None:
+            status, doc = 404, {"error": 6, "message": "User not found"}
+        else:
+            number = lambda key: int(params[key]) if key in params else None
+            status, doc = 200, history.page(number('page') or 1, min(number('limit') or 50, 200), number('from'), number('to'))
+        body = json.dumps(doc).encode()
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += len(body)
+        return status, body
+
+    def start(self) -> 'MockLastFM':
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> 'MockLastFM':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=3)
+    parser.add_argument('--scrobbles', type=int, default=100000)
+    parser.add_argument('--catalog', type=int, default=20000)
+    parser.add_argument('--zipf', type=float, default=1.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--port', type=int, default=8099)
+    args = parser.parse_args()
+    mock = MockLastFM(histories(args.users, args.scrobbles, args.catalog, args.zipf, args.seed), args.latency, port=args.port)
+    print(f'serving {", ".join(mock.histories)} at {mock.url}')
+    mock.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""parse cost of lastfm recent track pages: transient ORM scrobbles (the previous parser) vs ParsedScrobble records
+
+usage: python -m benchmarks.parsing --scrobbles 1000000
+"""
+import argparse
+import random
+import time
+import tracemalloc
+from typing import Any, Dict, List
+
+from app import app
+from lib.models import Scrobble, Track
+from lib.records import parse_recent_tracks
+
+PAGE_SIZE = 200
+#pages are reused, generating a million distinct dicts would dominate the run
+DISTINCT_PAGES = 50
+
+
+def synthetic_recent_tracks(pages: int=DISTINCT_PAGES, distinct_tracks: int=2000, start: int=1262304000) -> List[List[Dict[str,Any]]]:
+    """`recenttracks.track` lists shaped like the lastfm api responses"""
+    rng = random.Random(42)
+    weights = [ 1/(rank+1) for rank in range(distinct_tracks) ]
+    picks = rng.choices(range(distinct_tracks), weights=weights, k=pages*PAGE_SIZE)
+    tracks = [{
+        "name": f'track {p}',
+        "artist": {"mbid": "", "#text": f'artist {p//50}'},
+        "album": {"mbid": "", "#text": f'album {p//10}'},
+        "streamable": "0",
+        "url": f'https://www.last.fm/music/artist+{p//50}/_/track+{p}',
+        "mbid": "",
+        "image": [ {"size": size, "#text": ""} for size in ('small', 'medium', 'large', 'extralarge') ],
+        "date": {"uts": str(start + i*180), "#text": ""},
+    } for i, p in enumerate(picks)]
+    return [ tracks[i:i+PAGE_SIZE] for i in range(0, len(tracks), PAGE_SIZE) ]
+
+
+def parse_orm(tracks: List[Dict[str,Any]]) -> List[Scrobble]:
+    """the previous parser, a transient Track and Scrobble per row"""
+    parsed = []
+    for scrobble in tracks:
+        if "date" not in scrobble: continue
+        t = Track(title=scrobble["name"],artist=scrobble["artist"]['#text'],album=scrobble["album"]['#text'])
+        parsed.append(Scrobble(track=t,timestamp=int(scrobble["date"]["uts"]))) #type:ignore
+    return parsed
+
+
+def parse_records(tracks: List[Dict[str,Any]]):
+    return parse_recent_tracks(tracks)
+
+
+def measure(parse, pages: List[List[Dict[str,Any]]], rows: int):
+    """(seconds to parse `rows` rows a page at a time, peak bytes allocated while parsing one page)"""
+    batches = rows // PAGE_SIZE
+    began = time.perf_counter()
+    for i in range(batches):
+        parse(pages[i % len(pages)])
+    elapsed = time.perf_counter() - began
+    tracemalloc.start()
+    parse(pages[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scrobbles', type=int, default=1000000)
+    args = parser.parse_args()
+
+    pages = synthetic_recent_tracks()
+    rows = args.scrobbles - args.scrobbles % PAGE_SIZE
+    #the mapped classes are configured on first use, not part of the parse cost
+    parse_orm(pages[0])
+    with app.app_context():
+        for name, parse in (('orm', parse_orm), ('records', parse_records)):
+            elapsed, peak = measure(parse, pages, rows)
+            print(f'{name:>8}: {rows} rows in {elapsed:.2f}s -> {rows/elapsed:,.0f} rows/sec, {peak/1024:,.0f} KiB peak per page')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""query count and latency of get_scrobbles_in_period: ORM entities + lazy track loads vs column projection
+
+usage: python -m benchmarks.read_path --sizes 10000 100000 [--db sqlite:///bench.db]
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+from sqlalchemy import event, desc
+
+from app import app
+from benchmarks.ingestion import synthetic_pages
+from lib.database import DbHelper, clear_user_cache
+from lib.interning import clear_track_interners
+from lib.migrations import upgrade_schema
+from lib.models import Scrobble, db
+
+
+def orm_hydration(helper: DbHelper, start: datetime, end: datetime):
+    """the previous implementation: full Scrobble entities, `to_dict()` lazy loads each Track"""
+    result = helper.session.query(Scrobble)\
+        .filter(Scrobble.datetime>=start).filter(Scrobble.datetime<=end)\
+        .filter(Scrobble.user==helper.user)\
+        .order_by(desc(Scrobble.datetime)).all()
+    return [ scrobble.to_dict() for scrobble in result ]
+
+
+def measure(read, helper: DbHelper, start: datetime, end: datetime):
+    queries = [0]
+    def count(*args):
+        queries[0] += 1
+    engine = helper.session.get_bind()
+    event.listen(engine, 'before_cursor_execute', count)
+    helper.session.expunge_all()
+    began = time.perf_counter()
+    rows = read(helper, start, end)
+    elapsed = time.perf_counter() - began
+    event.remove(engine, 'before_cursor_execute', count)
+    return len(rows), queries[0], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--db', default='sqlite:///benchmarks/read_path.db')
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.db
+    with app.app_context():
+        for size in args.sizes:
+            db.session.remove()
+            db.drop_all()
+            upgrade_schema()
+            clear_user_cache()
+            clear_track_interners()
+            helper = DbHelper('bench_reader')
+            helper.add_user_to_db()
+            for page in synthetic_pages(size):
+                helper.bulk_write_scrobbles_to_db(page)
+            start, end = datetime(1970,1,2), datetime.now()
+            for name, read in (('orm + lazy tracks', orm_hydration),
+                    ('column projection', lambda h, s, e: h.get_scrobbles_in_period(s, e))):
+                rows, queries, elapsed = measure(read, helper, start, end)
+                print(f'{size:>7} rows | {name:<18}: {queries:>6} queries, {elapsed*1000:9.1f} ms')
+        db.session.remove()
+        db.drop_all()
+    if args.db.startswith('sqlite:///') and os.path.exists(args.db[len('sqlite:///'):]):
+        os.remove(args.db[len('sqlite:///'):])
+
+
+if __name__ == '__main__':
+    main()
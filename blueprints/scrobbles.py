@@ -1,27 +1,76 @@
-from flask import Blueprint,request, jsonify, Response, make_response, current_app
+from flask import Blueprint,request, Response, make_response, current_app, stream_with_context
 from lib.errors import LastFMUserNotFound, ScrobbleFetchFailed, InValidParameter
-from datetime import datetime
+from datetime import datetime, time
 from dateutil.relativedelta import relativedelta
 from dateutil.parser import parse
 from dateutil.tz import UTC # type: ignore
 import typing
-from lib.database import DbHelper
+from lib.database import DbHelper, lookup_users
 from lib.lastfm import LastFMHelper
+from lib.cache import get_results_cache
+from lib.jobs import get_job_queue, job_status
+from lib import buckets, compare, fastjson, leaderboards
+from lib.fastjson import jsonify
 
 scrobbles_api = Blueprint('scrobbles',__name__)
 
 
 @scrobbles_api.route('/<username>/update', methods=['POST','GET'])
 def update_user_scrobbles(username):
+    """POST queues the update on a background worker and returns the job (202), GET updates synchronously"""
     current_app.logger.info(f"Updating scrobbles for user {username}")
     try:
+        if request.method == 'POST':
+            job, created = get_job_queue().submit(username)
+            current_app.logger.info(f"update job {job['id']} for {username} {'queued' if created else 'already pending'}")
+            return jsonify(job_status(job)), 202
         lf = LastFMHelper(username=username)
-        r = lf.get_or_update_user_scrobbles()
-        if r: return "updated", 200
+        summary = lf.get_or_update_user_scrobbles()
+        return jsonify(summary), 200
     except Exception as e:
         return __return_response_for_exception(e)
     
 
+@scrobbles_api.route('/<username>/jobs/<job_id>', methods=['GET'])
+def get_update_job(username, job_id):
+    job = get_job_queue().get(job_id)
+    if job is None or job['username'] != username:
+        return make_response(jsonify({"error": f"no update job {job_id} for {username}"}), 404)
+    return jsonify(job_status(job))
+
+
+@scrobbles_api.route('/compare', methods=['GET'])
+def compare_users():
+    """top artists of several users, their overlap and who listened to each artist most, in one response"""
+    try:
+        params = _get_request_param(request) or {}
+        names = _get_required_param(params, 'users')
+        if isinstance(names, str): names = names.split(',')
+        names = list(dict.fromkeys( name.strip() for name in names if name.strip() ))
+        max_users = current_app.config.get('COMPARE_MAX_USERS', 25)
+        if not names or len(names) > max_users:
+            raise InValidParameter(f"Error with request argument at users, expected 1 to {max_users} usernames")
+        current_app.logger.info(f"Comparing users {', '.join(names)}")
+        start, end, _ = _period_or_window(params)
+        try:
+            limit = int(_get_optional_or_default_param(params,'limit'))
+        except ValueError as e:
+            raise InValidParameter("Error with request argument at limit")
+        if limit <= 0:
+            raise InValidParameter("Error with request argument at limit, expected a positive number")
+        artist = params.get('artist')
+        users = lookup_users(names)
+        result = {
+            "start": str(start),
+            "end": str(end),
+            #tagged with every user's last update, an update of any of them misses the cache
+            **get_results_cache().get_or_compute(','.join(names), tuple( u[1] for u in users.values() ), 'compare',
+                (start, end, limit, artist), lambda: compare.compare(users, start, end, limit, artist))
+        }
+        return jsonify(result)
+    except Exception as e:
+        return __return_response_for_exception(e)
+
 @scrobbles_api.route('/<lf_username>', methods=['GET'])
 def get_scrobbles(lf_username):
     current_app.logger.info(f"Getting scrobbles for user {lf_username}")
@@ -31,7 +80,30 @@ def get_scrobbles(lf_username):
             end = parse(_get_required_param(_get_request_param(request),'end')).replace(tzinfo=UTC)
         except ValueError as e:
             raise InValidParameter("Error processing request at start/end parameter")
+        params = _get_request_param(request) or {}
+        try:
+            after = int(params['after']) if 'after' in params else None
+            limit = int(params['limit']) if 'limit' in params else None
+        except ValueError as e:
+            raise InValidParameter("Error processing request at after/limit parameter")
+        if limit is not None and limit <= 0:
+            raise InValidParameter("Error with request argument at limit, expected a positive number")
+        if after is not None and after < 0:
+            raise InValidParameter("Error with request argument at after, expected a timestamp")
+        stream = params.get('stream')
+        if stream not in (None, 'json', 'ndjson'):
+            raise InValidParameter("Error with request argument at stream, expected json or ndjson")
         db = DbHelper(lf_username)
+        if stream:
+            return _stream_scrobbles(db, start, end, after, limit, stream)
+        if after is not None or limit:
+            rows = list(db.iter_scrobbles_in_period(start, end, after=after, limit=limit))
+            return jsonify({
+                "start" : f'{start}',
+                "end" : f'{end}',
+                "scrobbles": [ scrobble for _, scrobble in rows ],
+                "next": rows[-1][0] if limit and len(rows) == limit else None
+            })
         track_scrobbles = {
             "start" : f'{start}',
             "end" : f'{end}',
@@ -42,22 +114,42 @@ def get_scrobbles(lf_username):
     except Exception as e:
         return __return_response_for_exception(e)
 
+def _stream_scrobbles(db: DbHelper, start: datetime, end: datetime, after: typing.Optional[int],
+        limit: typing.Optional[int], stream: str) -> Response:
+    """streams the scrobbles as they are read, either as a chunked json document or as ndjson
+    (one scrobble per line, then a {"next": cursor} line)"""
+    rows = db.iter_scrobbles_in_period(start, end, after=after, limit=limit)
+    def generate():
+        count, last = 0, None
+        if stream == 'json':
+            yield f'{{"start": {fastjson.dumps(str(start))}, "end": {fastjson.dumps(str(end))}, "scrobbles": ['
+        for timestamp, scrobble in rows:
+            if stream == 'json':
+                yield (',' if count else '') + fastjson.dumps(scrobble)
+            else:
+                yield fastjson.dumps(scrobble) + '\n'
+            count, last = count+1, timestamp
+        next_cursor = last if limit and count == limit else None
+        if stream == 'json':
+            yield f'], "next": {fastjson.dumps(next_cursor)}}}'
+        else:
+            yield fastjson.dumps({"next": next_cursor}) + '\n'
+    mimetype = 'application/json' if stream == 'json' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
 @scrobbles_api.route('/<lf_username>/top-tracks', methods=['GET'])
 def get_top_tracks(lf_username):
     current_app.logger.info(f"Getting top tracks for user {lf_username}")
     try:
-        try:
-            start = parse(_get_required_param(_get_request_param(request),'start')).replace(tzinfo=UTC)
-            end = parse(_get_required_param(_get_request_param(request),'end')).replace(tzinfo=UTC)
-        except ValueError as e:
-            raise InValidParameter("Error processing request at start/end parameter")
+        start, end, days = _period_or_window(_get_request_param(request))
         limit = _get_optional_or_default_param(_get_request_param(request),'limit')
         if not limit: limit = 5
         db = DbHelper(lf_username)
         top_tracks = {
             "start" : f'{start}',
             "end" : f'{end}',
-            "top tracks": db.get_top_tracks_for_period(start,end,int(limit))
+            "top tracks": _top_n(db, 'top-tracks', start, end, days, limit,
+                db.get_top_tracks_for_period, db.get_top_tracks_for_window)
         }
         return jsonify(top_tracks)
     except Exception as e:
@@ -67,17 +159,14 @@ def get_top_tracks(lf_username):
 def get_top_albums(lf_username):
     current_app.logger.info(f"Getting top albums for user {lf_username}")
     try:
-        try:
-            start = parse(_get_required_param(_get_request_param(request),'start')).replace(tzinfo=UTC)
-            end = parse(_get_required_param(_get_request_param(request),'end')).replace(tzinfo=UTC)
-        except ValueError as e:
-            raise InValidParameter("Error processing request at start/end parameter")
+        start, end, days = _period_or_window(_get_request_param(request))
         limit = _get_optional_or_default_param(_get_request_param(request),'limit')
         db = DbHelper(lf_username)
         top_tracks = {
             "start" : f'{start}',
             "end" : f'{end}',
-            "top albums": db.get_top_albums_for_period(start,end,limit)
+            "top albums": _top_n(db, 'top-albums', start, end, days, limit,
+                db.get_top_albums_for_period, db.get_top_albums_for_window)
         }
         return jsonify(top_tracks)
     except Exception as e:
@@ -87,17 +176,14 @@ def get_top_albums(lf_username):
 def get_top_artist(lf_username):
     current_app.logger.info(f"Getting top artist for user {lf_username}")
     try:
-        try:
-            start = parse(_get_required_param(_get_request_param(request),'start')).replace(tzinfo=UTC)
-            end = parse(_get_required_param(_get_request_param(request),'end')).replace(tzinfo=UTC)
-        except ValueError as e:
-            raise InValidParameter("Error processing request at start/end parameter")
+        start, end, days = _period_or_window(_get_request_param(request))
         limit = _get_optional_or_default_param(_get_request_param(request),'limit')
         db = DbHelper(lf_username)
         top_tracks = {
             "start" : f'{start}',
             "end" : f'{end}',
-            "top artists": db.get_top_artists_for_period(start,end,limit)
+            "top artists": _top_n(db, 'top-artists', start, end, days, limit,
+                db.get_top_artists_for_period, db.get_top_artists_for_window)
         }
         return jsonify(top_tracks)
     except Exception as e:
@@ -113,17 +199,70 @@ def get_listening_frequency(lf_username):
             scale = _get_required_param(_get_request_param(request),'scale')
         except ValueError as e:
             raise InValidParameter("Error processing request at start/end parameter")
+        if scale not in buckets.UNITS:
+            raise InValidParameter(f"Error with request argument at scale, expected one of {', '.join(buckets.UNITS)}")
+        tz = _get_request_param(request).get('tz')
+        try:
+            buckets.get_tz(tz)
+        except ValueError as e:
+            raise InValidParameter(f"Error with request argument at tz, {e}")
         db = DbHelper(lf_username)
+        def compute():
+            try:
+                return db.get_track_count_in_period(start_period=start,end_period=end,unit=scale,tz=tz)
+            except ValueError as e:
+                raise InValidParameter(str(e))
         frequency = {
             "start": str(start),
             "end": str(end),
-            "frequency": db.get_track_count_in_period(start_period=start,end_period=end,unit=scale)
+            "frequency": _cached(db, 'frequency', (start,end,scale,tz), compute)
         }
         return jsonify(frequency)
     except Exception as e:
         return __return_response_for_exception(e)
             
 
+@scrobbles_api.route('/<lf_username>/summary', methods=['GET'])
+def get_summary(lf_username):
+    """top tracks, albums, artists and frequency of one range in a single response"""
+    current_app.logger.info(f"Getting summary for user {lf_username}")
+    try:
+        try:
+            start = parse(_get_required_param(_get_request_param(request),'start')).replace(tzinfo=UTC)
+            end = parse(_get_required_param(_get_request_param(request),'end')).replace(tzinfo=UTC)
+        except ValueError as e:
+            raise InValidParameter("Error processing request at start/end parameter")
+        params = _get_request_param(request)
+        try:
+            limit = int(_get_optional_or_default_param(params,'limit'))
+        except ValueError as e:
+            raise InValidParameter("Error with request argument at limit")
+        if limit <= 0:
+            raise InValidParameter("Error with request argument at limit, expected a positive number")
+        scale = params.get('scale', 'days')
+        if scale not in buckets.UNITS:
+            raise InValidParameter(f"Error with request argument at scale, expected one of {', '.join(buckets.UNITS)}")
+        tz = params.get('tz')
+        try:
+            buckets.get_tz(tz)
+        except ValueError as e:
+            raise InValidParameter(f"Error with request argument at tz, {e}")
+        db = DbHelper(lf_username)
+        def compute():
+            try:
+                return db.get_summary_for_period(start, end, limit, scale, tz)
+            except ValueError as e:
+                raise InValidParameter(str(e))
+        summary = {
+            "start": str(start),
+            "end": str(end),
+            **_cached(db, 'summary', (start,end,limit,scale,tz), compute)
+        }
+        return jsonify(summary)
+    except Exception as e:
+        return __return_response_for_exception(e)
+
+
 def __return_response_for_exception(error: Exception) -> Response:
     r = [{"error": str(error)},500]
     if isinstance(error,LastFMUserNotFound):
@@ -135,6 +274,35 @@ def __return_response_for_exception(error: Exception) -> Response:
 
     return make_response(jsonify(r[0]), r[1])
 
+def _period_or_window(params) -> typing.Tuple[datetime, datetime, typing.Optional[int]]:
+    """(start, end, days) of a `window` (week, month or year, ending today) or (start, end, None) of the
+    request's start/end"""
+    window = params.get('window') if params else None
+    if window is not None:
+        if window not in leaderboards.WINDOWS:
+            raise InValidParameter(f"Error with request argument at window, expected one of {', '.join(leaderboards.WINDOWS)}")
+        days = leaderboards.WINDOWS[window]
+        first, last = leaderboards.window_days(days)
+        return datetime.combine(first, time.min).replace(tzinfo=UTC), datetime.combine(last, time.max).replace(tzinfo=UTC), days
+    try:
+        start = parse(_get_required_param(params,'start')).replace(tzinfo=UTC)
+        end = parse(_get_required_param(params,'end')).replace(tzinfo=UTC)
+    except ValueError as e:
+        raise InValidParameter("Error processing request at start/end parameter")
+    return start, end, None
+
+def _top_n(db: DbHelper, endpoint: str, start: datetime, end: datetime, days: typing.Optional[int], limit,
+        for_period: typing.Callable, for_window: typing.Callable) -> typing.Any:
+    """a top-N list, for a window from the rolling leaderboard (cached under the window's days) when
+    `LEADERBOARDS` is on, otherwise from the period query"""
+    if days and current_app.config.get('LEADERBOARDS', True):
+        return _cached(db, endpoint, (f'{days} days', start, end, limit), lambda: for_window(days, int(limit)))
+    return _cached(db, endpoint, (start, end, limit), lambda: for_period(start, end, int(limit)))
+
+def _cached(db: DbHelper, endpoint: str, params: tuple, compute: typing.Callable[[], typing.Any]) -> typing.Any:
+    """serves `compute()` from the results cache, entries are tagged with the user's last update"""
+    return get_results_cache().get_or_compute(db.username, db.last_update, endpoint, params, compute)
+
 def _get_optional_or_default_param(params,param):
     if param in params:
         return params[param]
@@ -153,7 +321,8 @@ def _get_required_param(params,param):
         raise InValidParameter(f"Error with request argument at {param}")
 
 def _get_request_param(r):
-    if r.args:
+    #?profile=1 alone doesn't move the parameters out of the json body
+    if r.args and set(r.args) != {'profile'}:
         return r.args
     elif r.json:
         return r.json
@@ -0,0 +1,100 @@
+import time
+from datetime import datetime, timedelta
+from flask import Flask, current_app as app, g
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool, NullPool, StaticPool
+from typing import Any, Dict, Optional, Tuple
+from lib import metrics
+
+#the SQLALCHEMY_BINDS key of the read replica
+REPLICA = 'replica'
+#(config key, create_engine argument), only set keys are passed
+POOL_OPTIONS = (('DB_POOL_SIZE', 'pool_size'), ('DB_MAX_OVERFLOW', 'max_overflow'),
+    ('DB_POOL_TIMEOUT', 'pool_timeout'), ('DB_POOL_RECYCLE', 'pool_recycle'))
+QUEUE_ONLY_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+CHECKOUT_SECONDS = metrics.REGISTRY.histogram('db_pool_checkout_seconds', 'time waited for a pooled connection',
+    ('bind',), (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0))
+
+
+class TimedQueuePool(QueuePool):
+    """a QueuePool recording how long each checkout waited for a connection (or to open one)"""
+    bind = 'primary'
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            CHECKOUT_SECONDS.observe(time.perf_counter() - started, bind=self.bind)
+
+
+_pool_classes: Dict[str,type] = {}
+
+def timed_pool(bind: str) -> type:
+    """the TimedQueuePool class labelled `bind`, a class so recreated pools keep the label"""
+    if bind not in _pool_classes:
+        _pool_classes[bind] = type(f'TimedQueuePool_{bind}', (TimedQueuePool,), {'bind': bind})
+    return _pool_classes[bind]
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """applies the DB_POOL_* settings to every engine (primary and replica) and times their checkouts"""
+
+    def apply_driver_hacks(self, app: Flask, sa_url: Any, options: Dict[str,Any]) -> Tuple[Any,Dict[str,Any]]:
+        config = app.config
+        replica = (config.get('SQLALCHEMY_BINDS') or {}).get(REPLICA)
+        bind = REPLICA if replica and str(make_url(replica)) == str(sa_url) else 'primary'
+        #set before flask-sqlalchemy's defaults, a pool size gives sqlite files a queue instead of NullPool
+        options.update({ option: config[key] for key, option in POOL_OPTIONS if config.get(key) is not None })
+        if config.get('DB_POOL_PRE_PING'): options['pool_pre_ping'] = True
+        result = super().apply_driver_hacks(app, sa_url, options)
+        #flask-sqlalchemy < 2.5 edits the url and options in place and returns nothing
+        if result is not None: sa_url, options = result
+        if options.get('poolclass') in (NullPool, StaticPool):
+            for option in QUEUE_ONLY_OPTIONS: options.pop(option, None)
+            return sa_url, options
+        options['poolclass'] = timed_pool(bind)
+        if sa_url.drivername.startswith('sqlite'):
+            #pooled sqlite connections move between threads
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        return sa_url, options
+
+
+def replica_configured() -> bool:
+    return bool((app.config.get('SQLALCHEMY_BINDS') or {}).get(REPLICA))
+
+def read_session(updated: Optional[datetime]=None) -> Session:
+    """the session analytics reads use: on the replica bind when one is configured (one per app context,
+    autocommit so every read sees the replica's latest state), otherwise the primary `db.session`.
+    Reads of data last updated at `updated` (server local time) stay on the primary for
+    `REPLICA_MAX_LAG_SECONDS`, the replica may not have those rows yet and results are cached by that update
+    """
+    from lib.models import db
+    if not replica_configured(): return db.session
+    if updated is not None and updated > datetime.now() - timedelta(seconds=app.config.get('REPLICA_MAX_LAG_SECONDS', 60)):
+        return db.session
+    if 'read_session' not in g:
+        g.read_session = Session(bind=db.get_engine(app, bind=REPLICA), autocommit=True)
+    return g.read_session
+
+def close_read_session(error: Any=None) -> None:
+    session = g.pop('read_session', None)
+    if session is not None: session.close()
+
+def pool_stats() -> Dict[str,Dict[str,int]]:
+    """checked out/idle/overflow connections per bind, for the queue pools in use"""
+    from lib.models import db
+    stats = {}
+    binds = [('primary', None)] + ([(REPLICA, REPLICA)] if replica_configured() else [])
+    for name, bind in binds:
+        pool = db.get_engine(app, bind=bind).pool
+        if isinstance(pool, QueuePool):
+            stats[name] = {"checked_out": pool.checkedout(), "idle": pool.checkedin(), "overflow": max(0, pool.overflow())}
+    return stats
+
+
+def init_app(flask_app: Flask) -> None:
+    flask_app.teardown_appcontext(close_read_session)
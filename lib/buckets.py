@@ -0,0 +1,134 @@
+import math
+from datetime import datetime, date, timedelta, tzinfo
+from dateutil import tz as dateutil_tz
+from typing import Dict, Iterable, List, Optional, Tuple
+
+UNITS = ('hours', 'days', 'weekdays', 'months', 'years')
+#every utc offset in use is a multiple of 15 minutes, plays counted at this grain can be bucketed in any zone
+GRAIN = 900
+#dense responses are capped, an hourly histogram of ~11 years
+MAX_BUCKETS = 100000
+
+_EPOCH = datetime(1970,1,1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+
+
+def get_tz(name: Optional[str]=None) -> tzinfo:
+    """the IANA zone `name`, or the server's local zone
+
+    Raises:
+        ValueError: [unknown zone]
+    """
+    if not name: return dateutil_tz.tzlocal()
+    zone = dateutil_tz.gettz(name)
+    if zone is None: raise ValueError(f"unknown timezone {name}")
+    return zone
+
+def period_timestamps(start: datetime, end: datetime, zone: tzinfo) -> Tuple[int,int]:
+    """the inclusive period as whole unix timestamps, naive bounds are wall times in `zone`
+
+    Raises:
+        ValueError: [a bound the platform can't convert, e.g. year 1]
+    """
+    start = start if start.tzinfo else start.replace(tzinfo=zone)
+    end = end if end.tzinfo else end.replace(tzinfo=zone)
+    try:
+        return int(math.ceil(start.timestamp())), int(math.floor(end.timestamp()))
+    except (OverflowError, ValueError, OSError) as e:
+        raise ValueError(f"start/end out of range, {e}")
+
+def check_buckets(start_ts: int, end_ts: int, unit: str) -> None:
+    """fails fast on periods `histogram` would refuse, before their plays are read (utc offsets move
+    the count by at most one bucket, `histogram` checks the exact count)
+
+    Raises:
+        ValueError: [more than `MAX_BUCKETS` buckets]
+    """
+    if start_ts <= end_ts: _check_count(_bucket_count(start_ts // 86400, end_ts // 86400, unit, start_ts // 3600, end_ts // 3600), unit)
+
+def utc_offsets(zone: tzinfo, start_ts: int, end_ts: int) -> List[Tuple[int,int]]:
+    """(from timestamp, utc offset in seconds) segments covering [start_ts, end_ts], the zone is probed
+    weekly and transitions are located by bisection"""
+    def offset(ts):
+        return int(datetime.fromtimestamp(ts, zone).utcoffset().total_seconds())
+    segments = [(start_ts, offset(start_ts))]
+    probe = start_ts
+    while probe < end_ts:
+        step = min(probe + 7*86400, end_ts)
+        if offset(step) != segments[-1][1]:
+            lo, hi = probe, step
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if offset(mid) == segments[-1][1]: lo = mid
+                else: hi = mid
+            segments.append((hi, offset(hi)))
+            probe = hi
+        else:
+            probe = step
+    return segments
+
+def whole_hour_offsets(segments: List[Tuple[int,int]]) -> bool:
+    """utc hours map onto single local hours, so hourly rollups can be bucketed"""
+    return all(offset % 3600 == 0 for _, offset in segments) and all(start % 3600 == 0 for start, _ in segments[1:])
+
+def histogram(plays: Iterable[Tuple[int,int]], start_ts: int, end_ts: int, unit: str,
+        segments: List[Tuple[int,int]]) -> Dict[str,int]:
+    """dense, chronological plays per local `unit` in [start_ts, end_ts], empty buckets are 0.
+    `plays` are (timestamp, plays) pairs inside the period at `GRAIN` (or coarser, within a local hour) and
+    `segments` the zone's `utc_offsets` for the period. Keys are those of the previous sparse results:
+    "2019-01-23 05:00:00" (hours), "2019-01-23" (days), "2019-01-01 00:00:00" (months, years),
+    and "1" (monday) to "7" for weekdays.
+
+    Raises:
+        ValueError: [unknown unit, or the period has more than `MAX_BUCKETS` buckets]
+    """
+    if unit not in UNITS: raise ValueError(f"unknown unit {unit}, expected one of {', '.join(UNITS)}")
+    if start_ts > end_ts: return {}
+    size = 3600 if unit == 'hours' else 86400
+    counts: Dict[int,int] = {}
+    i = 0
+    for ts, n in sorted(plays):
+        while i + 1 < len(segments) and segments[i+1][0] <= ts: i += 1
+        bucket = (ts + segments[i][1]) // size
+        counts[bucket] = counts.get(bucket, 0) + int(n)
+    first = (start_ts + segments[0][1]) // size
+    last = (end_ts + segments[-1][1]) // size
+    if unit == 'hours':
+        _check_count(last - first + 1, unit)
+        return { str(_EPOCH + timedelta(hours=h)): counts.get(h, 0) for h in range(first, last+1) }
+    if unit != 'weekdays':
+        _check_count(_bucket_count(first, last, unit), unit)
+    if unit == 'days':
+        return { str(_day(d)): counts.get(d, 0) for d in range(first, last+1) }
+    if unit == 'weekdays':
+        weekdays = { str(w): 0 for w in range(1, 8) }
+        for d, n in counts.items():
+            weekdays[str(_day(d).isoweekday())] += n
+        return weekdays
+    first_day, last_day = _day(first), _day(last)
+    if unit == 'months':
+        key = lambda day: str(datetime(day.year, day.month, 1))
+        keys = [ key(date(y, m, 1)) for y in range(first_day.year, last_day.year+1) for m in range(1, 13)
+            if (first_day.year, first_day.month) <= (y, m) <= (last_day.year, last_day.month) ]
+    else:
+        key = lambda day: str(datetime(day.year, 1, 1))
+        keys = [ str(datetime(y, 1, 1)) for y in range(first_day.year, last_day.year+1) ]
+    results = dict.fromkeys(keys, 0)
+    for d, n in counts.items():
+        results[key(_day(d))] += n
+    return results
+
+def _bucket_count(first_day: int, last_day: int, unit: str, first_hour: int=0, last_hour: int=0) -> int:
+    """dense buckets from day number `first_day` to `last_day` (hour numbers for hours)"""
+    if unit == 'hours': return last_hour - first_hour + 1
+    if unit == 'days': return last_day - first_day + 1
+    if unit == 'weekdays': return 7
+    first, last = _EPOCH + timedelta(days=first_day), _EPOCH + timedelta(days=last_day)
+    if unit == 'months': return (last.year - first.year) * 12 + last.month - first.month + 1
+    return last.year - first.year + 1
+
+def _check_count(count: int, unit: str) -> None:
+    if count > MAX_BUCKETS: raise ValueError(f"{count} {unit} is too many buckets, use a larger scale")
+
+def _day(day_number: int) -> date:
+    return date.fromordinal(_EPOCH_ORDINAL + day_number)
@@ -0,0 +1,139 @@
+import json
+import threading
+from collections import OrderedDict
+from flask import current_app as app
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class NullBackend:
+    """caching disabled"""
+
+    def get(self, key: str) -> Optional[Any]:
+        return None
+
+    def set(self, key: str, user: str, value: Any) -> None:
+        pass
+
+    def invalidate_user(self, user: str) -> None:
+        pass
+
+    def clear(self) -> None:
+        pass
+
+
+class LRUBackend:
+    """in process, thread safe LRU keeping at most `size` entries"""
+
+    def __init__(self, size: int=1024) -> None:
+        self.size = size
+        self._entries: OrderedDict = OrderedDict()
+        self._users: Dict[str,set] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key not in self._entries: return None
+            self._entries.move_to_end(key)
+            return self._entries[key][1]
+
+    def set(self, key: str, user: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (user, value)
+            self._entries.move_to_end(key)
+            self._users.setdefault(user, set()).add(key)
+            while len(self._entries) > self.size:
+                old_key, (old_user, _) = self._entries.popitem(last=False)
+                self._users.get(old_user, set()).discard(old_key)
+
+    def invalidate_user(self, user: str) -> None:
+        with self._lock:
+            for key in self._users.pop(user, set()):
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._users.clear()
+
+
+class RedisBackend:
+    """shared backend so every worker process sees the same entries, needs the optional `redis` package"""
+
+    def __init__(self, url: str, ttl: int=3600, prefix: str='lastfm:results:') -> None:
+        try:
+            import redis
+        except ImportError:
+            raise ValueError("RESULTS_CACHE_BACKEND is redis but the redis package is not installed")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, user: str, value: Any) -> None:
+        pipe = self.client.pipeline()
+        pipe.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+        pipe.sadd(f'{self.prefix}user:{user}', self.prefix + key)
+        pipe.expire(f'{self.prefix}user:{user}', self.ttl)
+        pipe.execute()
+
+    def invalidate_user(self, user: str) -> None:
+        keys = self.client.smembers(f'{self.prefix}user:{user}')
+        if keys: self.client.delete(*keys)
+        self.client.delete(f'{self.prefix}user:{user}')
+
+    def clear(self) -> None:
+        for key in self.client.scan_iter(f'{self.prefix}*'):
+            self.client.delete(key)
+
+
+class ResultCache:
+    """caches analytics results keyed by (user, endpoint, params) and tagged with the user's
+    `last_update`. An update changes the tag so stale entries are never read again (in any process),
+    and the writing process also drops the user's entries eagerly with `invalidate_user`.
+    """
+
+    def __init__(self, backend) -> None:
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(user: str, tag: Any, endpoint: str, params: Tuple[Hashable,...]) -> str:
+        return json.dumps([user, str(tag), endpoint, [ str(p) for p in params ]])
+
+    def get_or_compute(self, user: str, tag: Any, endpoint: str, params: Tuple[Hashable,...], compute: Callable[[], Any]) -> Any:
+        key = self.make_key(user, tag, endpoint, params)
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = compute()
+        self.backend.set(key, user, value)
+        return value
+
+    def invalidate_user(self, user: str) -> None:
+        self.backend.invalidate_user(user)
+
+    def stats(self) -> Dict[str,int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def create_backend(config) -> Any:
+    backend = config.get('RESULTS_CACHE_BACKEND', 'lru')
+    if backend == 'lru':
+        return LRUBackend(config.get('RESULTS_CACHE_SIZE', 1024))
+    elif backend == 'redis':
+        return RedisBackend(config['RESULTS_CACHE_REDIS_URL'], config.get('RESULTS_CACHE_TTL', 3600))
+    elif backend in ('none', None):
+        return NullBackend()
+    raise ValueError(f"unknown RESULTS_CACHE_BACKEND {backend}")
+
+
+def get_results_cache() -> ResultCache:
+    if 'results_cache' not in app.extensions:
+        app.extensions['results_cache'] = ResultCache(create_backend(app.config))
+    return app.extensions['results_cache']
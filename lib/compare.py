@@ -0,0 +1,84 @@
+from datetime import datetime
+from itertools import combinations
+from sqlalchemy import func
+from typing import Any, Dict, List, Optional, Tuple
+from flask import current_app as app
+from lib import engine
+from lib.binds import read_session
+from lib.database import MAX_SQL_VARIABLES, _naive, daily_plays_in_period
+from lib.models import Track, db
+
+#the users' ids appear in both halves of the plays subquery
+_CHUNK = MAX_SQL_VARIABLES // 4
+
+
+def _loaded_columns(user_id: int, last_update: Optional[datetime]) -> Optional['engine.UserColumns']:
+    """the user's columns if this process already holds them up to date, compare never loads histories"""
+    if not app.config.get('COLUMNAR_ENGINE', False) or not engine.available(): return None
+    columns = engine.get_columnar_store(app.config.get('COLUMNAR_MAX_USERS', 32)).get((str(db.session.get_bind().url), user_id))
+    return columns if columns is not None and columns.tag == last_update else None
+
+
+def artist_plays(users: Dict[int,Optional[datetime]], start: datetime, end: datetime) -> Dict[int,Dict[str,int]]:
+    """plays per artist of each user ({user id: last update}) in the period. Users the columnar engine has
+    loaded are counted in memory, the others with one grouped query over `user_id IN (...)`
+    """
+    plays: Dict[int,Dict[str,int]] = { user_id: {} for user_id in users }
+    remaining = []
+    for user_id, last_update in users.items():
+        columns = _loaded_columns(user_id, last_update)
+        if columns is None: remaining.append(user_id)
+        else: plays[user_id] = columns.artist_plays(_naive(start), _naive(end))
+    session = read_session(max(( u for u in users.values() if u is not None ), default=None))
+    for i in range(0, len(remaining), _CHUNK):
+        daily = daily_plays_in_period(session, remaining[i:i+_CHUNK], start, end)
+        for user_id, artist, n in session.query(daily.c.user_id, Track.artist, func.sum(daily.c.plays))\
+                .join(daily, daily.c.track_id==Track.id).group_by(daily.c.user_id, Track.artist):
+            plays[user_id][artist] = int(n)
+    return plays
+
+
+def _top(artists: Dict[str,int], limit: int) -> List[Tuple[str,int]]:
+    """most played first, ties by name like the top-N queries"""
+    return sorted(artists.items(), key=lambda a: (-a[1], a[0]))[:limit]
+
+
+def _listeners(artist: str, plays: Dict[str,Dict[str,int]]) -> List[Dict[str,Any]]:
+    ranked = sorted(((name, artists[artist]) for name, artists in plays.items() if artists.get(artist)), key=lambda u: (-u[1], u[0]))
+    return [ {"user": name, "played": n} for name, n in ranked ]
+
+
+def compare(users: Dict[str,Tuple[Optional[int],Optional[datetime]]], start: datetime, end: datetime, limit: int=5,
+        artist: Optional[str]=None) -> Dict[str,Any]:
+    """top `limit` artists of each user ({username: (user id, last update)}, unknown users have no id) in the
+    period, the overlap of those lists and who played each of them most. Artists are grouped by name here,
+    not by title like `get_top_artists_for_period`, so a list never repeats an artist.
+
+    Returns:
+        Dict[str,Any]: "users" (plays, distinct artists and top artists per user), "overlap" (the artists in
+        every list and the jaccard index of every pair of lists), "top listeners" (per listed artist) and,
+        when `artist` is given, "listeners" of that artist
+    """
+    by_id = artist_plays({ user_id: last_update for user_id, last_update in users.values() if user_id is not None }, start, end)
+    plays = { name: by_id.get(user_id, {}) if user_id is not None else {} for name, (user_id, _) in users.items() }
+    tops = { name: _top(artists, limit) for name, artists in plays.items() }
+    sets = { name: { a for a, _ in top } for name, top in tops.items() }
+    common = set.intersection(*sets.values()) if sets else set()
+    pairs = []
+    for a, b in combinations(users, 2):
+        union = sets[a] | sets[b]
+        pairs.append({"users": [a, b], "common": sorted(sets[a] & sets[b]),
+            "jaccard": round(len(sets[a] & sets[b]) / len(union), 4) if union else 0.0})
+    listed = sorted(set().union(*sets.values()))
+    result: Dict[str,Any] = {
+        "users": { name: {
+            "played": sum(plays[name].values()),
+            "artists": len(plays[name]),
+            "top artists": [ {"artist": a, "played": n} for a, n in tops[name] ]
+        } for name in users },
+        "overlap": {"common artists": sorted(common), "pairs": pairs},
+        "top listeners": { a: _listeners(a, plays)[0] for a in listed },
+    }
+    if artist is not None:
+        result["listeners"] = {"artist": artist, "users": _listeners(artist, plays)}
+    return result
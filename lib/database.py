@@ -1,30 +1,170 @@
-from sqlalchemy import create_engine, func, desc
+from sqlalchemy import create_engine, func, desc, or_, and_
 from sqlalchemy import Column, String, Date, Time, DateTime, Integer, ForeignKey, UniqueConstraint
-from datetime import datetime
-from sqlalchemy.orm import sessionmaker, relationship
+from datetime import datetime, date, time, timedelta
+from sqlalchemy.orm import Session, sessionmaker, relationship
+from sqlalchemy.exc import IntegrityError
 from flask_sqlalchemy import SQLAlchemy
 from dateutil.relativedelta import relativedelta
-from typing import List, Dict, Any
-from lib.models import Scrobble, Track, User, db
+from collections import OrderedDict
+from time import monotonic
+import threading
+from typing import List, Dict, Any, Tuple, Optional, Iterator
+from flask import current_app
+from lib.cache import get_results_cache
+from lib.interning import TrackInterner, get_track_interner
+from lib.records import AnyScrobble, ParsedScrobble, as_records
+from lib.binds import read_session
+from lib import buckets, engine, leaderboards
+from lib.models import Scrobble, Track, User, DailyRollup, HourlyRollup, SyncCheckpoint, db
+
+#lowest common bound parameter limit (sqlite < 3.32), multi row inserts are chunked to stay under it
+MAX_SQL_VARIABLES = 999
+
+
+def app_config(key: str, default: Any=None) -> Any:
+    return current_app.config.get(key, default)
+
+def _naive(d: datetime) -> datetime:
+    """scrobble datetimes are stored naive (server local), bounds are compared the same way"""
+    return d.replace(tzinfo=None)
+
+
+def _of_users(column: Any, user_ids: List[int]) -> Any:
+    return column==user_ids[0] if len(user_ids) == 1 else column.in_(user_ids)
+
+def daily_plays_in_period(session: Any, user_ids: List[int], start_period: datetime, end_period: datetime):
+    """subquery of (user_id, track_id, day, plays) for the scrobbles of `user_ids` in the period,
+    days wholly inside the period are read from the daily rollup and only the partial
+    days at the edges are counted from the raw scrobbles
+    """
+    start, end = _naive(start_period), _naive(end_period)
+    raw = session.query(Scrobble.user_id.label('user_id'), Scrobble.track_id.label('track_id'), Scrobble.date.label('day'),
+            func.count(Scrobble.id).label('plays'))\
+        .filter(_of_users(Scrobble.user_id, user_ids))\
+        .filter(Scrobble.datetime>=start).filter(Scrobble.datetime<=end)
+    first_day = start.date() if start.time() == time.min else start.date() + timedelta(days=1)
+    #a day is whole if the next midnight is still inside the (inclusive) period
+    last_day = end.date() - timedelta(days=1)
+    if not app_config('ROLLUP_QUERIES', True) or first_day > last_day:
+        return raw.group_by(Scrobble.user_id, Scrobble.track_id, Scrobble.date).subquery()
+    raw = raw.filter(or_(
+        Scrobble.datetime < datetime.combine(first_day, time.min),
+        Scrobble.datetime >= datetime.combine(last_day + timedelta(days=1), time.min)))\
+        .group_by(Scrobble.user_id, Scrobble.track_id, Scrobble.date)
+    rollup = session.query(DailyRollup.user_id.label('user_id'), DailyRollup.track_id.label('track_id'),
+            DailyRollup.day.label('day'), DailyRollup.plays.label('plays'))\
+        .filter(_of_users(DailyRollup.user_id, user_ids))\
+        .filter(DailyRollup.day>=first_day).filter(DailyRollup.day<=last_day)
+    return rollup.union_all(raw).subquery()
+
+
+def insert_ignore(table: Any, rows: List[Dict[str,Any]], dialect: str) -> Any:
+    """`INSERT IGNORE` on mysql and `INSERT OR IGNORE` on sqlite, both report only the rows they inserted
+    (`ON DUPLICATE KEY UPDATE` would count duplicates as found rows under the dialect's CLIENT_FOUND_ROWS)
+    """
+    return table.insert().values(rows).prefix_with('IGNORE' if dialect == 'mysql' else 'OR IGNORE')
+
+
+class _UserCache():
+    """process wide username -> (user id, last update) map, entries expire after `USER_CACHE_TTL` seconds.
+    The process that writes a user's scrobbles updates its entry, other workers see the new
+    last update (the results cache tag) once their entry expires.
+    """
+
+    def __init__(self):
+        self._entries: Dict[Tuple[str,str],Tuple[float,int,Optional[datetime]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str,str]) -> Optional[Tuple[int,Optional[datetime]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None: return None
+            if entry[0] < monotonic():
+                del self._entries[key]
+                return None
+            return entry[1], entry[2]
+
+    def set(self, key: Tuple[str,str], user_id: int, last_update: Optional[datetime], ttl: float) -> None:
+        with self._lock:
+            self._entries[key] = (monotonic() + ttl, user_id, last_update)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+_user_cache = _UserCache()
+
+def clear_user_cache() -> None:
+    _user_cache.clear()
+
+
+def lookup_users(names: List[str]) -> Dict[str,Tuple[Optional[int],Optional[datetime]]]:
+    """(user id, last update) per username like `DbHelper` resolves them, the names missing from the
+    per process cache are read in one query. Unknown users get (None, None).
+    """
+    session = db.session
+    url = str(session.get_bind().url)
+    users: Dict[str,Tuple[Optional[int],Optional[datetime]]] = {}
+    missing = []
+    for name in names:
+        cached = _user_cache.get((url, name))
+        if cached: users[name] = cached
+        else: missing.append(name)
+    for i in range(0, len(missing), MAX_SQL_VARIABLES):
+        for user in session.query(User).filter(User.name.in_(missing[i:i+MAX_SQL_VARIABLES])):
+            users[user.name] = (user.id, user.last_update)
+            _user_cache.set((url, user.name), user.id, user.last_update, app_config('USER_CACHE_TTL', 60))
+    return { name: users.get(name, (None, None)) for name in names }
 
 
 class DbHelper():
 
     def __init__(self,username: str):
-        from app import db
-        db.create_all()
-        if not db:
-            raise ValueError("DB Initialization failed")
+        """no schema work happens here, tables are created once by `lib.migrations.upgrade_schema`
+        (at startup or with `flask upgrade-db`) and the user id comes from a per process cache
+        """
+        self.session = db.session
+        self.username = username
+        self._user: Optional[User] = None
+        cached = _user_cache.get(self._user_cache_key())
+        if cached:
+            self.user_id, self.last_update = cached
         else:
-            self.session = db.session
-        self.user = self.session.query(User).filter_by(name = username).first()
-        if not self.user: self.user = User(name=username)
+            self._cache_user()
+
+    @property
+    def read_session(self) -> Session:
+        """analytics reads, on the read replica when one is configured and has had time to catch up with
+        this user's last update
+        """
+        return read_session(self.last_update)
+
+    @property
+    def user(self) -> User:
+        """the user row, loaded on first use since reads only need `user_id`"""
+        if self._user is None:
+            self._user = self.session.query(User).filter_by(name = self.username).first()
+            if not self._user: self._user = User(name=self.username)
+        return self._user
+
+    @user.setter
+    def user(self, user: User) -> None:
+        self._user = user
+
+    def _user_cache_key(self) -> Tuple[str,str]:
+        return (str(self.session.get_bind().url), self.username)
 
+    def _cache_user(self) -> None:
+        """remembers the (persisted) user's id and last update, transient users aren't cached"""
+        self.user_id, self.last_update = self.user.id, self.user.last_update
+        if self.user_id is not None:
+            _user_cache.set(self._user_cache_key(), self.user_id, self.last_update, app_config('USER_CACHE_TTL', 60))
 
     def add_user_to_db(self):
         self.session.add(self.user)
         self.session.commit()
         self.user = self.session.query(User).filter_by(name = self.user.name).first()
+        self._cache_user()
     
     def get_last_update(self):
         return self.session.query(User).filter_by(name=self.user.name).first().last_update
@@ -33,101 +173,307 @@ class DbHelper():
     def get_all_scrobbles_from_db(self) -> List[Scrobble]:
         return self.session.query(Scrobble).all()
 
-    def get_scrobbles_in_period(self, start_period: datetime, end_period: datetime) -> List[Scrobble]:
-        result = self.session.query(Scrobble)\
-            .filter(Scrobble.datetime>=start_period)\
-                .filter(Scrobble.datetime<=end_period)\
-                    .filter(Scrobble.user==self.user).all()
-        return [ scrobble.to_dict() for scrobble in result ]
+    def get_scrobbles_in_period(self, start_period: datetime, end_period: datetime) -> List[Dict[str,Any]]:
+        return [ scrobble for _, scrobble in self._scrobble_rows(self._scrobble_rows_query(start_period, end_period)
+            .order_by(desc(Scrobble.datetime)).all()) ]
+
+    def iter_scrobbles_in_period(self, start_period: datetime, end_period: datetime, after: Optional[int]=None,
+            limit: Optional[int]=None, batch_size: int=1000) -> Iterator[Tuple[int,Dict[str,Any]]]:
+        """yields (timestamp, scrobble dict) pairs through a server side cursor, `batch_size` rows at a time.
+        with `after` (a timestamp) or `limit` the rows are keyset paginated, oldest first,
+        otherwise they are newest first like `get_scrobbles_in_period`
+        """
+        q = self._scrobble_rows_query(start_period, end_period)
+        if after is not None or limit:
+            if after is not None: q = q.filter(Scrobble.timestamp>after)
+            q = q.order_by(Scrobble.timestamp)
+            if limit: q = q.limit(limit)
+        else:
+            q = q.order_by(desc(Scrobble.datetime))
+        return self._scrobble_rows(q.execution_options(stream_results=True).yield_per(batch_size))
+
+    def _scrobble_rows_query(self, start_period: datetime, end_period: datetime):
+        """only the columns a scrobble dict needs, in one joined query (no entity hydration or lazy track loads)"""
+        return self.read_session.query(Scrobble.timestamp, Scrobble.datetime, Track.title, Track.album, Track.artist)\
+            .join(Track, Scrobble.track_id==Track.id)\
+            .filter(Scrobble.user_id==self.user_id)\
+            .filter(Scrobble.datetime>=start_period).filter(Scrobble.datetime<=end_period)
+
+    @staticmethod
+    def _scrobble_rows(rows) -> Iterator[Tuple[int,Dict[str,Any]]]:
+        for timestamp, scrobbled_at, title, album, artist in rows:
+            yield timestamp, {
+                "date": scrobbled_at,
+                "track": {
+                    "title": title,
+                    "album": album,
+                    "artist": artist
+                }
+            }
+
+    def _columns(self) -> Optional['engine.UserColumns']:
+        """the user's in memory columns when `COLUMNAR_ENGINE` is on (and numpy is installed), loaded on
+        first use and caught up with the rows written since whenever the user's last update changes
+        """
+        if not app_config('COLUMNAR_ENGINE', False) or not engine.available() or self.user_id is None: return None
+        store = engine.get_columnar_store(app_config('COLUMNAR_MAX_USERS', 32))
+        key = (str(self.session.get_bind().url), self.user_id)
+        columns = store.get(key)
+        if columns is None:
+            columns = engine.UserColumns()
+            store.set(key, columns)
+        if columns.tag != self.last_update:
+            self._catch_up_columns(columns)
+        return columns
+
+    def _catch_up_columns(self, columns: 'engine.UserColumns') -> None:
+        """appends the user's scrobble rows newer (by id) than the ones `columns` holds"""
+        with columns.lock:
+            if columns.tag == self.last_update: return
+            rows = self.session.query(Scrobble.id, Scrobble.timestamp, Scrobble.datetime, Scrobble.track_id)\
+                .filter(Scrobble.user_id==self.user_id).filter(Scrobble.id>columns.max_id).all()
+            new_ids = list({ track_id for *_, track_id in rows if track_id not in columns.track_index })
+            tracks: Dict[int,Tuple[str,str,str]] = {}
+            for i in range(0, len(new_ids), MAX_SQL_VARIABLES):
+                for track_id, title, album, artist in self.session.query(Track.id, Track.title, Track.album, Track.artist)\
+                        .filter(Track.id.in_(new_ids[i:i+MAX_SQL_VARIABLES])):
+                    tracks[track_id] = (title, album, artist)
+            columns.append(rows, tracks)
+            columns.tag = self.last_update
+
+    def _sync_loaded_columns(self) -> None:
+        """after a write, appends the new rows to the user's columns if this process has them loaded"""
+        if not app_config('COLUMNAR_ENGINE', False) or not engine.available(): return
+        columns = engine.get_columnar_store().get((str(self.session.get_bind().url), self.user_id))
+        if columns is not None: self._catch_up_columns(columns)
 
-    
     def get_top_tracks_for_period(self,start_period: datetime, end_period: datetime, limit: int=5) -> List[Dict[str,Any]]:
-        result = self.session.query(Track, func.count(Scrobble.timestamp).label('qty'))\
-            .join(Scrobble.track)\
-            .filter(Scrobble.datetime>=start_period).filter(Scrobble.datetime<=end_period)\
-            .filter(Scrobble.user==self.user)\
-            .group_by(Track.title).order_by(desc('qty'))\
+        columns = self._columns()
+        if columns is not None: return columns.top_tracks(_naive(start_period), _naive(end_period), limit)
+        plays = self._daily_plays_in_period(start_period, end_period)
+        qty = func.sum(plays.c.plays).label('qty')
+        result = self.read_session.query(Track.title, func.max(Track.album), func.max(Track.artist), qty)\
+            .join(plays, plays.c.track_id==Track.id)\
+            .group_by(Track.title).order_by(desc('qty'), Track.title)\
             .limit(limit).all()
         
         results: List[Dict] = []
         for r in result:
             results.append({
-                "played" : r[1],
-                "track" : r[0].title,
-                "album" : r[0].album,
-                "artist": r[0].artist
+                "played" : int(r[3]),
+                "track" : r[0],
+                "album" : r[1],
+                "artist": r[2]
             })
         
         return results
 
     def get_top_albums_for_period(self,start_period: datetime, end_period: datetime, limit: int=5) -> List[Dict[str,Any]]:
-        result = self.session.query(Track.album, Track.artist, func.count(Scrobble.timestamp).label('qty'))\
-            .join(Scrobble.track)\
-            .filter(Scrobble.datetime>=start_period).filter(Scrobble.datetime<=end_period)\
-                 .filter(Scrobble.user==self.user)\
-            .group_by(Track.album).order_by(desc('qty'))\
+        columns = self._columns()
+        if columns is not None: return columns.top_albums(_naive(start_period), _naive(end_period), limit)
+        plays = self._daily_plays_in_period(start_period, end_period)
+        qty = func.sum(plays.c.plays).label('qty')
+        result = self.read_session.query(Track.album, func.max(Track.artist), qty)\
+            .join(plays, plays.c.track_id==Track.id)\
+            .group_by(Track.album).order_by(desc('qty'), Track.album)\
             .limit(limit).all()
         results: List[Dict] = []
 
         for r in result:
             results.append({
-                "played": r[2],
+                "played": int(r[2]),
                 "album": r[0],
                 "artist": r[1]
             })
         return results
     
     def get_top_artists_for_period(self,start_period: datetime, end_period: datetime, limit: int=5) -> List[Dict[str,Any]]:
-
-        result = self.session.query(Track.artist, func.count(Scrobble.timestamp).label('qty'))\
-            .join(Scrobble.track)\
-            .filter(Scrobble.datetime>=start_period).filter(Scrobble.datetime<=end_period)\
-                 .filter(Scrobble.user==self.user)\
-            .group_by(Track.title).order_by(desc('qty'))\
+        columns = self._columns()
+        if columns is not None: return columns.top_artists(_naive(start_period), _naive(end_period), limit)
+        plays = self._daily_plays_in_period(start_period, end_period)
+        qty = func.sum(plays.c.plays).label('qty')
+        result = self.read_session.query(func.max(Track.artist), qty)\
+            .join(plays, plays.c.track_id==Track.id)\
+            .group_by(Track.title).order_by(desc('qty'), Track.title)\
             .limit(limit).all()
 
         results: List[Dict] = []
         
         for r in result:
             results.append({
-                "played": r[1],
+                "played": int(r[1]),
                 "artist": r[0]
             })
         return results
     
-    def get_track_count_in_period(self,start_period: datetime,end_period: datetime, unit="days") -> Dict[str,int]:
-        unit_map = {
-            'hours': [ Scrobble.date, func.extract('hour',Scrobble.time)],
-            'days': [func.extract('day',Scrobble.date), Scrobble.date],
-            #weekday broken for now
-            'weekdays':[func.extract('year',Scrobble.date),func.extract('month',Scrobble.date),func.extract('dayofweek',Scrobble.date).label('weekday')],
-            'months':[func.extract('year',Scrobble.date),func.extract('month',Scrobble.date)],
-            'years':[func.extract('year',Scrobble.date)]
-        }
-        count = func.count(Scrobble.timestamp).label('count')
-
-        r = self.session.query(*unit_map[unit],count)\
-            .filter(self.user==Scrobble.user)\
-            .filter(Scrobble.datetime>=start_period).filter(Scrobble.datetime<=end_period)\
-                 .filter(Scrobble.user==self.user)\
-            .group_by(*unit_map[unit])\
-            .order_by(desc(count)).all()
-        
-        transform_map: Dict[str,DateTime]= {
-                'hours': lambda d,h: d + relativedelta(hour=h),
-                'days' : lambda d,date: date,
-                'weekdays': lambda y,m,w: datetime(y,m,1) + relativedelta(day=1,weekday=w),
-                'months': lambda y,m: datetime(y,m,1),
-                'years': lambda y: datetime(y,1,1)
+    def _leaderboard(self, days: int, kind: str, limit: int) -> List[Tuple[str,str,str,int]]:
+        """the top `limit` groups of the user's last `days` days (today included) from the materialized
+        leaderboard, which is moved to today (or built) on the primary first"""
+        if self.user_id is None: return []
+        try:
+            if leaderboards.advance(self.session, self.user_id, days): self.session.commit()
+        except IntegrityError:
+            #another request built the same window
+            self.session.rollback()
+        return leaderboards.top(self.session, self.user_id, days, kind, limit)
+
+    def get_top_tracks_for_window(self, days: int, limit: int=5) -> List[Dict[str,Any]]:
+        """`get_top_tracks_for_period` of the last `days` days, from the rolling leaderboard"""
+        return [ {"played": plays, "track": title, "album": album, "artist": artist}
+            for title, album, artist, plays in self._leaderboard(days, leaderboards.TITLE, limit) ]
+
+    def get_top_albums_for_window(self, days: int, limit: int=5) -> List[Dict[str,Any]]:
+        return [ {"played": plays, "album": album, "artist": artist}
+            for album, _, artist, plays in self._leaderboard(days, leaderboards.ALBUM, limit) ]
+
+    def get_top_artists_for_window(self, days: int, limit: int=5) -> List[Dict[str,Any]]:
+        #grouped by title like `get_top_artists_for_period`
+        return [ {"played": plays, "artist": artist}
+            for _, _, artist, plays in self._leaderboard(days, leaderboards.TITLE, limit) ]
+
+    def get_track_count_in_period(self,start_period: datetime,end_period: datetime, unit="days", tz: Optional[str]=None) -> Dict[str,int]:
+        """plays per `unit` (hours, days, weekdays, months or years) of local time in `tz` (an IANA zone,
+        server local by default), as dense chronological buckets (see `buckets.histogram`).
+        The bounds are wall times in `tz`, any tzinfo on them is ignored like on the other reads.
+        Buckets are computed from the timestamps, whole hours come from the hourly rollup when
+        `ROLLUP_HOUR_BUCKETS` is on and the zone's offsets are whole hours.
+
+        Raises:
+            ValueError: [unknown unit or timezone, or too many buckets]
+        """
+        zone = buckets.get_tz(tz)
+        start_ts, end_ts = buckets.period_timestamps(_naive(start_period), _naive(end_period), zone)
+        if start_ts > end_ts: return buckets.histogram([], start_ts, end_ts, unit, [])
+        buckets.check_buckets(start_ts, end_ts, unit)
+        segments = buckets.utc_offsets(zone, start_ts, end_ts)
+        plays = self._plays_by_grain(start_ts, end_ts, use_rollups=buckets.whole_hour_offsets(segments))
+        return buckets.histogram(plays, start_ts, end_ts, unit, segments)
+
+    def get_summary_for_period(self, start_period: datetime, end_period: datetime, limit: int=5,
+            unit: str="days", tz: Optional[str]=None) -> Dict[str,Any]:
+        """top tracks, albums and artists and the frequency of the period from a single read of the
+        per track and day plays (rollups + edge days), aggregated here the way the separate queries group
+        and order them. Frequency is derived from the same rows for day based units in the server's zone,
+        hours or another `tz` take one more read of the timestamps.
+
+        Raises:
+            ValueError: [unknown unit or timezone, or too many buckets]
+        """
+        buckets.check_buckets(*buckets.period_timestamps(_naive(start_period), _naive(end_period), buckets.get_tz(tz)), unit)
+        columns = self._columns()
+        if columns is not None:
+            start, end = _naive(start_period), _naive(end_period)
+            return {
+                "top tracks": columns.top_tracks(start, end, limit),
+                "top albums": columns.top_albums(start, end, limit),
+                "top artists": columns.top_artists(start, end, limit),
+                "frequency": self.get_track_count_in_period(start_period, end_period, unit, tz)
             }
-        results: Dict = {}
-        for result in r:
-            f = transform_map[unit]
-            temp = list(result)
-            c = temp.pop()
-            results[str(f(*temp))]=c
-        
-        return results
+        plays = self._daily_plays_in_period(start_period, end_period)
+        rows = self.read_session.query(plays.c.day, plays.c.plays, Track.title, Track.album, Track.artist)\
+            .join(Track, Track.id==plays.c.track_id).all()
+        titles: Dict[str,List] = {}
+        albums: Dict[str,List] = {}
+        days: Dict[date,int] = {}
+        for day, n, title, album, artist in rows:
+            n = int(n)
+            t = titles.setdefault(title, [0, album, artist])
+            t[0], t[1], t[2] = t[0] + n, max(t[1], album), max(t[2], artist)
+            a = albums.setdefault(album, [0, artist])
+            a[0], a[1] = a[0] + n, max(a[1], artist)
+            day = day if isinstance(day, date) else date.fromisoformat(str(day)[:10])
+            days[day] = days.get(day, 0) + n
+        top_titles = sorted(titles.items(), key=lambda kv: (-kv[1][0], kv[0]))[:int(limit)]
+        top_albums = sorted(albums.items(), key=lambda kv: (-kv[1][0], kv[0]))[:int(limit)]
+        if unit != 'hours' and not tz:
+            zone = buckets.get_tz()
+            start_ts, end_ts = buckets.period_timestamps(_naive(start_period), _naive(end_period), zone)
+            #local noon always exists and falls on its own day
+            noons = [ (int(datetime.combine(day, time(12)).replace(tzinfo=zone).timestamp()), n) for day, n in days.items() ]
+            segments = buckets.utc_offsets(zone, start_ts, end_ts) if start_ts <= end_ts else []
+            frequency = buckets.histogram(noons, start_ts, end_ts, unit, segments)
+        else:
+            frequency = self.get_track_count_in_period(start_period, end_period, unit, tz)
+        return {
+            "top tracks": [ {"played": n, "track": title, "album": album, "artist": artist}
+                for title, (n, album, artist) in top_titles ],
+            "top albums": [ {"played": n, "album": album, "artist": artist} for album, (n, artist) in top_albums ],
+            #grouped by title like `get_top_artists_for_period`
+            "top artists": [ {"played": n, "artist": artist} for _, (n, _, artist) in top_titles ],
+            "frequency": frequency
+        }
+
+    def _plays_by_grain(self, start_ts: int, end_ts: int, use_rollups: bool=True) -> List[Tuple[int,int]]:
+        """(timestamp, plays) pairs at `buckets.GRAIN` for the user's scrobbles in [start_ts, end_ts],
+        from the columnar engine when it is on, otherwise one statement: a grouped scan of the timestamp
+        index, with the whole hours read from the hourly rollup (rollup pairs are per hour)
+        """
+        columns = self._columns()
+        if columns is not None: return columns.plays_by_grain(start_ts, end_ts, buckets.GRAIN)
+        grain = (Scrobble.timestamp - Scrobble.timestamp % buckets.GRAIN).label('grain')
+        raw = self.read_session.query(grain, func.count(Scrobble.id))\
+            .filter(Scrobble.user_id==self.user_id)\
+            .filter(Scrobble.timestamp>=start_ts).filter(Scrobble.timestamp<=end_ts)
+        first_hour = -(-start_ts // 3600)
+        #hours ending at or before `end_ts` are whole
+        last_hour = (end_ts + 1) // 3600 - 1
+        if use_rollups and app_config('ROLLUP_HOUR_BUCKETS', True) and first_hour <= last_hour:
+            raw = raw.filter(or_(Scrobble.timestamp < first_hour*3600, Scrobble.timestamp >= (last_hour+1)*3600))\
+                .group_by(grain)
+            rollup = self.read_session.query((HourlyRollup.hour * 3600).label('grain'), HourlyRollup.plays)\
+                .filter(HourlyRollup.user_id==self.user_id)\
+                .filter(HourlyRollup.hour>=first_hour).filter(HourlyRollup.hour<=last_hour)
+            q = rollup.union_all(raw)
+        else:
+            q = raw.group_by(grain)
+        return [ (int(g), int(c)) for g, c in q ]
+
+    def _daily_plays_in_period(self, start_period: datetime, end_period: datetime):
+        """subquery of (user_id, track_id, day, plays) for the user's scrobbles in the period, see `daily_plays_in_period`"""
+        return daily_plays_in_period(self.read_session, [self.user_id], start_period, end_period)
+
+    def refresh_rollups(self, days: Optional[List[date]]=None, hours: Optional[List[int]]=None) -> None:
+        """recomputes the user's rollup rows for `days` (and `hours`, hours since the epoch) from the
+        raw scrobbles, passing neither rebuilds every rollup row of the user. Does not commit.
+        """
+        rebuild = days is None and hours is None
+        user_id = self.user.id
+        if rebuild: leaderboards.clear(self.session, user_id)
+        daily = self.session.query(DailyRollup).filter(DailyRollup.user_id==user_id)
+        counts = self.session.query(Scrobble.user_id, Scrobble.date, Scrobble.track_id, func.count(Scrobble.id))\
+            .filter(Scrobble.user_id==user_id)
+        if not rebuild:
+            daily = daily.filter(DailyRollup.day.in_(days or []))
+            counts = counts.filter(Scrobble.date.in_(days or []))
+            #the bounds let the (user_id, datetime) index seek to the days instead of reading the whole history
+            if days: counts = counts.filter(Scrobble.datetime >= datetime.combine(min(days), time.min))\
+                .filter(Scrobble.datetime < datetime.combine(max(days) + timedelta(days=1), time.min))
+        if rebuild or days:
+            daily.delete(synchronize_session=False)
+            self.session.execute(DailyRollup.__table__.insert().from_select(
+                ['user_id', 'day', 'track_id', 'plays'],
+                counts.group_by(Scrobble.user_id, Scrobble.date, Scrobble.track_id).statement))
+        if not app_config('ROLLUP_HOUR_BUCKETS', True): return
+        hour = (Scrobble.timestamp - Scrobble.timestamp % 3600) / 3600
+        hourly = self.session.query(HourlyRollup).filter(HourlyRollup.user_id==user_id)
+        counts = self.session.query(Scrobble.user_id, hour, func.count(Scrobble.id))\
+            .filter(Scrobble.user_id==user_id)
+        if not rebuild:
+            hourly = hourly.filter(HourlyRollup.hour.in_(hours or []))
+            counts = counts.filter(or_(*[
+                and_(Scrobble.timestamp >= h*3600, Scrobble.timestamp < (h+1)*3600) for h in hours or [] ]))
+            if hours: counts = counts.filter(Scrobble.timestamp >= min(hours)*3600).filter(Scrobble.timestamp < (max(hours)+1)*3600)
+        if rebuild or hours:
+            hourly.delete(synchronize_session=False)
+            self.session.execute(HourlyRollup.__table__.insert().from_select(
+                ['user_id', 'hour', 'plays'], counts.group_by(Scrobble.user_id, hour).statement))
+
+    def _refresh_rollups_for(self, plays: List[Tuple[date,int]]) -> None:
+        """refreshes the rollup rows touched by the (date, timestamp) of newly written scrobbles"""
+        if not plays: return
+        days = sorted({ day for day, _ in plays })
+        self.refresh_rollups(days=days, hours=sorted({ ts // 3600 for _, ts in plays }))
+        if app_config('LEADERBOARDS', True): leaderboards.on_write(self.session, self.user.id, days)
     
     def add_track_to_db(self,track,title,album,artist) -> Track:
         t = self.session.query(Track).filter_by(title=title,album=album,artist=artist).first()
@@ -146,28 +492,172 @@ class DbHelper():
         else: 
             return r
 
-    def write_scrobbles_to_db(self, scrobbles: List[Scrobble]) -> None:
+    def write_scrobbles_to_db(self, scrobbles: List[AnyScrobble]) -> int:
+        #the row by row path goes through the session, parsed records become ORM objects only here
+        scrobbles = [ s.to_orm() if isinstance(s, ParsedScrobble) else s for s in scrobbles ]
         i=0
+        interner = self.track_interner()
         for scrobble in scrobbles:
             track=scrobble.track
-            t = self._add_or_ignore_to_db(Track,track,title=track.title,artist=track.artist,album=track.album)
+            key = self._track_key(track)
+            track_id = interner.peek(key)
+            if track_id is not None:
+                t = self.session.query(Track).get(track_id)
+                interner.record(1, 0)
+            else:
+                t = self._add_or_ignore_to_db(Track,track,title=track.title,artist=track.artist,album=track.album)
             # t = self.add_track_to_db(track,title=track.title,artist=track.artist,album=track.album)
             scrobble.track=None
-            self._add_or_ignore_to_db(Scrobble,scrobble,date=scrobble.date,time=scrobble.time)
+            s = self._add_or_ignore_to_db(Scrobble,scrobble,date=scrobble.date,time=scrobble.time)
             scrobble.track = t
             scrobble.user = self.user
             self.session.commit()
-            i+=1
+            if track_id is None:
+                interner.add({key: t.id})
+                interner.record(0, 1)
+            if s is scrobble: i+=1
+        self._refresh_rollups_for([ (s.date, s.timestamp) for s in scrobbles ])
         self.user.last_update = datetime.now()
         self.session.commit()
+        self._cache_user()
+        self._sync_loaded_columns()
+        get_results_cache().invalidate_user(self.user.name)
+        return i
+
+    def bulk_write_scrobbles_to_db(self, scrobbles: List[AnyScrobble]) -> int:
+        """writes a page of scrobbles with set based statements and a single commit,
+        tracks are deduped in memory and resolved from the process wide track interner,
+        only the keys it doesn't know are looked up (in one batch) or inserted
+        
+        Args:
+            scrobbles (List[AnyScrobble]): parsed records (or transient scrobbles), usually one lastfm page
+        
+        Returns:
+            int: number of new scrobbles inserted
+        """
+        if not self.supports_bulk_insert():
+            return self.write_scrobbles_to_db(scrobbles)
+        interner = self.track_interner()
+        records = as_records(scrobbles)
+        #track ids set at parse time came from the interner already
+        unresolved = [ s for s in records if s.track_id is None ]
+        keys = list(OrderedDict.fromkeys(s.track_key for s in unresolved))
+        track_ids, missing = interner.lookup(keys)
+        resolved: Dict[Tuple[str,str,str],int] = {}
+        if missing:
+            resolved = self._get_track_ids(missing)
+            new_tracks = [ dict(zip(('title','album','artist'),key)) for key in missing if key not in resolved ]
+            if new_tracks:
+                self._insert_or_ignore(Track.__table__, new_tracks)
+                resolved.update(self._get_track_ids([ key for key in missing if key not in resolved ]))
+            track_ids.update(resolved)
+        misses = sum(1 for s in unresolved if s.track_key in resolved)
+        user_id = self.user.id
+        rows: List[Dict[str,Any]] = []
+        for s in records:
+            moment = datetime.fromtimestamp(s.timestamp)
+            rows.append({
+                "timestamp": s.timestamp,
+                "date": moment.date(),
+                "time": moment.time(),
+                "datetime": moment,
+                "track_id": s.track_id if s.track_id is not None else track_ids[s.track_key],
+                "user_id": user_id
+            })
+        inserted = self._insert_or_ignore(Scrobble.__table__, rows) if rows else 0
+        if inserted: self._refresh_rollups_for([ (row["date"], row["timestamp"]) for row in rows ])
+        self.user.last_update = datetime.now()
+        self.session.commit()
+        interner.add(resolved)
+        interner.record(len(records) - misses, misses)
+        self._cache_user()
+        self._sync_loaded_columns()
+        get_results_cache().invalidate_user(self.user.name)
+        return inserted
+
+    def track_interner(self) -> TrackInterner:
+        """the (title, album, artist) -> track id cache shared by everything writing to this database"""
+        return get_track_interner(str(self.session.get_bind().url), app_config('TRACK_INTERN_SIZE', 50000))
+
+    def supports_bulk_insert(self) -> bool:
+        return self.session.get_bind().dialect.name in ('mysql', 'sqlite')
+
+    @staticmethod
+    def _track_key(track: Track) -> Tuple[str,str,str]:
+        return (track.title, track.album, track.artist)
+
+    def _get_track_ids(self, keys: List[Tuple[str,str,str]]) -> Dict[Tuple[str,str,str],int]:
+        """maps (title, album, artist) keys to track ids with batched IN lookups on title"""
+        wanted = set(keys)
+        titles = list({ key[0] for key in keys })
+        track_ids: Dict[Tuple[str,str,str],int] = {}
+        for i in range(0, len(titles), MAX_SQL_VARIABLES):
+            result = self.session.query(Track.id, Track.title, Track.album, Track.artist)\
+                .filter(Track.title.in_(titles[i:i+MAX_SQL_VARIABLES])).all()
+            for r in result:
+                key = (r[1], r[2], r[3])
+                if key in wanted: track_ids[key] = r[0]
+        #collations can match rows the exact comparison above misses (e.g mysql *_ci)
+        for key in wanted.difference(track_ids):
+            track_id = self.session.query(Track.id)\
+                .filter_by(title=key[0],album=key[1],artist=key[2]).scalar()
+            if track_id is not None: track_ids[key] = track_id
+        return track_ids
+
+    def _insert_or_ignore(self, table, rows: List[Dict[str,Any]]) -> int:
+        """multi row INSERT that skips rows violating a unique constraint, see `insert_ignore`
+
+        Returns:
+            int: number of new rows, skipped duplicates aren't counted
+        """
+        dialect = self.session.get_bind().dialect.name
+        chunk_size = max(1, MAX_SQL_VARIABLES // len(rows[0]))
+        inserted = 0
+        for i in range(0, len(rows), chunk_size):
+            inserted += self.session.execute(insert_ignore(table, rows[i:i+chunk_size], dialect)).rowcount
+        return inserted
     
     def is_new_user(self,username: str) -> bool:
         r = self.session.query(User).filter_by(name = username).first()
         return r is None
     
+    def get_sync_cursor(self) -> Optional[int]:
+        """timestamp of the user's newest stored scrobble, where the next sync starts"""
+        return self.session.query(func.max(Scrobble.timestamp)).filter(Scrobble.user_id==self.user.id).scalar()
+
+    def get_open_sync(self) -> Optional[SyncCheckpoint]:
+        return self.session.query(SyncCheckpoint)\
+            .filter(SyncCheckpoint.user_id==self.user.id).filter(SyncCheckpoint.finished==False).first()
+
+    def start_sync(self, from_timestamp: Optional[int], to_timestamp: int) -> SyncCheckpoint:
+        checkpoint = self.session.query(SyncCheckpoint).filter(SyncCheckpoint.user_id==self.user.id).first()
+        if not checkpoint:
+            checkpoint = SyncCheckpoint(user_id=self.user.id)
+            self.session.add(checkpoint)
+        checkpoint.from_timestamp = from_timestamp
+        checkpoint.to_timestamp = to_timestamp
+        checkpoint.total_pages = None
+        checkpoint.next_page = 1
+        checkpoint.finished = False
+        checkpoint.started = checkpoint.updated = datetime.now()
+        self.session.commit()
+        return checkpoint
+
+    def save_sync_progress(self, checkpoint: SyncCheckpoint, next_page: int, total_pages: int) -> None:
+        checkpoint.next_page = next_page
+        checkpoint.total_pages = total_pages
+        checkpoint.updated = datetime.now()
+        self.session.commit()
+
+    def finish_sync(self, checkpoint: SyncCheckpoint) -> None:
+        checkpoint.finished = True
+        checkpoint.updated = datetime.now()
+        self.session.commit()
+
     def set_user_update_to_min(self):
         self.user.last_update = datetime(1999,1,1)
         self.session.commit()
+        self._cache_user()
 
 if __name__ == "__main__":
     helper = DbHelper(username='testuser')
@@ -0,0 +1,178 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_EPOCH_ORDINAL = datetime(1970,1,1).toordinal()
+
+
+def available() -> bool:
+    return np is not None
+
+def _wall_seconds(d: datetime) -> int:
+    """a naive (server local) datetime as seconds, so the `Scrobble.datetime` comparisons become integer ones"""
+    return (d.toordinal() - _EPOCH_ORDINAL) * 86400 + d.hour * 3600 + d.minute * 60 + d.second
+
+
+class UserColumns:
+    """one user's scrobbles as columns sorted by local time: `wall` (int64 naive local seconds, what the sql
+    path filters on), `timestamps` (int64) and `tracks` (int32 index into the track dimension). The dimension
+    keeps the strings and the title/album groups as indexes into their sorted distinct values, so group
+    order is string order (binary collation, like sqlite). `max_id` is the newest scrobble row loaded,
+    rows written later are appended with `append`. `lock` is held by appends and reads.
+    """
+
+    def __init__(self, tag: Any=None) -> None:
+        self.tag = tag
+        self.lock = threading.RLock()
+        self.max_id = 0
+        self.wall = np.empty(0, dtype=np.int64)
+        self.timestamps = np.empty(0, dtype=np.int64)
+        self.tracks = np.empty(0, dtype=np.int32)
+        self.track_ids: List[int] = []
+        self.track_index: Dict[int,int] = {}
+        self.titles: List[str] = []
+        self.albums: List[str] = []
+        self.artists: List[str] = []
+
+    def append(self, rows: List[Tuple[int,int,datetime,int]], tracks: Dict[int,Tuple[str,str,str]]) -> None:
+        """adds scrobble rows (id, timestamp, datetime, track id), `tracks` has the strings of unseen track ids"""
+        if not rows: return
+        with self.lock:
+            self._append(rows, tracks)
+
+    def _append(self, rows: List[Tuple[int,int,datetime,int]], tracks: Dict[int,Tuple[str,str,str]]) -> None:
+        new_tracks = [ track_id for track_id in tracks if track_id not in self.track_index ]
+        for track_id in new_tracks:
+            title, album, artist = tracks[track_id]
+            self.track_index[track_id] = len(self.track_ids)
+            self.track_ids.append(track_id)
+            self.titles.append(title)
+            self.albums.append(album)
+            self.artists.append(artist)
+        if new_tracks: self._build_groups()
+        wall = np.fromiter((_wall_seconds(d) for _, _, d, _ in rows), dtype=np.int64, count=len(rows))
+        timestamps = np.fromiter((t for _, t, _, _ in rows), dtype=np.int64, count=len(rows))
+        track_idx = np.fromiter((self.track_index[t] for _, _, _, t in rows), dtype=np.int32, count=len(rows))
+        self.wall = np.concatenate((self.wall, wall))
+        self.timestamps = np.concatenate((self.timestamps, timestamps))
+        self.tracks = np.concatenate((self.tracks, track_idx))
+        if len(self.wall) > 1 and np.any(self.wall[1:] < self.wall[:-1]):
+            order = np.argsort(self.wall, kind='stable')
+            self.wall, self.timestamps, self.tracks = self.wall[order], self.timestamps[order], self.tracks[order]
+        self.max_id = max(self.max_id, max(r[0] for r in rows))
+
+    def _build_groups(self) -> None:
+        titles = sorted(set(self.titles))
+        albums = sorted(set(self.albums))
+        title_rank = { t: i for i, t in enumerate(titles) }
+        album_rank = { a: i for i, a in enumerate(albums) }
+        self.title_names, self.album_names = titles, albums
+        self.title_of = np.array([ title_rank[t] for t in self.titles ], dtype=np.int32)
+        self.album_of = np.array([ album_rank[a] for a in self.albums ], dtype=np.int32)
+
+    def __len__(self) -> int:
+        return len(self.wall)
+
+    def _slice(self, start: datetime, end: datetime) -> slice:
+        """rows with start <= datetime <= end, bounds are naive local like the stored datetimes"""
+        lo = _wall_seconds(start) + (1 if start.microsecond else 0)
+        hi = _wall_seconds(end)
+        return slice(int(np.searchsorted(self.wall, lo, 'left')), int(np.searchsorted(self.wall, hi, 'right')))
+
+    def _plays(self, start: datetime, end: datetime) -> Any:
+        return np.bincount(self.tracks[self._slice(start, end)], minlength=len(self.track_ids))
+
+    def _top_groups(self, plays: Any, group_of: Any, limit: Optional[int]) -> List[Tuple[int,int,Any]]:
+        """(group, plays, played track indexes) for the top `limit` groups by plays, then group (name) order"""
+        counts = np.bincount(group_of, weights=plays, minlength=int(group_of.max())+1 if len(group_of) else 0).astype(np.int64)
+        groups = np.nonzero(counts)[0]
+        order = np.lexsort((groups, -counts[groups]))
+        top = groups[order[:int(limit)] if limit is not None else order]
+        played = np.nonzero(plays)[0]
+        return [ (int(g), int(counts[g]), played[group_of[played] == g]) for g in top ]
+
+    def _top(self, start: datetime, end: datetime, limit: Optional[int], by_album: bool) -> List[Tuple[str,int,List[int]]]:
+        """(group name, plays, played track indexes) of the top `limit` titles (or albums), sql ordering"""
+        with self.lock:
+            if not len(self): return []
+            group_of, names = (self.album_of, self.album_names) if by_album else (self.title_of, self.title_names)
+            return [ (names[g], played, tracks.tolist()) for g, played, tracks in self._top_groups(self._plays(start, end), group_of, limit) ]
+
+    def top_tracks(self, start: datetime, end: datetime, limit: Optional[int]=5) -> List[Dict[str,Any]]:
+        return [{
+            "played": played,
+            "track": title,
+            "album": max(self.albums[t] for t in tracks),
+            "artist": max(self.artists[t] for t in tracks)
+        } for title, played, tracks in self._top(start, end, limit, by_album=False) ]
+
+    def top_albums(self, start: datetime, end: datetime, limit: Optional[int]=5) -> List[Dict[str,Any]]:
+        return [{
+            "played": played,
+            "album": album,
+            "artist": max(self.artists[t] for t in tracks)
+        } for album, played, tracks in self._top(start, end, limit, by_album=True) ]
+
+    def top_artists(self, start: datetime, end: datetime, limit: Optional[int]=5) -> List[Dict[str,Any]]:
+        #grouped by title like the sql path
+        return [{
+            "played": played,
+            "artist": max(self.artists[t] for t in tracks)
+        } for _, played, tracks in self._top(start, end, limit, by_album=False) ]
+
+    def artist_plays(self, start: datetime, end: datetime) -> Dict[str,int]:
+        """plays per artist (not per title like `top_artists`) in the range"""
+        with self.lock:
+            if not len(self): return {}
+            plays = self._plays(start, end)
+            artists: Dict[str,int] = {}
+            for t in np.nonzero(plays)[0].tolist():
+                artists[self.artists[t]] = artists.get(self.artists[t], 0) + int(plays[t])
+            return artists
+
+    def plays_by_grain(self, start_ts: int, end_ts: int, grain: int) -> List[Tuple[int,int]]:
+        """(timestamp, plays) pairs per `grain` seconds for the rows in [start_ts, end_ts]"""
+        with self.lock:
+            timestamps = self.timestamps
+        selected = timestamps[(timestamps >= start_ts) & (timestamps <= end_ts)]
+        grains, counts = np.unique(selected - selected % grain, return_counts=True)
+        return list(zip(grains.tolist(), counts.tolist()))
+
+
+class ColumnarStore:
+    """process wide (engine url, user id) -> `UserColumns`, keeping the `max_users` most recently used"""
+
+    def __init__(self, max_users: int=32) -> None:
+        self.max_users = max_users
+        self._users: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str,int]) -> Optional[UserColumns]:
+        with self._lock:
+            columns = self._users.get(key)
+            if columns is not None: self._users.move_to_end(key)
+            return columns
+
+    def set(self, key: Tuple[str,int], columns: UserColumns) -> None:
+        with self._lock:
+            self._users[key] = columns
+            self._users.move_to_end(key)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._users.clear()
+
+
+_store = ColumnarStore()
+
+def get_columnar_store(max_users: int=32) -> ColumnarStore:
+    _store.max_users = max_users
+    return _store
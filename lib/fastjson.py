@@ -0,0 +1,59 @@
+import json
+import uuid
+from datetime import date
+from typing import Any, Union
+from flask import Response, current_app, json as flask_json, jsonify as flask_jsonify
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def backend() -> str:
+    """the decoder `loads` uses: orjson, ujson or the stdlib json"""
+    return 'orjson' if orjson is not None else 'ujson' if ujson is not None else 'json'
+
+def loads(data: Union[bytes,str]) -> Any:
+    """decodes a json document with the fastest available decoder
+
+    Raises:
+        ValueError: [the document is not valid json]
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    if ujson is not None:
+        return ujson.loads(data)
+    return json.loads(data)
+
+def _default(o: Any) -> Any:
+    """what flask's JSONEncoder does for types orjson doesn't pass through, dates as http dates"""
+    if isinstance(o, date):
+        return http_date(o.timetuple())
+    if isinstance(o, uuid.UUID):
+        return str(o)
+    if hasattr(o, '__html__'):
+        return str(o.__html__())
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+def dumps(obj: Any, indent: bool=False) -> str:
+    """`flask.json.dumps` of `obj`, encoded by orjson when it is installed and `FAST_JSON` is on"""
+    if orjson is None or not current_app.config.get('FAST_JSON', True):
+        return flask_json.dumps(obj, indent=2 if indent else None, separators=(',', ': ') if indent else None)
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    if current_app.config.get('JSON_SORT_KEYS', True): option |= orjson.OPT_SORT_KEYS
+    if indent: option |= orjson.OPT_INDENT_2
+    return orjson.dumps(obj, default=_default, option=option).decode()
+
+def jsonify(obj: Any) -> Response:
+    """`flask.jsonify` of a single object (pretty printed in debug, like flask), see `dumps`"""
+    config = current_app.config
+    if orjson is None or not config.get('FAST_JSON', True):
+        return flask_jsonify(obj)
+    indent = config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug
+    return current_app.response_class(dumps(obj, indent) + '\n', mimetype=config['JSONIFY_MIMETYPE'])
@@ -0,0 +1,40 @@
+import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app as app
+from typing import Dict, Tuple
+
+
+def create_session(pool_size: int=10) -> requests.Session:
+    """a keep-alive `requests.Session` whose connection pool can serve `pool_size` threads at once"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+    return session
+
+
+def get_http_session() -> requests.Session:
+    """the app owned session used for LastFM requests, so imports reuse connections instead of
+    paying a TCP (and TLS) handshake per page"""
+    if 'lastfm_http_session' not in app.extensions:
+        app.extensions['lastfm_http_session'] = create_session(app.config.get('LASTFM_HTTP_POOL_SIZE', 10))
+    return app.extensions['lastfm_http_session']
+
+
+def get_http_timeout() -> Tuple[float,float]:
+    return (app.config.get('LASTFM_CONNECT_TIMEOUT', 3.05), app.config.get('LASTFM_READ_TIMEOUT', 30))
+
+
+def connection_stats(session: requests.Session) -> Dict[str,int]:
+    """requests sent vs connections opened by the session's urllib3 pools, the difference was served
+    by a reused keep-alive connection"""
+    stats = {"requests": 0, "connections": 0}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats["requests"] += pool.num_requests
+            stats["connections"] += pool.num_connections
+    stats["reused"] = max(0, stats["requests"] - stats["connections"])
+    return stats
@@ -0,0 +1,87 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+TrackKey = Tuple[str,str,str]
+
+
+class TrackInterner:
+    """bounded LRU (title, album, artist) -> track id map with hit/miss counters, thread safe.
+    Ids are only added once the rows holding them are committed, tracks are never deleted so entries
+    don't go stale.
+    """
+
+    def __init__(self, size: int=50000) -> None:
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._ids: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def peek(self, key: TrackKey) -> Optional[int]:
+        """the id of `key` if known, without touching the counters"""
+        with self._lock:
+            return self._ids.get(key)
+
+    def lookup(self, keys: Iterable[TrackKey]) -> Tuple[Dict[TrackKey,int], List[TrackKey]]:
+        """(ids of the known keys, keys to resolve from the db), the caller `record`s the outcome"""
+        found: Dict[TrackKey,int] = {}
+        missing: List[TrackKey] = []
+        with self._lock:
+            for key in keys:
+                track_id = self._ids.get(key)
+                if track_id is None:
+                    missing.append(key)
+                else:
+                    self._ids.move_to_end(key)
+                    found[key] = track_id
+        return found, missing
+
+    def record(self, hits: int, misses: int) -> None:
+        """counts rows whose track was resolved from the interner (hits) or the db (misses)"""
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def add(self, ids: Dict[TrackKey,int]) -> None:
+        with self._lock:
+            for key, track_id in ids.items():
+                self._ids[key] = track_id
+                self._ids.move_to_end(key)
+            while len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._ids.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> Dict[str,int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._ids)}
+
+
+_interners: Dict[str,TrackInterner] = {}
+_interners_lock = threading.Lock()
+
+def get_track_interner(engine_url: str, size: int=50000) -> TrackInterner:
+    """the process wide interner of the database at `engine_url`"""
+    with _interners_lock:
+        if engine_url not in _interners:
+            _interners[engine_url] = TrackInterner(size)
+        return _interners[engine_url]
+
+def track_interner_stats() -> Dict[str,int]:
+    """`stats` summed over the interners of the process"""
+    totals = {"hits": 0, "misses": 0, "size": 0}
+    with _interners_lock:
+        interners = list(_interners.values())
+    for interner in interners:
+        for key, value in interner.stats().items():
+            totals[key] += value
+    return totals
+
+def clear_track_interners() -> None:
+    with _interners_lock:
+        for interner in _interners.values():
+            interner.clear()
@@ -0,0 +1,246 @@
+import sqlite3
+import threading
+import time
+import uuid
+from flask import current_app as app
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+JOB_FIELDS = ('id', 'username', 'status', 'pages_done', 'total_pages', 'rows_written',
+    'error', 'created', 'started', 'updated', 'finished')
+
+
+def job_status(job: Dict[str,Any]) -> Dict[str,Any]:
+    """the job as reported by the status endpoint, with an eta extrapolated from the page rate"""
+    status = dict(job)
+    status['eta'] = None
+    if job['status'] == RUNNING and job['pages_done'] and job['total_pages']:
+        elapsed = job['updated'] - job['started']
+        remaining = max(0, job['total_pages'] - job['pages_done'])
+        status['eta'] = round(elapsed / job['pages_done'] * remaining, 1)
+    elif job['status'] in (DONE, FAILED):
+        status['eta'] = 0
+    return status
+
+
+class MemoryJobStore:
+    """jobs live in this process only, status is visible to the process that enqueued them. Running jobs
+    belong to this process's live workers, so they are never re-claimed however quiet they are.
+    Finished jobs are dropped `retention` seconds after they finish.
+    """
+
+    def __init__(self, retention: float=86400) -> None:
+        self.retention = retention
+        self._jobs: Dict[str,Dict[str,Any]] = {}
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float) -> None:
+        expired = [ job_id for job_id, job in self._jobs.items()
+            if job['status'] in (DONE, FAILED) and (job['finished'] or job['updated']) < now - self.retention ]
+        for job_id in expired: del self._jobs[job_id]
+
+    def enqueue(self, username: str) -> Tuple[Dict[str,Any], bool]:
+        with self._lock:
+            now = time.time()
+            self._prune(now)
+            for job in self._jobs.values():
+                if job['username'] == username and job['status'] in (QUEUED, RUNNING):
+                    return dict(job), False
+            job = new_job(username, now)
+            self._jobs[job['id']] = job
+            return dict(job), True
+
+    def claim(self) -> Optional[Dict[str,Any]]:
+        with self._lock:
+            now = time.time()
+            self._prune(now)
+            claimable = [ job for job in self._jobs.values() if job['status'] == QUEUED ]
+            if not claimable: return None
+            job = min(claimable, key=lambda j: j['created'])
+            job.update(status=RUNNING, started=now, updated=now)
+            return dict(job)
+
+    def update(self, job_id: str, **fields) -> None:
+        with self._lock:
+            self._jobs[job_id].update(fields, updated=time.time())
+
+    def get(self, job_id: str) -> Optional[Dict[str,Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+
+class SQLiteJobStore:
+    """jobs in a local sqlite file, shared by every worker process on the host. Running jobs whose
+    heartbeat (`updated`) is older than `stale_after` seconds belong to a dead worker and are re-claimed,
+    the sync checkpoint then resumes the import where it stopped. Finished jobs are deleted `retention`
+    seconds after they finish.
+    """
+
+    def __init__(self, path: str, stale_after: float=300, retention: float=86400) -> None:
+        self.path = path
+        self.stale_after = stale_after
+        self.retention = retention
+        with self._connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, username TEXT, status TEXT, pages_done INTEGER, total_pages INTEGER,
+                rows_written INTEGER, error TEXT, created REAL, started REAL, updated REAL, finished REAL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_jobs_status_created ON jobs (status, created)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_jobs_username ON jobs (username, status)')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _transaction(self, work: Callable[[sqlite3.Connection], Any]) -> Any:
+        conn = self._connect()
+        try:
+            #takes the write lock up front so the check-then-write below is atomic across processes
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = work(conn)
+                conn.execute('COMMIT')
+                return result
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+
+    def _prune(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute('DELETE FROM jobs WHERE status IN (?, ?) AND COALESCE(finished, updated) < ?', (DONE, FAILED, now - self.retention))
+
+    def enqueue(self, username: str) -> Tuple[Dict[str,Any], bool]:
+        def work(conn):
+            now = time.time()
+            self._prune(conn, now)
+            row = conn.execute('''SELECT * FROM jobs WHERE username = ? AND
+                (status = ? OR (status = ? AND updated >= ?)) ORDER BY created LIMIT 1''',
+                (username, QUEUED, RUNNING, now - self.stale_after)).fetchone()
+            if row: return dict(row), False
+            job = new_job(username, now)
+            conn.execute(f'INSERT INTO jobs ({", ".join(JOB_FIELDS)}) VALUES ({", ".join("?" * len(JOB_FIELDS))})',
+                [ job[f] for f in JOB_FIELDS ])
+            return job, True
+        return self._transaction(work)
+
+    def claim(self) -> Optional[Dict[str,Any]]:
+        def work(conn):
+            now = time.time()
+            self._prune(conn, now)
+            row = conn.execute('''SELECT * FROM jobs WHERE status = ? OR (status = ? AND updated < ?)
+                ORDER BY created LIMIT 1''', (QUEUED, RUNNING, now - self.stale_after)).fetchone()
+            if not row: return None
+            conn.execute('UPDATE jobs SET status = ?, started = ?, updated = ? WHERE id = ?', (RUNNING, now, now, row['id']))
+            return dict(row, status=RUNNING, started=now, updated=now)
+        return self._transaction(work)
+
+    def update(self, job_id: str, **fields) -> None:
+        fields['updated'] = time.time()
+        columns = [ f for f in fields if f in JOB_FIELDS ]
+        with self._connect() as conn:
+            conn.execute(f'UPDATE jobs SET {", ".join(f"{c} = ?" for c in columns)} WHERE id = ?',
+                [ fields[c] for c in columns ] + [job_id])
+
+    def get(self, job_id: str) -> Optional[Dict[str,Any]]:
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            return dict(row) if row else None
+
+
+def new_job(username: str, now: float) -> Dict[str,Any]:
+    return {
+        'id': uuid.uuid4().hex, 'username': username, 'status': QUEUED,
+        'pages_done': 0, 'total_pages': None, 'rows_written': 0, 'error': None,
+        'created': now, 'started': None, 'updated': now, 'finished': None
+    }
+
+
+class JobQueue:
+    """runs user updates on background worker threads, one job per user at a time"""
+
+    def __init__(self, flask_app, store, workers: int=2, poll_interval: float=1.0, max_backoff: float=60.0) -> None:
+        self.app = flask_app
+        self.store = store
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self._wakeup = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def submit(self, username: str) -> Tuple[Dict[str,Any], bool]:
+        """enqueues an update for `username`, or returns the user's queued/running job
+
+        Returns:
+            Tuple[dict, bool]: the job and whether it was newly created
+        """
+        job, created = self.store.enqueue(username)
+        self._start_workers()
+        self._wakeup.set()
+        return job, created
+
+    def get(self, job_id: str) -> Optional[Dict[str,Any]]:
+        return self.store.get(job_id)
+
+    def _start_workers(self) -> None:
+        with self._lock:
+            if self._threads: return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'update-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self) -> None:
+        """claims and runs jobs forever, store errors (e.g. a locked sqlite file) are logged and retried
+        with a doubling wait so they never end the thread
+        """
+        backoff = self.poll_interval
+        while True:
+            try:
+                job = self.store.claim()
+                if job is not None: self.run_job(job)
+                backoff = self.poll_interval
+            except Exception:
+                self.app.logger.exception(f"update worker {threading.current_thread().name} failed, retrying in {backoff}s")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def run_job(self, job: Dict[str,Any]) -> None:
+        from lib.lastfm import LastFMHelper
+        from lib.models import db
+        with self.app.app_context():
+            def progress(pages_done, total_pages, rows_written):
+                self.store.update(job['id'], pages_done=pages_done, total_pages=total_pages, rows_written=rows_written)
+            try:
+                summary = LastFMHelper(username=job['username']).get_or_update_user_scrobbles(on_progress=progress)
+                self.store.update(job['id'], status=DONE, finished=time.time(),
+                    pages_done=summary['pages'], total_pages=summary['pages'], rows_written=summary['new scrobbles'])
+            except Exception as e:
+                self.app.logger.exception(f"update job {job['id']} for {job['username']} failed")
+                self.store.update(job['id'], status=FAILED, finished=time.time(), error=str(e))
+            finally:
+                db.session.remove()
+
+
+def create_store(config) -> Any:
+    backend = config.get('JOBS_BACKEND', 'memory')
+    retention = config.get('JOBS_RETENTION_SECONDS', 86400)
+    if backend == 'memory':
+        return MemoryJobStore(retention)
+    elif backend == 'sqlite':
+        return SQLiteJobStore(config.get('JOBS_SQLITE_PATH', 'jobs.db'), config.get('JOBS_STALE_SECONDS', 300), retention)
+    raise ValueError(f"unknown JOBS_BACKEND {backend}")
+
+
+def get_job_queue() -> JobQueue:
+    if 'job_queue' not in app.extensions:
+        app.extensions['job_queue'] = JobQueue(app._get_current_object(), create_store(app.config),
+            app.config.get('JOBS_WORKERS', 2), app.config.get('JOBS_POLL_INTERVAL', 1.0))
+    return app.extensions['job_queue']
@@ -4,13 +4,28 @@ from dateutil.relativedelta import relativedelta
 from dateutil.tz import tzutc
 from typing import Optional, List, Callable
 from lib.errors import LastFMUserNotFound, ScrobbleFetchFailed, FireStoreError
-from lib.models import Track, Scrobble
+from lib.models import SyncCheckpoint
 from flask import current_app as app
 from flask import g
 import sys
 import os
 import pickle
+import threading
+import time
+from lib import fastjson, metrics
 from lib.database import DbHelper
+from lib.httpclient import get_http_session, get_http_timeout, connection_stats
+from lib.pipeline import IngestionPipeline, PipelineStats
+from lib.ratelimit import TokenBucket
+from lib.records import ParsedScrobble, parse_recent_tracks
+
+def get_rate_limiter() -> TokenBucket:
+    """the app wide LastFM request budget, shared by every import running in this process"""
+    if 'lastfm_rate_limiter' not in app.extensions:
+        app.extensions['lastfm_rate_limiter'] = TokenBucket(
+            app.config.get('LASTFM_REQUESTS_PER_SECOND', 5), app.config.get('LASTFM_REQUEST_BURST', 5))
+    return app.extensions['lastfm_rate_limiter']
+
 
 class LastFMHelper:
     lastfm_api = "http://ws.audioscrobbler.com/2.0/"
@@ -21,78 +36,188 @@ class LastFMHelper:
     def __init__(self, api_key: Optional[str]=key, username: str='sonofatailor') -> None:
         self.API_KEY=api_key
         self.username=username
-        self.SCROBBLES_CACHE: dict={}
         self.__scrobbles_parsed = False
         self.SCROBBLE_FILE=f'{username}.scrobbles'
         if not self.API_KEY and not app.config['TESTING']: raise ValueError("No API KEY passed to LastFM or set in env")
         self.db = DbHelper(self.username)
+        self.track_interner = self.db.track_interner()
+        self.page_retries = app.config.get('LASTFM_PAGE_RETRIES', 3)
+        self.retry_backoff = app.config.get('LASTFM_RETRY_BACKOFF', 1.0)
+        self.http = get_http_session()
+        self.http_timeout = get_http_timeout()
+        #every lastfm request of this helper (retries included), capped by `max_requests` of an update
+        self.requests_sent = 0
+        self.max_requests: Optional[int] = None
+        self._requests_lock = threading.Lock()
         # self.get_or_update_user_scrobbles()
 
 
-    def get_or_update_user_scrobbles(self) -> List[dict]:
-        """get scrobbles dict
+    def get_or_update_user_scrobbles(self, on_progress: Optional[Callable[[int,int,int], None]]=None,
+            max_pages: Optional[int]=None, max_requests: Optional[int]=None) -> dict:
+        """downloads new scrobbles into the db, pages are parsed, written and discarded.
+        A sync covers (newest stored scrobble - `SYNC_OVERLAP_SECONDS`, now], the overlap is deduped by
+        the unique constraint. An interrupted sync is resumed from its last committed page.
+        
+        Args:
+            on_progress (Callable): called after each committed page with (pages done, total pages, rows written)
+            max_pages (int): fetch at most this many pages, the sync stays open and the next update resumes it
+            max_requests (int): send at most this many requests (`requests_sent`, retries included)
         
         Returns:
-            List[dict]: dict of scrobbles from lastfm
+            dict: summary of the update (counts, time range of the scrobbles and duration)
         """
 
+        self.max_requests = max_requests
         if self._is_new_lf_user():
             print("Initializing new User!")
-            self.SCROBBLES_CACHE['scrobbles'] = []
             self.db.add_user_to_db()
-            s = self._get_scrobbles_from_lf()
-        else:
-            last_update = self.db.get_last_update()
-            if last_update <= datetime.now():
-                payload = {'from': int(last_update.timestamp())}
-                payload['to'] = datetime.now()
-                s =self._get_scrobbles_from_lf(payload=payload)
-        return  s
-    
-    def get_scrobbles_in_period(self,start_period: datetime, end_period: datetime) -> List[Scrobble]:
-        return [ scrobble for scrobble in self.SCROBBLES_CACHE['scrobbles'] if start_period <= scrobble.date <= end_period]
+        checkpoint = self.db.get_open_sync()
+        if not checkpoint:
+            return self._sync(self._start_sync(), on_progress, max_pages)
+        app.logger.info(f"resuming sync for {self.username} at page {checkpoint.next_page}/{checkpoint.total_pages}")
+        resumed = self._sync(checkpoint, on_progress, max_pages)
+        remaining = None if max_pages is None else max_pages - self.pipeline_stats.pages_fetched
+        if not resumed["complete"]: return resumed
+        if remaining is not None and remaining <= 0:
+            #the resumed sync stopped at its old `to`, the scrobbles since then are still missing
+            return dict(resumed, complete=False)
+        return self.__merge_summaries(resumed, self._sync(self._start_sync(), on_progress, remaining))
+
+    def _start_sync(self) -> SyncCheckpoint:
+        """a checkpoint for (newest stored scrobble - `SYNC_OVERLAP_SECONDS`, now]"""
+        cursor = self.db.get_sync_cursor()
+        from_timestamp = max(0, cursor - app.config.get('SYNC_OVERLAP_SECONDS', 600)) if cursor is not None else None
+        return self.db.start_sync(from_timestamp, int(datetime.now().timestamp()))
 
-    def _get_scrobbles_from_lf(self,payload: dict={}) -> dict:
-        page, total_pages = 0,1
-        if 'scrobbles' not in self.SCROBBLES_CACHE: self.SCROBBLES_CACHE['scrobbles'] = []
+    def _sync(self, checkpoint: SyncCheckpoint, on_progress: Optional[Callable[[int,int,int], None]]=None,
+            max_pages: Optional[int]=None) -> dict:
+        payload = {'to': checkpoint.to_timestamp}
+        if checkpoint.from_timestamp is not None: payload['from'] = checkpoint.from_timestamp
+        return self._get_scrobbles_from_lf(payload=payload, checkpoint=checkpoint, on_progress=on_progress, max_pages=max_pages)
+
+    def _get_scrobbles_from_lf(self,payload: dict={}, checkpoint: Optional[SyncCheckpoint]=None,
+            on_progress: Optional[Callable[[int,int,int], None]]=None, max_pages: Optional[int]=None) -> dict:
+        """downloads and stores the scrobbles in `payload`'s range through an `IngestionPipeline`,
+        page 1 is ingested first to learn `totalPages`, the rest are fetched and parsed by
+        `LASTFM_FETCH_WORKERS` threads while this thread writes them to the db.
+        Only the running time range is kept, so memory doesn't grow with the history size.
+        Progress is saved to `checkpoint` after each committed page, with `max_pages` the checkpoint
+        is only finished once the last page is in.
+        
+        Returns:
+            dict: summary of the import
+        """
+        self._time_range: List[Optional[int]] = [None, None]
         print(f"downloading scrobbles for {self.username}... started at {datetime.now()}")
-        while total_pages > page:
-            page+=1
-            try:
-                scrobbles_in_page = self.__get_scrobbles_page(page=page,payload=payload)
-            except ScrobbleFetchFailed:
-                self.db.set_user_update_to_min()
-                raise ScrobbleFetchFailed
-            parsed_scrobbles = self.__parse_scrobbles(scrobbles_in_page["recenttracks"]["track"])
-            self.SCROBBLES_CACHE['scrobbles']+= parsed_scrobbles
-            self._write_scrobbles_to_db(parsed_scrobbles)
-            total_pages = int(scrobbles_in_page["recenttracks"]["@attr"]["totalPages"])
-            progress=int(page/total_pages*100) if total_pages else 0
+        limiter = get_rate_limiter()
+        pipeline = IngestionPipeline(
+            fetch=lambda page: self._fetch_page_with_retries(page, payload, limiter),
+            parse=lambda page: self.__parse_scrobbles(page["recenttracks"]["track"]),
+            write=self.__store_scrobbles,
+            workers=app.config.get('LASTFM_FETCH_WORKERS', 4),
+            queue_size=app.config.get('INGESTION_QUEUE_SIZE', 8))
+        done: set = set()
+        next_page = checkpoint.next_page if checkpoint and checkpoint.total_pages is not None else 1
+        total_pages = checkpoint.total_pages if next_page > 1 else None
+        def page_done(page, written):
+            #pages are committed out of order, the checkpoint keeps the lowest page not yet committed
+            nonlocal next_page
+            done.add(page)
+            while next_page in done:
+                done.discard(next_page)
+                next_page += 1
+            if checkpoint: self.db.save_sync_progress(checkpoint, next_page, total_pages)
+            if on_progress: on_progress(next_page - 1 + len(done), total_pages, pipeline.stats.rows_written)
+            progress=int(pipeline.stats.pages_written/max(total_pages, 1)*100)
             print(f"\r {'=' * int(progress/2)}>  {progress}%",end="")
+        try:
+            if total_pages is None:
+                first_page = pipeline.fetch(1)
+                total_pages = int(first_page["recenttracks"]["@attr"]["totalPages"])
+                page_done(1, pipeline.write(pipeline.parse(first_page)))
+                del first_page
+            last_page = total_pages
+            if max_pages is not None:
+                last_page = min(total_pages, next_page + max_pages - pipeline.stats.pages_fetched - 1)
+            pipeline.run(range(next_page, last_page+1), on_page=page_done)
+        finally:
+            self.pipeline_stats = pipeline.stats
+            metrics.record_ingestion(pipeline.stats)
+        complete = next_page > total_pages
+        if checkpoint and complete: self.db.finish_sync(checkpoint)
         print(f"downloaded, ended at {datetime.now()}")
-        if self.SCROBBLES_CACHE['scrobbles']:
-            self.SCROBBLES_CACHE['last_update']=int(datetime.now().timestamp())
-        return self.SCROBBLES_CACHE
-    
-    def _write_scrobbles_to_db(self, scrobbles: List[Scrobble]) -> None:
-        self.db.write_scrobbles_to_db(scrobbles)
-
-
-    def __parse_scrobbles(self, scrobbles: List[dict]) -> List[Scrobble]:
-        parsed_scrobbles: List[Scrobble]=[]
-        for scrobble in scrobbles:
-            t = Track(title=scrobble["name"],artist=scrobble["artist"]['#text'],album=scrobble["album"]['#text'])
-            if "date" in scrobble:
-                s = Scrobble(track=t,timestamp=int(scrobble["date"]["uts"])) #type:ignore
-            #set currently playing to now
-            else:
-                try:
-                    if scrobble["@attr"]["nowplaying"] == 'true': 
-                        s = Scrobble(track=t,timestamp=int(datetime.now().timestamp())) #type:ignore
-                except:
-                    continue
-            parsed_scrobbles.append(s)
-        return parsed_scrobbles
+        app.logger.info(f"ingestion stats for {self.username}: {pipeline.stats}, http: {connection_stats(self.http)}, tracks: {self.track_interner.stats()}")
+        return self.__summary(pipeline.stats, complete)
+
+    def __store_scrobbles(self, parsed_scrobbles: List[ParsedScrobble]) -> int:
+        if parsed_scrobbles:
+            first = min(s.timestamp for s in parsed_scrobbles)
+            last = max(s.timestamp for s in parsed_scrobbles)
+            start, end = self._time_range
+            self._time_range = [first if start is None else min(start, first), last if end is None else max(end, last)]
+        return self._write_scrobbles_to_db(parsed_scrobbles)
+
+    def __summary(self, stats: PipelineStats, complete: bool=True) -> dict:
+        start, end = self._time_range
+        return {
+            "user": self.username,
+            "pages": stats.pages_written,
+            "scrobbles": stats.rows_parsed,
+            "new scrobbles": stats.rows_written,
+            "first scrobble": str(datetime.fromtimestamp(start)) if start is not None else None,
+            "last scrobble": str(datetime.fromtimestamp(end)) if end is not None else None,
+            "duration": round(stats.wall_seconds, 3),
+            "complete": complete
+        }
+
+    @staticmethod
+    def __merge_summaries(first: dict, second: dict) -> dict:
+        """one summary for a resumed sync followed by a fresh one"""
+        times = [ t for t in (first["first scrobble"], second["first scrobble"]) if t is not None ]
+        last_times = [ t for t in (first["last scrobble"], second["last scrobble"]) if t is not None ]
+        return dict(second,
+            pages=first["pages"] + second["pages"],
+            scrobbles=first["scrobbles"] + second["scrobbles"],
+            duration=round(first["duration"] + second["duration"], 3),
+            **{"new scrobbles": first["new scrobbles"] + second["new scrobbles"],
+                "first scrobble": min(times) if times else None,
+                "last scrobble": max(last_times) if last_times else None})
+
+    def _fetch_page_with_retries(self, page: int, payload: dict, limiter: TokenBucket) -> dict:
+        """fetches a single page, retrying it up to `LASTFM_PAGE_RETRIES` times with exponential backoff.
+        Every attempt counts in `requests_sent`, none is sent once the update's `max_requests` are spent.
+        runs on worker threads, so it must not touch the db session or app context.
+        
+        Raises:
+            LastFMUserNotFound: [not retried]
+            ScrobbleFetchFailed: [once retries are exhausted]
+        """
+        retries, backoff = self.page_retries, self.retry_backoff
+        attempt = 0
+        while True:
+            with self._requests_lock:
+                if self.max_requests is not None and self.requests_sent >= self.max_requests:
+                    raise ScrobbleFetchFailed(f"page {page} not fetched, the update's {self.max_requests} requests are spent")
+                self.requests_sent += 1
+            limiter.acquire()
+            try:
+                return self.__get_scrobbles_page(page=page,payload=payload)
+            except (ScrobbleFetchFailed, requests.RequestException, ValueError) as e:
+                if attempt >= retries:
+                    raise ScrobbleFetchFailed(f"page {page} failed after {attempt+1} attempts: {e}")
+                time.sleep(backoff * 2**attempt)
+                attempt += 1
+
+    def _write_scrobbles_to_db(self, scrobbles: List[ParsedScrobble]) -> int:
+        if app.config.get('BULK_INGESTION', True):
+            return self.db.bulk_write_scrobbles_to_db(scrobbles)
+        else:
+            return self.db.write_scrobbles_to_db(scrobbles)
+
+
+    def __parse_scrobbles(self, scrobbles: List[dict]) -> List[ParsedScrobble]:
+        #known tracks are resolved here, on the fetch threads, so the writer skips them
+        return parse_recent_tracks(scrobbles, self.track_interner.peek)
 
 
     def _is_new_lf_user(self) -> bool:
@@ -117,19 +242,25 @@ class LastFMHelper:
         Returns:
             dict: [json of request result]
         """
+        payload = dict(payload)
         payload['method'] = "user.getRecentTracks"
         payload['user'] = self.username
         payload['limit'] = 200
         payload['page'] = page
+        started = time.perf_counter()
         r = self.__do_request("GET",payload)
-        if 'error' in r.json() and r.json()["error"] == 6:
+        metrics.LASTFM_FETCH_SECONDS.observe(time.perf_counter() - started)
+        metrics.LASTFM_PAGE_BYTES.observe(len(r.content))
+        #decoded once, by the fastest json library installed
+        page = fastjson.loads(r.content)
+        if isinstance(page, dict) and page.get("error") == 6:
             raise LastFMUserNotFound("the username is not found on LastFM")
         elif r.status_code != 200:
             raise ScrobbleFetchFailed(f"An error occured getting srobbles from LastFM, response:{r.text}")
-        return r.json() 
+        return page
 
     def __do_request(self, http_method, payload):
-        """makes a `request` call using the provided data:
+        """makes a call with the app's pooled `requests.Session` using the provided data:
         
         Args:
             http_method (str): 
@@ -137,20 +268,19 @@ class LastFMHelper:
             format and api_key are auto appended
         
         Returns:
-            [type]: [description]
+            [requests.Response]: the response
         """
 
         request_methods = {
-            "GET":requests.get,
-            "POST":requests.post
+            "GET":self.http.get,
+            "POST":self.http.post
         }
         payload["format"]="json"
         payload["api_key"]=self.API_KEY
         r: function = request_methods[http_method]
-        return r(self.lastfm_api,params=payload)
+        return r(self.lastfm_api,params=payload,timeout=self.http_timeout)
 
 
 if __name__=="__main__":
     lf = LastFMHelper(username="sonofatailor")
-    tracks = lf.get_or_update_user_scrobbles()
-    print(tracks[-1])
+    print(lf.get_or_update_user_scrobbles())
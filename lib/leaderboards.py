@@ -0,0 +1,127 @@
+from datetime import date, timedelta
+from sqlalchemy import func, desc
+from sqlalchemy.orm import Session
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from lib.models import Track, DailyRollup, Leaderboard, LeaderboardWindow
+
+#window names the api accepts, windows end today (server local) and are `days` long
+WINDOWS = {'week': 7, 'month': 30, 'year': 365}
+#groups of the top-N queries: tracks (and artists) are grouped by title, albums by album
+TITLE = 'title'
+ALBUM = 'album'
+KINDS = (TITLE, ALBUM)
+#IN lists are chunked under sqlite's bound parameter limit (see `database.MAX_SQL_VARIABLES`)
+_CHUNK = 900
+
+
+def window_days(days: int, today: Optional[date]=None) -> Tuple[date,date]:
+    """(first, last) day of the `days` long window ending `today`"""
+    last = today or date.today()
+    return last - timedelta(days=days-1), last
+
+
+def _day_range(first: date, last: date) -> List[date]:
+    return [ first + timedelta(days=i) for i in range((last - first).days + 1) ]
+
+
+def _chunks(values: List[Any]) -> Iterable[List[Any]]:
+    for i in range(0, len(values), _CHUNK):
+        yield values[i:i+_CHUNK]
+
+
+def _groups_on_days(session: Session, user_id: int, days: List[date]) -> Dict[str,Set[str]]:
+    """the titles and albums the user played on `days`"""
+    groups: Dict[str,Set[str]] = { kind: set() for kind in KINDS }
+    for chunk in _chunks(sorted(set(days))):
+        for title, album in session.query(Track.title, Track.album).join(DailyRollup, DailyRollup.track_id==Track.id)\
+                .filter(DailyRollup.user_id==user_id).filter(DailyRollup.day.in_(chunk)).distinct():
+            groups[TITLE].add(title)
+            groups[ALBUM].add(album)
+    return groups
+
+
+def _group_rows(session: Session, user_id: int, first: date, last: date, kind: str,
+        names: Optional[List[str]]=None) -> List[Tuple[str,str,str,int]]:
+    """(name, max album, max artist, plays) per group over the daily rollups of [first, last], only `names` if given"""
+    key = Track.title if kind == TITLE else Track.album
+    query = session.query(key, func.max(Track.album), func.max(Track.artist), func.sum(DailyRollup.plays))\
+        .join(DailyRollup, DailyRollup.track_id==Track.id)\
+        .filter(DailyRollup.user_id==user_id).filter(DailyRollup.day>=first).filter(DailyRollup.day<=last)
+    if names is None:
+        return query.group_by(key).all()
+    rows: List[Tuple[str,str,str,int]] = []
+    for chunk in _chunks(names):
+        rows += query.filter(key.in_(chunk)).group_by(key).all()
+    return rows
+
+
+def refresh(session: Session, user_id: int, days: int, first: date, last: date,
+        groups: Optional[Dict[str,Set[str]]]=None) -> None:
+    """recomputes the leaderboard rows of `groups` ({kind: names}, every group if None) over [first, last].
+    Groups are recomputed from the day buckets rather than adjusted by deltas, their max album/artist
+    can't be un-maxed when plays expire. Does not commit.
+    """
+    table = Leaderboard.__table__
+    for kind in KINDS:
+        names = None if groups is None else sorted(groups[kind])
+        if names == []: continue
+        stale = session.query(Leaderboard).filter(Leaderboard.user_id==user_id)\
+            .filter(Leaderboard.days==days).filter(Leaderboard.kind==kind)
+        if names is None:
+            stale.delete(synchronize_session=False)
+        else:
+            for chunk in _chunks(names):
+                stale.filter(Leaderboard.name.in_(chunk)).delete(synchronize_session=False)
+        rows = [ {"user_id": user_id, "days": days, "kind": kind, "name": name, "album": album,
+            "artist": artist, "plays": int(plays)} for name, album, artist, plays
+            in _group_rows(session, user_id, first, last, kind, names) if plays ]
+        if rows: session.execute(table.insert(), rows)
+
+
+def advance(session: Session, user_id: int, days: int, today: Optional[date]=None) -> bool:
+    """moves the user's `days` window to end `today`, building it on first use. The groups played on the
+    days leaving the window (expired) or entering it are recomputed, a window that moved by more than its
+    length (or backwards) is rebuilt. Does not commit.
+
+    Returns:
+        bool: whether anything changed
+    """
+    first, last = window_days(days, today)
+    state = session.query(LeaderboardWindow).filter_by(user_id=user_id, days=days).first()
+    if state is not None and (state.first_day, state.last_day) == (first, last):
+        return False
+    if state is None or state.last_day < first or state.last_day > last:
+        refresh(session, user_id, days, first, last)
+    else:
+        moved = _day_range(state.first_day, first - timedelta(days=1)) + _day_range(state.last_day + timedelta(days=1), last)
+        refresh(session, user_id, days, first, last, _groups_on_days(session, user_id, moved))
+    if state is None:
+        state = LeaderboardWindow(user_id=user_id, days=days)
+        session.add(state)
+    state.first_day, state.last_day = first, last
+    return True
+
+
+def on_write(session: Session, user_id: int, written_days: Iterable[date]) -> None:
+    """adds the plays written on `written_days` to the user's materialized windows containing them.
+    Windows that don't exist yet are built on their first read. Does not commit.
+    """
+    written = set(written_days)
+    for state in session.query(LeaderboardWindow).filter(LeaderboardWindow.user_id==user_id).all():
+        inside = [ day for day in written if state.first_day <= day <= state.last_day ]
+        if inside:
+            refresh(session, user_id, state.days, state.first_day, state.last_day, _groups_on_days(session, user_id, inside))
+
+
+def clear(session: Session, user_id: int) -> None:
+    """drops the user's windows, they are rebuilt on their next read. Does not commit."""
+    session.query(Leaderboard).filter(Leaderboard.user_id==user_id).delete(synchronize_session=False)
+    session.query(LeaderboardWindow).filter(LeaderboardWindow.user_id==user_id).delete(synchronize_session=False)
+
+
+def top(session: Session, user_id: int, days: int, kind: str, limit: int) -> List[Tuple[str,str,str,int]]:
+    """the `limit` most played (name, album, artist, plays) groups of the window, ties by name like the
+    top-N queries"""
+    return session.query(Leaderboard.name, Leaderboard.album, Leaderboard.artist, Leaderboard.plays)\
+        .filter(Leaderboard.user_id==user_id).filter(Leaderboard.days==days).filter(Leaderboard.kind==kind)\
+        .order_by(desc(Leaderboard.plays), Leaderboard.name).limit(limit).all()
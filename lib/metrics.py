@@ -0,0 +1,237 @@
+import cProfile
+import io
+import pstats
+import re
+import threading
+import time
+from bisect import bisect_left
+from flask import Flask, Response, current_app as app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+#seconds, from a cached read to a slow lastfm page
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 500)
+BYTE_BUCKETS = (1e4, 5e4, 1e5, 2e5, 5e5, 1e6, 2e6)
+
+Labels = Tuple[str,...]
+Sample = Tuple[str,Dict[str,str],float]
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Labels=()) -> None:
+        self.name, self.help, self.labels, self.type = name, help, labels, 'counter'
+        self._values: Dict[Labels,float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float=1, **labels: str) -> None:
+        key = tuple(str(labels[l]) for l in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(tuple(str(labels[l]) for l in self.labels), 0)
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            return [ (self.name, dict(zip(self.labels, key)), value) for key, value in sorted(self._values.items()) ]
+
+
+class Histogram:
+    """cumulative bucket counts, sum and count per label set"""
+
+    def __init__(self, name: str, help: str, labels: Labels=(), buckets: Iterable[float]=DEFAULT_BUCKETS) -> None:
+        self.name, self.help, self.labels, self.type = name, help, labels, 'histogram'
+        self.buckets = tuple(sorted(buckets))
+        #per label set: [count per bucket (last is +Inf), sum]
+        self._values: Dict[Labels,List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[l]) for l in self.labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = [counts, total + value]
+
+    def count(self, **labels: str) -> int:
+        with self._lock:
+            values = self._values.get(tuple(str(labels[l]) for l in self.labels))
+            return sum(values[0]) if values else 0
+
+    def samples(self) -> List[Sample]:
+        samples: List[Sample] = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                labels = dict(zip(self.labels, key))
+                cumulative = 0
+                for bound, n in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += n
+                    samples.append((self.name + '_bucket', dict(labels, le=_number(bound)), cumulative))
+                samples.append((self.name + '_sum', labels, total))
+                samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+
+class Registry:
+    """the metrics of the process plus collectors, callables returning (name, help, value[, labels]) gauges
+    read from the app's own stats objects when /metrics is scraped"""
+
+    def __init__(self) -> None:
+        self.metrics: List[Any] = []
+        self.collectors: List[Callable[[], Iterable[Tuple]]] = []
+
+    def counter(self, name: str, help: str, labels: Labels=()) -> Counter:
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Labels=(), buckets: Iterable[float]=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """the prometheus text exposition format (0.0.4)"""
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines += [f'# HELP {metric.name} {metric.help}', f'# TYPE {metric.name} {metric.type}']
+            lines += [ _sample(name, labels, value) for name, labels, value in metric.samples() ]
+        gauges: Dict[str,Tuple[str,List[str]]] = {}
+        for collect in self.collectors:
+            for name, help, value, *labels in collect():
+                gauges.setdefault(name, (help, []))[1].append(_sample(name, labels[0] if labels else {}, value))
+        for name, (help, samples) in gauges.items():
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} gauge'] + samples
+        return '\n'.join(lines) + '\n'
+
+
+def _number(value: float) -> str:
+    if value == float('inf'): return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+def _sample(name: str, labels: Dict[str,str], value: float) -> str:
+    if not labels: return f'{name} {_number(value)}'
+    escaped = ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels.items())
+    return f'{name}{{{escaped}}} {_number(value)}'
+
+def _metric_name(name: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+#process wide, fetch and job threads record without an app context
+REGISTRY = Registry()
+REQUEST_SECONDS = REGISTRY.histogram('http_request_duration_seconds', 'time to build the response per endpoint',
+    ('endpoint', 'method', 'status'))
+REQUEST_SQL_STATEMENTS = REGISTRY.histogram('http_request_sql_statements', 'sql statements executed per request',
+    ('endpoint',), STATEMENT_BUCKETS)
+REQUEST_SQL_SECONDS = REGISTRY.histogram('http_request_sql_seconds', 'time spent executing sql per request', ('endpoint',))
+SQL_STATEMENTS = REGISTRY.counter('sql_statements_total', 'sql statements executed by the process')
+SQL_SECONDS = REGISTRY.counter('sql_statement_seconds_total', 'time spent executing sql statements')
+LASTFM_FETCH_SECONDS = REGISTRY.histogram('lastfm_fetch_seconds', 'latency of lastfm page requests')
+LASTFM_PAGE_BYTES = REGISTRY.histogram('lastfm_page_bytes', 'body size of lastfm pages', (), BYTE_BUCKETS)
+INGESTION_ROWS = REGISTRY.counter('ingestion_rows_total', 'new scrobbles written by imports')
+INGESTION_SECONDS = REGISTRY.counter('ingestion_seconds_total', 'wall time of imports, rows/sec is the ratio of the rates')
+
+_last_ingestion: Dict[str,float] = {}
+_request = threading.local()
+_listening = False
+
+
+def record_ingestion(stats: Any) -> None:
+    """counts a finished import's `PipelineStats`, and keeps them as the last run's gauges"""
+    INGESTION_ROWS.inc(stats.rows_written)
+    INGESTION_SECONDS.inc(stats.wall_seconds)
+    last = stats.to_dict()
+    last["rows_per_second"] = stats.rows_written / stats.wall_seconds if stats.wall_seconds else 0
+    _last_ingestion.clear()
+    _last_ingestion.update(last)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['metrics_started'].pop()
+    SQL_STATEMENTS.inc()
+    SQL_SECONDS.inc(elapsed)
+    sql = getattr(_request, 'sql', None)
+    if sql is not None:
+        sql[0] += 1
+        sql[1] += elapsed
+
+
+def _app_stats() -> Iterable[Tuple]:
+    """gauges from the stats the app already keeps, only for the parts this process has used"""
+    from lib.binds import pool_stats
+    from lib.httpclient import connection_stats
+    from lib.interning import track_interner_stats
+    for key, value in _last_ingestion.items():
+        yield f'ingestion_last_run_{key}', 'the last import of this process (PipelineStats)', value
+    cache = app.extensions.get('results_cache')
+    if cache is not None:
+        for key, value in cache.stats().items():
+            yield f'results_cache_{key}', 'analytics results cache lookups', value
+    session = app.extensions.get('lastfm_http_session')
+    if session is not None:
+        for key, value in connection_stats(session).items():
+            yield f'lastfm_http_{key}', 'lastfm requests sent, connections opened and reused', value
+    for key, value in track_interner_stats().items():
+        yield f'track_interner_{key}', 'track ids resolved by the interner (hits) or the db (misses), and entries', value
+    for bind, stats in pool_stats().items():
+        for key, value in stats.items():
+            yield f'db_pool_{key}', 'connections of the engine pool', value, {"bind": bind}
+    scheduler = app.extensions.get('refresh_scheduler')
+    if scheduler is not None and scheduler.last_run is not None:
+        for key, value in scheduler.last_run.to_dict().items():
+            if isinstance(value, (int, float)):
+                yield _metric_name(f'refresh_last_run_{key}'), 'the last scheduled refresh run', value
+
+
+def _endpoint() -> str:
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+def _start_request() -> None:
+    g.metrics_started = time.perf_counter()
+    _request.sql = [0, 0.0]
+    if app.config.get('PROFILE_REQUESTS', False) and request.args.get('profile') == '1':
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+def _finish_request(response: Response) -> Response:
+    """records the request, streamed bodies are timed up to the first byte"""
+    endpoint = _endpoint()
+    REQUEST_SECONDS.observe(time.perf_counter() - g.metrics_started,
+        endpoint=endpoint, method=request.method, status=response.status_code)
+    sql = getattr(_request, 'sql', None) or [0, 0.0]
+    REQUEST_SQL_STATEMENTS.observe(sql[0], endpoint=endpoint)
+    REQUEST_SQL_SECONDS.observe(sql[1], endpoint=endpoint)
+    profiler: Optional[cProfile.Profile] = g.pop('profiler', None)
+    if profiler is None: return response
+    profiler.disable()
+    out = io.StringIO()
+    out.write(f'{request.method} {request.full_path} -> {response.status_code}, {sql[0]} sql statements in {sql[1]:.4f}s\n\n')
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(app.config.get('PROFILE_TOP_FUNCTIONS', 40))
+    return Response(out.getvalue(), mimetype='text/plain')
+
+def _end_request(error: Optional[BaseException]=None) -> None:
+    _request.sql = None
+
+def metrics_view() -> Response:
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(flask_app: Flask) -> None:
+    """times every request of `flask_app`, counts sql statements on every engine and serves /metrics"""
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        REGISTRY.collectors.append(_app_stats)
+        _listening = True
+    flask_app.before_request(_start_request)
+    flask_app.after_request(_finish_request)
+    flask_app.teardown_request(_end_request)
+    flask_app.add_url_rule('/metrics', 'metrics', metrics_view)
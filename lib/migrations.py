@@ -0,0 +1,44 @@
+from sqlalchemy import func, inspect, select
+from typing import List
+from lib.models import DailyRollup, HourlyRollup, Scrobble, db
+
+
+def upgrade_schema(engine=None) -> List[str]:
+    """creates missing tables, then the indexes `create_all` skips on tables that already exist.
+    Rollup tables created next to existing scrobbles are backfilled, the top-N reads trust them for whole days
+
+    Returns:
+        List[str]: names of the tables and indexes that were created
+    """
+    engine = engine or db.engine
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    db.metadata.create_all(bind=engine)
+    created = [ table.name for table in db.metadata.sorted_tables if table.name not in existing_tables ]
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables: continue
+        existing_indexes = { index['name'] for index in inspector.get_indexes(table.name) }
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=engine)
+                created.append(index.name)
+    if Scrobble.__tablename__ in existing_tables:
+        backfill_rollups(engine, [ name for name in created if name in ROLLUP_TABLES ])
+    return created
+
+
+ROLLUP_TABLES = (DailyRollup.__tablename__, HourlyRollup.__tablename__)
+
+def backfill_rollups(engine, tables: List[str]) -> None:
+    """fills the (empty) rollup `tables` from every user's scrobbles, one INSERT ... SELECT each"""
+    hour = (Scrobble.timestamp - Scrobble.timestamp % 3600) / 3600
+    statements = {
+        DailyRollup.__tablename__: DailyRollup.__table__.insert().from_select(['user_id', 'day', 'track_id', 'plays'],
+            select([Scrobble.user_id, Scrobble.date, Scrobble.track_id, func.count(Scrobble.id)])
+                .group_by(Scrobble.user_id, Scrobble.date, Scrobble.track_id)),
+        HourlyRollup.__tablename__: HourlyRollup.__table__.insert().from_select(['user_id', 'hour', 'plays'],
+            select([Scrobble.user_id, hour, func.count(Scrobble.id)]).group_by(Scrobble.user_id, hour)),
+    }
+    with engine.begin() as conn:
+        for table in tables:
+            conn.execute(statements[table])
@@ -1,17 +1,19 @@
 from sqlalchemy import func, desc
-from sqlalchemy import Column, String, Date, Time, DateTime, Integer, ForeignKey, UniqueConstraint, Unicode
+from sqlalchemy import Column, String, Date, Time, DateTime, Integer, Boolean, ForeignKey, UniqueConstraint, Unicode, Index
 from datetime import datetime
 from sqlalchemy.orm import sessionmaker, relationship
-from flask_sqlalchemy import SQLAlchemy
+from lib.binds import RoutingSQLAlchemy
 from typing import List, Dict, Any
 # from app import db
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
 class Track(db.Model):
     __tablename__ = 'tracks'
-    __table_args__ = (UniqueConstraint('title','album','artist'),{
+    __table_args__ = (UniqueConstraint('title','album','artist'),
+        Index('ix_tracks_artist','artist'),
+        Index('ix_tracks_album_artist','album','artist'),{
         'mysql_row_format': 'DYNAMIC'
     })
 
@@ -44,7 +46,11 @@ class User(db.Model):
 
 class Scrobble(db.Model): 
     __tablename__ = 'scrobbles'
-    __table_args__ = (UniqueConstraint('date','time','user_id'), {
+    __table_args__ = (UniqueConstraint('date','time','user_id'),
+        #every read filters on the user plus a datetime range, track_id makes it covering for the rollup joins
+        Index('ix_scrobbles_user_datetime_track','user_id','datetime','track_id'),
+        #keyset pagination cursor
+        Index('ix_scrobbles_user_timestamp','user_id','timestamp'), {
         'mysql_row_format': 'DYNAMIC'
     })
     id = Column(Integer, primary_key=True)
@@ -73,3 +79,96 @@ class Scrobble(db.Model):
             "date":self.datetime,
             "track":self.track.to_dict()
         }
+
+
+
+class DailyRollup(db.Model):
+    """plays per (user, day, track), maintained by `DbHelper` on every write"""
+    __tablename__ = 'daily_rollups'
+    __table_args__ = (UniqueConstraint('user_id','day','track_id'), {
+        'mysql_row_format': 'DYNAMIC'
+    })
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    day = Column(Date)
+    track_id = Column(Integer, ForeignKey('tracks.id'))
+    plays = Column(Integer)
+
+    def __repr__(self):
+        return f"<DailyRollup: {self.day} {self.track_id} {self.plays} >"
+
+
+class HourlyRollup(db.Model):
+    """plays per (user, hour), hours are counted since the epoch so they're timezone independent"""
+    __tablename__ = 'hourly_rollups'
+    __table_args__ = (UniqueConstraint('user_id','hour'), {
+        'mysql_row_format': 'DYNAMIC'
+    })
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    hour = Column(Integer)
+    plays = Column(Integer)
+
+    def __repr__(self):
+        return f"<HourlyRollup: {self.hour} {self.plays} >"
+
+
+
+class LeaderboardWindow(db.Model):
+    """the days a user's materialized `days` long leaderboard currently covers, see `lib.leaderboards`"""
+    __tablename__ = 'leaderboard_windows'
+    __table_args__ = (UniqueConstraint('user_id','days'), {
+        'mysql_row_format': 'DYNAMIC'
+    })
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    days = Column(Integer)
+    first_day = Column(Date)
+    last_day = Column(Date)
+
+    def __repr__(self):
+        return f"<LeaderboardWindow: user {self.user_id} {self.days} days {self.first_day}-{self.last_day} >"
+
+
+class Leaderboard(db.Model):
+    """plays per (user, window, title or album) over the days of the user's `LeaderboardWindow`,
+    with the max album/artist of the group like the top-N queries"""
+    __tablename__ = 'leaderboards'
+    __table_args__ = (UniqueConstraint('user_id','days','kind','name'),
+        #top-N reads walk this index from the most played group
+        Index('ix_leaderboards_user_days_kind_plays','user_id','days','kind','plays'), {
+        'mysql_row_format': 'DYNAMIC'
+    })
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    days = Column(Integer)
+    kind = Column(String(8))
+    name = Column(String(256))
+    album = Column(String(256))
+    artist = Column(String(256))
+    plays = Column(Integer)
+
+    def __repr__(self):
+        return f"<Leaderboard: user {self.user_id} {self.days} days {self.kind} {self.name} {self.plays} >"
+
+
+class SyncCheckpoint(db.Model):
+    """progress of a user's (latest) sync from lastfm, pages below `next_page` are committed.
+    An unfinished checkpoint is resumed with the same from/to window, so pages keep their numbering.
+    """
+    __tablename__ = 'sync_checkpoints'
+    __table_args__ = (UniqueConstraint('user_id'), {
+        'mysql_row_format': 'DYNAMIC'
+    })
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    from_timestamp = Column(Integer)
+    to_timestamp = Column(Integer)
+    total_pages = Column(Integer)
+    next_page = Column(Integer)
+    finished = Column(Boolean, default=False)
+    started = Column(DateTime)
+    updated = Column(DateTime)
+
+    def __repr__(self):
+        return f"<SyncCheckpoint: user {self.user_id} {self.from_timestamp}-{self.to_timestamp} page {self.next_page}/{self.total_pages} >"
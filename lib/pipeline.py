@@ -0,0 +1,134 @@
+import threading
+import time
+from queue import Queue, Empty, Full
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+
+class PipelineStats:
+    """per stage timing counters for an ingestion run, seconds are summed across worker threads"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.pages_fetched = 0
+        self.pages_written = 0
+        self.rows_parsed = 0
+        self.rows_written = 0
+        self.fetch_seconds = 0.0
+        self.parse_seconds = 0.0
+        self.write_seconds = 0.0
+        #time fetchers spent blocked on a full queue (writer is the bottleneck)
+        self.backpressure_seconds = 0.0
+        #time the writer spent waiting on an empty queue (fetchers are the bottleneck)
+        self.writer_idle_seconds = 0.0
+        self.started = time.perf_counter()
+        self.wall_seconds = 0.0
+
+    def add(self, **counters) -> None:
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def to_dict(self) -> Dict[str,Any]:
+        with self._lock:
+            return {
+                "pages_fetched": self.pages_fetched,
+                "pages_written": self.pages_written,
+                "rows_parsed": self.rows_parsed,
+                "rows_written": self.rows_written,
+                "fetch_seconds": round(self.fetch_seconds, 4),
+                "parse_seconds": round(self.parse_seconds, 4),
+                "write_seconds": round(self.write_seconds, 4),
+                "backpressure_seconds": round(self.backpressure_seconds, 4),
+                "writer_idle_seconds": round(self.writer_idle_seconds, 4),
+                "wall_seconds": round(self.wall_seconds, 4)
+            }
+
+    def __repr__(self):
+        return str(self.to_dict())
+
+
+class IngestionPipeline:
+    """producer/consumer ingestion: `workers` fetcher threads fetch and parse pages onto a
+    bounded queue that a single writer (the calling thread, which owns the db session) drains.
+    The queue bound is the backpressure, at most `queue_size` + `workers` parsed pages are alive at once.
+    """
+
+    def __init__(self, fetch: Callable[[int], Any], parse: Callable[[Any], List[Any]],
+                 write: Callable[[List[Any]], int], workers: int=4, queue_size: int=8) -> None:
+        self._fetch = fetch
+        self._parse = parse
+        self._write = write
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.stats = PipelineStats()
+
+    def fetch(self, page: int) -> Any:
+        start = time.perf_counter()
+        raw = self._fetch(page)
+        self.stats.add(fetch_seconds=time.perf_counter() - start, pages_fetched=1)
+        return raw
+
+    def parse(self, raw: Any) -> List[Any]:
+        start = time.perf_counter()
+        rows = self._parse(raw)
+        self.stats.add(parse_seconds=time.perf_counter() - start, rows_parsed=len(rows))
+        return rows
+
+    def write(self, rows: List[Any]) -> int:
+        start = time.perf_counter()
+        written = self._write(rows)
+        self.stats.add(write_seconds=time.perf_counter() - start, pages_written=1, rows_written=written or 0)
+        self.stats.wall_seconds = time.perf_counter() - self.stats.started
+        return written
+
+    def run(self, pages: Sequence[int], on_page: Optional[Callable[[int, int], None]]=None) -> PipelineStats:
+        """fetches, parses and writes `pages`, pages are written in the order they arrive
+
+        Args:
+            pages (Sequence[int]): page numbers to ingest
+            on_page (Callable[[int, int], None], optional): called on the writer with (page, rows written)
+
+        Raises:
+            the first exception raised by a fetcher or the writer, remaining pages are abandoned
+        """
+        if not pages: return self.stats
+        todo: Queue = Queue()
+        for page in pages: todo.put(page)
+        results: Queue = Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        def fetcher():
+            while not stop.is_set():
+                try:
+                    page = todo.get_nowait()
+                except Empty:
+                    return
+                try:
+                    item = (page, self.parse(self.fetch(page)), None)
+                except Exception as e:
+                    item = (page, None, e)
+                waited = time.perf_counter()
+                while not stop.is_set():
+                    try:
+                        results.put(item, timeout=0.1)
+                        break
+                    except Full:
+                        continue
+                self.stats.add(backpressure_seconds=time.perf_counter() - waited)
+                if item[2] is not None: return
+
+        threads = [ threading.Thread(target=fetcher, daemon=True) for _ in range(min(self.workers, len(pages))) ]
+        for thread in threads: thread.start()
+        try:
+            for _ in range(len(pages)):
+                waited = time.perf_counter()
+                page, rows, error = results.get()
+                self.stats.add(writer_idle_seconds=time.perf_counter() - waited)
+                if error is not None: raise error
+                written = self.write(rows)
+                if on_page: on_page(page, written)
+        finally:
+            stop.set()
+            for thread in threads: thread.join()
+            self.stats.wall_seconds = time.perf_counter() - self.stats.started
+        return self.stats
@@ -0,0 +1,49 @@
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+from lib.models import Scrobble, Track
+
+
+class ParsedScrobble(NamedTuple):
+    """a scrobble as parsed from a lastfm page, plain tuple so parsing builds no ORM state.
+    `track_id` is set when the track interner already knows the track.
+    """
+    timestamp: int
+    title: str
+    album: str
+    artist: str
+    track_id: Optional[int] = None
+
+    @property
+    def track_key(self) -> Tuple[str,str,str]:
+        return (self.title, self.album, self.artist)
+
+    def to_orm(self) -> Scrobble:
+        """the (transient) ORM scrobble, for the row by row write path"""
+        return Scrobble(track=Track(title=self.title,album=self.album,artist=self.artist),timestamp=self.timestamp) #type:ignore
+
+    @classmethod
+    def from_orm(cls, scrobble: Scrobble) -> 'ParsedScrobble':
+        track = scrobble.track
+        return cls(scrobble.timestamp, track.title, track.album, track.artist, scrobble.track_id)
+
+
+AnyScrobble = Union[Scrobble, ParsedScrobble]
+
+
+def as_records(scrobbles: List[AnyScrobble]) -> List[ParsedScrobble]:
+    return [ s if isinstance(s, ParsedScrobble) else ParsedScrobble.from_orm(s) for s in scrobbles ]
+
+
+def parse_recent_tracks(tracks: List[Dict[str,Any]],
+        track_id: Optional[Callable[[Tuple[str,str,str]], Optional[int]]]=None) -> List[ParsedScrobble]:
+    """records for the entries of a `user.getRecentTracks` page, `track_id` resolves known tracks.
+    The now playing track has no date until lastfm scrobbles it, storing it early would double count it
+    and push the sync cursor past the real scrobble, so it is skipped.
+    """
+    parsed: List[ParsedScrobble] = []
+    append = parsed.append
+    for scrobble in tracks:
+        date = scrobble.get("date")
+        if date is None: continue
+        key = (scrobble["name"], scrobble["album"]['#text'], scrobble["artist"]['#text'])
+        append(ParsedScrobble(int(date["uts"]), key[0], key[1], key[2], track_id(key) if track_id else None))
+    return parsed
@@ -0,0 +1,134 @@
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app as app
+from sqlalchemy import func, or_
+from typing import Any, Dict, List, Optional, Tuple
+from lib.models import User, HourlyRollup, SyncCheckpoint, db
+
+
+class RefreshRunStats:
+    """what a scheduler run did, `requests` is the LastFM requests it spent (retries included, the budget
+    is charged with them) and `pages` the pages those requests fetched"""
+
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        self.started = datetime.now()
+        self.candidates = 0
+        self.refreshed = 0
+        self.partial = 0
+        self.failed = 0
+        self.deferred = 0
+        self.requests = 0
+        self.pages = 0
+        self.new_scrobbles = 0
+        self.duration = 0.0
+        self.users: List[Dict[str,Any]] = []
+
+    def to_dict(self) -> Dict[str,Any]:
+        return {
+            "started": str(self.started),
+            "duration": round(self.duration, 3),
+            "budget": self.budget,
+            "requests": self.requests,
+            "pages": self.pages,
+            "candidates": self.candidates,
+            "refreshed": self.refreshed,
+            "partial": self.partial,
+            "failed": self.failed,
+            "deferred": self.deferred,
+            "new scrobbles": self.new_scrobbles,
+            "users": self.users
+        }
+
+    def __repr__(self):
+        return str(self.to_dict())
+
+
+class RefreshScheduler:
+    """refreshes users whose `last_update` is older than `stale_after` seconds, most urgent first.
+    Priority is staleness weighted by the user's plays over the last `activity_days` days, users with
+    an unfinished sync are always candidates. A run spends at most `request_budget` LastFM requests in total
+    (retries of failed pages included) and `user_pages` pages per user, so a long first import is spread over several runs (resumed from its
+    sync checkpoint) instead of starving everyone else. Requests also go through the app wide rate limiter.
+    """
+
+    def __init__(self, stale_after: int=3600, request_budget: int=500, user_pages: int=20, activity_days: int=7) -> None:
+        self.stale_after = stale_after
+        self.request_budget = request_budget
+        self.user_pages = user_pages
+        self.activity_days = activity_days
+        self.last_run: Optional[RefreshRunStats] = None
+        self._lock = threading.Lock()
+
+    def candidates(self, now: Optional[datetime]=None) -> List[Tuple[str,float]]:
+        """stale users and users with an open sync as (username, priority), highest priority first"""
+        now = now or datetime.now()
+        since_hour = int((now - timedelta(days=self.activity_days)).timestamp()) // 3600
+        recent = db.session.query(HourlyRollup.user_id, func.sum(HourlyRollup.plays).label('plays'))\
+            .filter(HourlyRollup.hour >= since_hour).group_by(HourlyRollup.user_id).subquery()
+        open_syncs = db.session.query(SyncCheckpoint.user_id).filter(SyncCheckpoint.finished==False)
+        rows = db.session.query(User.name, User.last_update, func.coalesce(recent.c.plays, 0))\
+            .outerjoin(recent, recent.c.user_id==User.id)\
+            .filter(or_(User.last_update==None,
+                User.last_update < now - timedelta(seconds=self.stale_after),
+                User.id.in_(open_syncs))).all()
+        never = datetime(1970,1,1)
+        ranked = [ (name, (now - (last_update or never)).total_seconds() * (1 + math.log1p(plays)))
+            for name, last_update, plays in rows ]
+        return sorted(ranked, key=lambda c: (-c[1], c[0]))
+
+    def run(self) -> RefreshRunStats:
+        """refreshes candidates in priority order until they are done or the budget is spent"""
+        from lib.lastfm import LastFMHelper
+        with self._lock:
+            stats = RefreshRunStats(self.request_budget)
+            start = time.perf_counter()
+            candidates = self.candidates()
+            stats.candidates = len(candidates)
+            for name, priority in candidates:
+                remaining = self.request_budget - stats.requests
+                if remaining <= 0:
+                    stats.deferred += 1
+                    continue
+                report: Dict[str,Any] = {"user": name, "priority": round(priority, 1)}
+                helper = None
+                try:
+                    helper = LastFMHelper(username=name)
+                    summary = helper.get_or_update_user_scrobbles(max_pages=min(self.user_pages, remaining),
+                        max_requests=remaining)
+                    report.update(pages=summary["pages"], new_scrobbles=summary["new scrobbles"], complete=summary["complete"])
+                    stats.new_scrobbles += summary["new scrobbles"]
+                    if summary["complete"]: stats.refreshed += 1
+                    else: stats.partial += 1
+                except Exception as e:
+                    app.logger.exception(f"scheduled refresh of {name} failed")
+                    report.update(error=str(e))
+                    stats.failed += 1
+                finally:
+                    pipeline_stats = getattr(helper, 'pipeline_stats', None)
+                    report.setdefault("pages", pipeline_stats.pages_fetched if pipeline_stats else 0)
+                    report["requests"] = helper.requests_sent if helper else 0
+                    stats.pages += report["pages"]
+                    stats.requests += report["requests"]
+                    stats.users.append(report)
+                    db.session.remove()
+            stats.duration = time.perf_counter() - start
+            self.last_run = stats
+        app.logger.info(f"refresh run: {stats}")
+        return stats
+
+    def run_forever(self, interval: float, stop: Optional[threading.Event]=None) -> None:
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            self.run()
+            stop.wait(interval)
+
+
+def get_refresh_scheduler() -> RefreshScheduler:
+    if 'refresh_scheduler' not in app.extensions:
+        app.extensions['refresh_scheduler'] = RefreshScheduler(
+            app.config.get('REFRESH_STALE_SECONDS', 3600), app.config.get('REFRESH_REQUEST_BUDGET', 500),
+            app.config.get('REFRESH_USER_PAGES', 20), app.config.get('REFRESH_ACTIVITY_DAYS', 7))
+    return app.extensions['refresh_scheduler']
@@ -0,0 +1,47 @@
+import os
+import pytest
+
+from lastfm_visualizer.app import app
+from lib.database import DbHelper, clear_user_cache
+from lib.interning import clear_track_interners
+from lib.migrations import upgrade_schema
+from lib.models import db
+
+TEST_DB = 'tests/testdb.db'
+
+
+@pytest.fixture
+def reset_caches():
+    """forgets the process wide user ids and track ids of earlier tests' databases"""
+    clear_user_cache()
+    clear_track_interners()
+
+
+@pytest.fixture
+def client(reset_caches):
+    app.config['TESTING'] = True
+    app.config['SQLALCHEMY_DATABASE_URI']=f'sqlite:///{TEST_DB}'
+    app.config['LASTFM_RETRY_BACKOFF'] = 0
+    with app.app_context():
+        upgrade_schema()
+    client = app.test_client()
+
+    yield client
+    if os.path.exists(TEST_DB):
+        os.remove(TEST_DB)
+
+
+@pytest.fixture
+def db_helper(reset_caches):
+    """a `DbHelper` for 'testuser' on a fresh sqlite file, or on `TEST_MYSQL_URI` when it is set"""
+    app.config['TESTING'] = True
+    app.config['SQLALCHEMY_DATABASE_URI']=os.getenv('TEST_MYSQL_URI', f'sqlite:///{TEST_DB}')
+    with app.app_context():
+        upgrade_schema()
+        helper = DbHelper('testuser')
+        helper.add_user_to_db()
+        yield helper
+        db.session.remove()
+        if os.getenv('TEST_MYSQL_URI'): db.drop_all()
+    if os.path.exists(TEST_DB):
+        os.remove(TEST_DB)
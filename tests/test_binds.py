@@ -0,0 +1,99 @@
+import os
+import shutil
+import threading
+import time
+import pytest
+from datetime import datetime, timedelta
+
+from lastfm_visualizer.app import app
+from lib import binds
+from lib.database import DbHelper
+from lib.migrations import upgrade_schema
+from lib.models import Scrobble, db
+from tests.test_database import make_page
+
+PRIMARY = 'tests/primary.db'
+REPLICA = 'tests/replica.db'
+#engines are made once per uri, a fresh file gets one with the pool settings
+POOLED = 'tests/pooled.db'
+PERIOD = (datetime(2019,1,1), datetime(2019,2,1))
+
+
+def remove(*paths):
+    for path in paths:
+        if os.path.exists(path): os.remove(path)
+
+
+@pytest.fixture
+def replicated(reset_caches):
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{PRIMARY}'
+    app.config['SQLALCHEMY_BINDS'] = {'replica': f'sqlite:///{REPLICA}'}
+    try:
+        with app.app_context():
+            upgrade_schema()
+            yield
+            db.session.remove()
+    finally:
+        app.config['SQLALCHEMY_BINDS'] = None
+        remove(PRIMARY, REPLICA)
+
+
+def test_reads_use_the_replica_and_writes_the_primary(replicated):
+    helper = DbHelper('replicated')
+    helper.add_user_to_db()
+    helper.bulk_write_scrobbles_to_db(make_page(count=20))
+    #what replication would have shipped so far
+    shutil.copyfile(PRIMARY, REPLICA)
+    helper.bulk_write_scrobbles_to_db(make_page(start=1548300000 + 20*60, count=10))
+    assert db.session.query(Scrobble).count() == 30
+    #as if the update were older than the replica's lag
+    app.config['REPLICA_MAX_LAG_SECONDS'] = 0
+    try:
+        reader = DbHelper('replicated')
+        assert reader.read_session is not db.session
+        assert sum(t["played"] for t in reader.get_top_tracks_for_period(*PERIOD, limit=10)) == 20
+        assert len(reader.get_scrobbles_in_period(*PERIOD)) == 20
+        assert sum(reader.get_track_count_in_period(*PERIOD).values()) == 20
+        shutil.copyfile(PRIMARY, REPLICA)
+        assert len(reader.get_scrobbles_in_period(*PERIOD)) == 30
+    finally:
+        app.config['REPLICA_MAX_LAG_SECONDS'] = 60
+
+
+def test_recently_updated_users_are_read_from_the_primary(replicated):
+    helper = DbHelper('replicated')
+    helper.add_user_to_db()
+    helper.bulk_write_scrobbles_to_db(make_page(count=20))
+    shutil.copyfile(PRIMARY, REPLICA)
+    helper.bulk_write_scrobbles_to_db(make_page(start=1548300000 + 20*60, count=10))
+    #the replica hasn't received the update yet, its results must not be cached under it
+    reader = DbHelper('replicated')
+    assert reader.read_session is db.session
+    assert len(reader.get_scrobbles_in_period(*PERIOD)) == 30
+    reader.last_update = datetime.now() - timedelta(seconds=61)
+    assert reader.read_session is not db.session
+    assert len(reader.get_scrobbles_in_period(*PERIOD)) == 20
+
+
+def test_pool_settings_apply_and_checkout_waits_are_measured():
+    app.config.update({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{POOLED}', 'DB_POOL_SIZE': 1, 'DB_MAX_OVERFLOW': 0,
+        'DB_POOL_TIMEOUT': 5, 'DB_POOL_PRE_PING': True})
+    try:
+        with app.app_context():
+            engine = db.get_engine(app)
+            assert isinstance(engine.pool, binds.TimedQueuePool) and engine.pool.size() == 1
+            waited = binds.CHECKOUT_SECONDS.count(bind='primary')
+            held = engine.connect()
+            def release():
+                time.sleep(0.2)
+                held.close()
+            threading.Thread(target=release).start()
+            began = time.perf_counter()
+            engine.connect().close()
+            assert time.perf_counter() - began >= 0.15
+            assert binds.CHECKOUT_SECONDS.count(bind='primary') == waited + 2
+            assert binds.pool_stats()["primary"] == {"checked_out": 0, "idle": 1, "overflow": 0}
+            engine.dispose()
+    finally:
+        app.config.update({'DB_POOL_SIZE': None, 'DB_MAX_OVERFLOW': None, 'DB_POOL_TIMEOUT': None, 'DB_POOL_PRE_PING': False})
+        remove(POOLED)
@@ -0,0 +1,83 @@
+import json
+import pytest
+import responses
+from collections import Counter
+from datetime import datetime
+
+from lastfm_visualizer.app import app
+from lib.buckets import get_tz, period_timestamps, utc_offsets, histogram
+from lib.models import Scrobble
+from tests.test_database import spread_page
+from tests.test_scrobbles_api import standard_data_request_callback, LF_API, LF_TEST_USERNAME
+
+
+def brute_force(timestamps, start, end, unit, tz):
+    """the local time of every scrobble in the zone, counted per bucket key"""
+    zone = get_tz(tz)
+    start_ts, end_ts = period_timestamps(start, end, zone)
+    formats = {'hours': '%Y-%m-%d %H:00:00', 'days': '%Y-%m-%d', 'weekdays': '%u',
+        'months': '%Y-%m-01 00:00:00', 'years': '%Y-01-01 00:00:00'}
+    return Counter(datetime.fromtimestamp(ts, zone).strftime(formats[unit])
+        for ts in timestamps if start_ts <= ts <= end_ts)
+
+
+def test_utc_offsets_find_dst_transitions():
+    zone = get_tz('America/New_York')
+    start, end = period_timestamps(datetime(2019,1,1), datetime(2019,12,31), zone)
+    segments = utc_offsets(zone, start, end)
+    assert [ (datetime.utcfromtimestamp(ts), offset) for ts, offset in segments[1:] ] == [
+        (datetime(2019,3,10,7), -4*3600), (datetime(2019,11,3,6), -5*3600)]
+
+
+def test_histogram_is_dense_and_chronological():
+    zone = get_tz('UTC')
+    start, end = period_timestamps(datetime(2019,1,30), datetime(2019,3,2), zone)
+    segments = utc_offsets(zone, start, end)
+    plays = [(start + 3600, 2), (start + 2*86400, 1)]
+    days = histogram(plays, start, end, 'days', segments)
+    assert list(days) == sorted(days) and len(days) == 32
+    assert (days['2019-01-30'], days['2019-01-31'], days['2019-02-01'], days['2019-03-02']) == (2, 0, 1, 0)
+    assert histogram(plays, start, end, 'months', segments) == {
+        '2019-01-01 00:00:00': 2, '2019-02-01 00:00:00': 1, '2019-03-01 00:00:00': 0}
+    assert list(histogram([], start, end, 'weekdays', segments)) == ['1', '2', '3', '4', '5', '6', '7']
+    with pytest.raises(ValueError):
+        histogram([], start, end, 'fortnights', segments)
+    start, end = period_timestamps(datetime(1700,1,1), datetime(2019,3,2), zone)
+    with pytest.raises(ValueError):
+        histogram([], start, end, 'days', utc_offsets(zone, start, end))
+    assert len(histogram([], start, end, 'months', utc_offsets(zone, start, end))) == 319 * 12 + 3
+
+
+@pytest.mark.parametrize("tz", [None, 'UTC', 'America/New_York', 'Asia/Kolkata', 'Australia/Adelaide'])
+@pytest.mark.parametrize("rollups", [True, False])
+def test_frequency_matches_local_times_in_the_zone(db_helper, tz, rollups):
+    db_helper.bulk_write_scrobbles_to_db(spread_page(start=1552000000, count=300))
+    timestamps = [ ts for ts, in db_helper.session.query(Scrobble.timestamp) ]
+    start, end = datetime(2019,3,8,6,30), datetime(2019,3,17,20)
+    app.config['ROLLUP_HOUR_BUCKETS'] = rollups
+    try:
+        for unit in ('hours', 'days', 'weekdays', 'months', 'years'):
+            frequency = db_helper.get_track_count_in_period(start, end, unit, tz=tz)
+            assert list(frequency) == sorted(frequency, key=lambda k: (len(k), k))
+            assert { k: v for k, v in frequency.items() if v } == brute_force(timestamps, start, end, unit, tz)
+    finally:
+        app.config['ROLLUP_HOUR_BUCKETS'] = True
+
+
+@responses.activate
+def test_frequency_endpoint_takes_a_timezone(client):
+    responses.add_callback(
+        responses.GET, f'{LF_API}/?method=user.getRecentTracks&user={LF_TEST_USERNAME}',
+        callback=standard_data_request_callback,
+        content_type='application/json',
+    )
+    client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    data = {"start": "2019-01-23", "end": "2019-01-25", "scale": "days", "tz": "Asia/Tokyo"}
+    r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/frequency', data=json.dumps(data), content_type='application/json')
+    assert r.status_code == 200
+    assert sum(r.json["frequency"].values()) > 0
+    assert list(r.json["frequency"]) == ["2019-01-23", "2019-01-24", "2019-01-25"]
+    for bad in ({"tz": "Mars/Olympus"}, {"scale": "fortnights"}, {"start": "0001-01-01", "tz": "America/New_York"},
+            {"start": "1700-01-01"}, {"start": "1700-01-01", "scale": "hours"}):
+        r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/frequency', data=json.dumps(dict(data, **bad)), content_type='application/json')
+        assert r.status_code == 400
@@ -0,0 +1,44 @@
+import json
+import responses
+
+from lastfm_visualizer.app import app
+from lib.cache import LRUBackend, ResultCache
+from tests.test_scrobbles_api import standard_data_request_callback, LF_API, LF_TEST_USERNAME
+
+
+def test_lru_backend_evicts_least_recently_used():
+    backend = LRUBackend(size=2)
+    backend.set('a', 'user1', 1)
+    backend.set('b', 'user1', 2)
+    backend.get('a')
+    backend.set('c', 'user2', 3)
+    assert (backend.get('a'), backend.get('b'), backend.get('c')) == (1, None, 3)
+
+
+def test_invalidate_user_drops_only_that_users_entries():
+    cache = ResultCache(LRUBackend())
+    cache.get_or_compute('user1', 'v1', 'top-tracks', ('2019', 5), lambda: ['x'])
+    cache.get_or_compute('user2', 'v1', 'top-tracks', ('2019', 5), lambda: ['y'])
+    cache.invalidate_user('user1')
+    assert cache.get_or_compute('user1', 'v1', 'top-tracks', ('2019', 5), lambda: ['z']) == ['z']
+    assert cache.get_or_compute('user2', 'v1', 'top-tracks', ('2019', 5), lambda: ['z']) == ['y']
+
+
+@responses.activate
+def test_endpoints_are_served_from_cache_until_the_next_update(client):
+    responses.add_callback(
+        responses.GET, f'{LF_API}/',
+        callback=standard_data_request_callback,
+        content_type='application/json',
+    )
+    data = json.dumps({"start":"2019-01-23", "end": "2019-01-25", "limit":3})
+    client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    cache = app.extensions['results_cache']
+    hits, misses = cache.hits, cache.misses
+    first = client.get(f'/scrobbles/{LF_TEST_USERNAME}/top-artists',data=data,content_type='application/json')
+    second = client.get(f'/scrobbles/{LF_TEST_USERNAME}/top-artists',data=data,content_type='application/json')
+    assert first.json == second.json
+    assert (cache.hits - hits, cache.misses - misses) == (1, 1)
+    client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    client.get(f'/scrobbles/{LF_TEST_USERNAME}/top-artists',data=data,content_type='application/json')
+    assert cache.misses - misses == 2
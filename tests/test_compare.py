@@ -0,0 +1,117 @@
+import random
+import pytest
+from datetime import datetime
+from sqlalchemy import event
+
+from lastfm_visualizer.app import app
+from lib import compare
+from lib.database import DbHelper, lookup_users
+from lib.models import Scrobble
+from tests.test_engine import random_pages
+
+USERS = ['alice', 'bob', 'carol']
+PERIOD = (datetime(2019,1,1), datetime(2019,3,1,12,30))
+
+
+def add_users(names=USERS, scrobbles=600):
+    """each user plays from the same catalog with a different seed"""
+    for seed, name in enumerate(names):
+        helper = DbHelper(name)
+        helper.add_user_to_db()
+        for page in random_pages(random.Random(seed), scrobbles, datetime(2018,12,1), datetime(2019,4,1)):
+            helper.bulk_write_scrobbles_to_db(page)
+
+
+def artist_plays_of(name, start, end):
+    helper = DbHelper(name)
+    plays = {}
+    for s in helper.session.query(Scrobble).filter_by(user_id=helper.user_id)\
+            .filter(Scrobble.datetime>=start).filter(Scrobble.datetime<=end):
+        plays[s.track.artist] = plays.get(s.track.artist, 0) + 1
+    return plays
+
+
+def count_statements(session, call):
+    statements = []
+    def capture(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = session.get_bind()
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        result = call()
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+    return result, len(statements)
+
+
+def test_artist_plays_of_every_user_in_one_query(db_helper):
+    add_users()
+    users = lookup_users(USERS)
+    plays, statements = count_statements(db_helper.session,
+        lambda: compare.artist_plays({ user_id: last_update for user_id, last_update in users.values() }, *PERIOD))
+    assert statements == 1
+    for name in USERS:
+        assert plays[users[name][0]] == artist_plays_of(name, *PERIOD)
+
+
+def test_compare_ranks_overlaps_and_listeners(db_helper):
+    add_users()
+    result = compare.compare(lookup_users(USERS + ['nobody']), *PERIOD, limit=3, artist='Zappa')
+    plays = { name: artist_plays_of(name, *PERIOD) for name in USERS }
+    plays['nobody'] = {}
+    tops = {}
+    for name, artists in plays.items():
+        tops[name] = sorted(artists.items(), key=lambda a: (-a[1], a[0]))[:3]
+        assert result["users"][name] == {"played": sum(artists.values()), "artists": len(artists),
+            "top artists": [ {"artist": a, "played": n} for a, n in tops[name] ]}
+    alice, bob = { a for a, _ in tops['alice'] }, { a for a, _ in tops['bob'] }
+    assert result["overlap"]["pairs"][0] == {"users": ['alice', 'bob'], "common": sorted(alice & bob),
+        "jaccard": round(len(alice & bob) / len(alice | bob), 4)}
+    assert len(result["overlap"]["pairs"]) == 6
+    #nobody has no top artists
+    assert result["overlap"]["common artists"] == []
+    def ranked(artist):
+        return sorted(((name, p[artist]) for name, p in plays.items() if p.get(artist)), key=lambda u: (-u[1], u[0]))
+    assert result["listeners"] == {"artist": 'Zappa', "users": [ {"user": u, "played": n} for u, n in ranked('Zappa') ]}
+    assert sorted(result["top listeners"]) == sorted({ a for top in tops.values() for a, _ in top })
+    for artist, listener in result["top listeners"].items():
+        assert (listener["user"], listener["played"]) == ranked(artist)[0]
+
+
+def test_compare_reads_loaded_columns(db_helper):
+    pytest.importorskip('numpy')
+    add_users()
+    users = lookup_users(USERS)
+    from_sql = compare.compare(users, *PERIOD, limit=5)
+    from lib import engine
+    engine.get_columnar_store().clear()
+    app.config['COLUMNAR_ENGINE'] = True
+    try:
+        DbHelper('bob')._columns()
+        assert compare.compare(users, *PERIOD, limit=5) == from_sql
+    finally:
+        app.config['COLUMNAR_ENGINE'] = False
+        engine.get_columnar_store().clear()
+
+
+def test_compare_endpoint(client):
+    with app.app_context():
+        add_users(USERS[:2], 200)
+    query = {"users": "alice, bob,alice", "start": "2019-01-01", "end": "2019-03-01", "limit": 2}
+    r = client.get('/scrobbles/compare', query_string=query)
+    assert r.status_code == 200
+    assert list(r.json["users"]) == ['alice', 'bob']
+    assert r.json["start"] == "2019-01-01 00:00:00+00:00"
+    assert len(r.json["users"]["alice"]["top artists"]) == 2
+    assert client.get('/scrobbles/compare', query_string={"start": "2019-01-01", "end": "2019-03-01"}).status_code == 400
+    app.config['COMPARE_MAX_USERS'] = 1
+    try:
+        assert client.get('/scrobbles/compare', query_string=query).status_code == 400
+    finally:
+        app.config['COMPARE_MAX_USERS'] = 25
+
+
+@pytest.mark.parametrize("limit", [0, -2])
+def test_compare_endpoint_rejects_non_positive_limits(client, limit):
+    query = {"users": "alice,bob", "start": "2019-01-01", "end": "2019-03-01", "limit": limit}
+    assert client.get('/scrobbles/compare', query_string=query).status_code == 400
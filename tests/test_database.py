@@ -0,0 +1,190 @@
+import pytest
+from datetime import datetime
+from sqlalchemy import func, event
+from sqlalchemy.dialects import mysql
+
+from lastfm_visualizer.app import app
+from lib.database import DbHelper, insert_ignore
+from lib.migrations import upgrade_schema
+from lib.models import Scrobble, Track, DailyRollup, HourlyRollup, db
+from lib.records import ParsedScrobble, parse_recent_tracks
+
+
+def make_page(start=1548300000, count=50):
+    tracks = [("Song A","Album A","Artist A"),("Song B","Album B","Artist B"),("Song A","Album C","Artist A")]
+    page = []
+    for i in range(count):
+        title, album, artist = tracks[i % len(tracks)]
+        t = Track(title=title,album=album,artist=artist)
+        page.append(Scrobble(track=t,timestamp=start + i*60))
+    return page
+
+
+def stored_rows(helper):
+    return sorted(
+        (s.timestamp, s.track.title, s.track.album, s.track.artist)
+        for s in helper.session.query(Scrobble).all())
+
+
+def test_bulk_write_inserts_tracks_and_scrobbles(db_helper):
+    inserted = db_helper.bulk_write_scrobbles_to_db(make_page())
+    assert inserted == 50
+    assert db_helper.session.query(Track).count() == 3
+    assert db_helper.session.query(Scrobble).filter_by(user_id=db_helper.user.id).count() == 50
+
+
+def test_bulk_write_ignores_duplicates(db_helper):
+    db_helper.bulk_write_scrobbles_to_db(make_page())
+    inserted = db_helper.bulk_write_scrobbles_to_db(make_page(start=1548300000 + 25*60))
+    assert inserted == 25
+    assert db_helper.session.query(Track).count() == 3
+    assert db_helper.session.query(Scrobble).count() == 75
+
+
+def test_bulk_write_matches_row_by_row_write(db_helper):
+    db_helper.write_scrobbles_to_db(make_page(count=20))
+    row_by_row = stored_rows(db_helper)
+    db_helper.session.query(Scrobble).delete()
+    db_helper.session.commit()
+    db_helper.bulk_write_scrobbles_to_db(make_page(count=20))
+    assert stored_rows(db_helper) == row_by_row
+
+
+@pytest.mark.parametrize("bulk", [True, False])
+def test_parsed_records_write_like_orm_scrobbles(db_helper, bulk):
+    write = db_helper.bulk_write_scrobbles_to_db if bulk else db_helper.write_scrobbles_to_db
+    write(make_page(count=20))
+    from_orm = stored_rows(db_helper)
+    db_helper.session.query(Scrobble).delete()
+    db_helper.session.commit()
+    write([ ParsedScrobble.from_orm(s) for s in make_page(count=20) ])
+    assert stored_rows(db_helper) == from_orm
+
+
+def test_parse_skips_the_now_playing_track():
+    tracks = [
+        {"name": "Song A", "artist": {"#text": "Artist A"}, "album": {"#text": "Album A"}, "@attr": {"nowplaying": "true"}},
+        {"name": "Song B", "artist": {"#text": "Artist B"}, "album": {"#text": "Album B"}, "date": {"uts": "1548300000"}},
+    ]
+    known = {("Song B", "Album B", "Artist B"): 7}
+    assert parse_recent_tracks(tracks, known.get) == [ParsedScrobble(1548300000, "Song B", "Album B", "Artist B", 7)]
+
+
+def spread_page(start=1548300000, count=200):
+    """scrobbles ~47 minutes apart, so a page covers several days"""
+    page = make_page(start=start, count=count)
+    for i, s in enumerate(page):
+        page[i] = Scrobble(track=s.track, timestamp=start + i*2833)
+    return page
+
+
+@pytest.mark.parametrize("start,end", [
+    (datetime(2019,1,24), datetime(2019,1,27)),
+    (datetime(2019,1,24,7,30), datetime(2019,1,27,13,5)),
+    (datetime(2019,1,25,1), datetime(2019,1,25,22)),
+])
+def test_rollup_answers_match_raw_scrobbles(db_helper, start, end):
+    db_helper.bulk_write_scrobbles_to_db(spread_page())
+    queries = [
+        lambda: db_helper.get_top_tracks_for_period(start, end, 5),
+        lambda: db_helper.get_top_albums_for_period(start, end, 5),
+        lambda: db_helper.get_top_artists_for_period(start, end, 5),
+        lambda: db_helper.get_track_count_in_period(start, end, 'days'),
+        lambda: db_helper.get_track_count_in_period(start, end, 'hours'),
+        lambda: db_helper.get_track_count_in_period(start, end, 'months'),
+    ]
+    from_rollups = [ q() for q in queries ]
+    app.config['ROLLUP_QUERIES'] = app.config['ROLLUP_HOUR_BUCKETS'] = False
+    try:
+        from_raw = [ q() for q in queries ]
+    finally:
+        app.config['ROLLUP_QUERIES'] = app.config['ROLLUP_HOUR_BUCKETS'] = True
+    assert from_rollups == from_raw
+
+
+def test_rollups_follow_rewritten_days(db_helper):
+    db_helper.bulk_write_scrobbles_to_db(spread_page(count=100))
+    db_helper.bulk_write_scrobbles_to_db(spread_page(count=200))
+    rollup_plays = db_helper.session.query(func.sum(DailyRollup.plays)).filter_by(user_id=db_helper.user.id).scalar()
+    hourly_plays = db_helper.session.query(func.sum(HourlyRollup.plays)).filter_by(user_id=db_helper.user.id).scalar()
+    assert rollup_plays == hourly_plays == 200
+
+
+def test_db_helper_construction_is_served_from_the_user_cache(db_helper):
+    statements = []
+    def capture(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = db_helper.session.get_bind()
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        helper = DbHelper('testuser')
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+    assert statements == []
+    assert helper.user_id == db_helper.user.id
+
+
+@pytest.mark.parametrize("unit,statements_expected", [("days", 1), ("weekdays", 1), ("hours", 2)])
+def test_summary_reads_the_range_once(db_helper, unit, statements_expected):
+    db_helper.bulk_write_scrobbles_to_db(spread_page())
+    start, end = datetime(2019,1,24,7,30), datetime(2019,1,27,13,5)
+    statements = []
+    def capture(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = db_helper.session.get_bind()
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        summary = db_helper.get_summary_for_period(start, end, 2, unit)
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+    assert len(statements) == statements_expected
+    assert summary == {
+        "top tracks": db_helper.get_top_tracks_for_period(start, end, 2),
+        "top albums": db_helper.get_top_albums_for_period(start, end, 2),
+        "top artists": db_helper.get_top_artists_for_period(start, end, 2),
+        "frequency": db_helper.get_track_count_in_period(start, end, unit)
+    }
+
+
+@pytest.mark.parametrize("bulk", [True, False])
+def test_known_tracks_are_resolved_from_the_interner(db_helper, bulk):
+    write = db_helper.bulk_write_scrobbles_to_db if bulk else db_helper.write_scrobbles_to_db
+    interner = db_helper.track_interner()
+    write(make_page(count=30))
+    #the bulk path resolves a whole page at once, the row path caches each track after its first row
+    assert interner.stats() == ({"hits": 0, "misses": 30, "size": 3} if bulk else {"hits": 27, "misses": 3, "size": 3})
+    track_lookups = []
+    def capture(conn, cursor, statement, *args):
+        if 'FROM tracks' in statement and 'WHERE tracks.title' in statement: track_lookups.append(statement)
+    engine = db_helper.session.get_bind()
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        write(make_page(start=1548400000, count=30))
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+    assert track_lookups == []
+    assert interner.stats()["hits"] == (30 if bulk else 57)
+    assert db_helper.session.query(Track).count() == 3
+    assert db_helper.session.query(Scrobble).count() == 60
+
+
+def test_mysql_bulk_insert_ignores_duplicates_without_counting_them():
+    stmt = insert_ignore(Scrobble.__table__, [{"timestamp": 1, "user_id": 1}], 'mysql')
+    sql = str(stmt.compile(dialect=mysql.dialect()))
+    assert sql.startswith('INSERT IGNORE INTO scrobbles')
+    assert 'ON DUPLICATE KEY' not in sql
+
+
+def test_upgrade_schema_backfills_rollup_tables_it_creates(db_helper):
+    db_helper.bulk_write_scrobbles_to_db(spread_page())
+    def rollups():
+        return (sorted(db_helper.session.query(DailyRollup.user_id, DailyRollup.day, DailyRollup.track_id, DailyRollup.plays)),
+            sorted(db_helper.session.query(HourlyRollup.user_id, HourlyRollup.hour, HourlyRollup.plays)))
+    maintained = rollups()
+    assert maintained[0] and maintained[1]
+    engine = db_helper.session.get_bind()
+    db.session.remove()
+    DailyRollup.__table__.drop(engine)
+    HourlyRollup.__table__.drop(engine)
+    assert {'daily_rollups', 'hourly_rollups'} <= set(upgrade_schema(engine))
+    assert rollups() == maintained
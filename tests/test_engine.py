@@ -0,0 +1,73 @@
+import random
+import pytest
+from datetime import datetime, timedelta
+
+from lastfm_visualizer.app import app
+from lib.models import Scrobble, Track
+
+engine = pytest.importorskip('lib.engine')
+pytest.importorskip('numpy')
+
+TITLES = ['Intro', 'intro', 'Ärger', 'Zebra', 'beta', 'Beta', 'Home', 'Run', 'Run (Live)', 'Outro']
+ALBUMS = ['A', 'B', 'b', 'Zed', 'Élan', 'Live']
+ARTISTS = ['Artist 1', 'artist 1', 'Ölund', 'Zappa', 'Bob']
+
+
+def random_pages(rng, count, start, end, page_size=200):
+    tracks = [ (rng.choice(TITLES), rng.choice(ALBUMS), rng.choice(ARTISTS)) for _ in range(40) ]
+    timestamps = rng.sample(range(int(start.timestamp()), int(end.timestamp())), count)
+    scrobbles = [ Scrobble(track=Track(title=t, album=a, artist=r), timestamp=ts)
+        for ts, (t, a, r) in ((ts, rng.choice(tracks)) for ts in timestamps) ]
+    return [ scrobbles[i:i+page_size] for i in range(0, count, page_size) ]
+
+
+def random_range(rng, start, end):
+    span = int((end - start).total_seconds())
+    a, b = sorted(rng.randrange(span) for _ in range(2))
+    first = start + timedelta(seconds=a)
+    if rng.random() < 0.5: first = first.replace(hour=0, minute=0, second=0)
+    return first, start + timedelta(seconds=b, microseconds=rng.choice([0, 500]))
+
+
+def answers(helper, ranges):
+    results = []
+    for start, end, limit in ranges:
+        results += [
+            helper.get_top_tracks_for_period(start, end, limit),
+            helper.get_top_albums_for_period(start, end, limit),
+            helper.get_top_artists_for_period(start, end, limit),
+        ]
+        for unit in ('hours', 'days', 'weekdays', 'months', 'years'):
+            for tz in (None, 'Asia/Kolkata'):
+                results.append(helper.get_track_count_in_period(start, end, unit, tz=tz))
+    return results
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_columnar_engine_matches_sql(db_helper, seed):
+    rng = random.Random(seed)
+    first, last = datetime(2018,10,1), datetime(2019,12,31)
+    pages = random_pages(rng, 1500, first, last)
+    ranges = [ random_range(rng, first - timedelta(days=10), last + timedelta(days=10)) + (rng.choice([1, 3, 5, 50]),)
+        for _ in range(15) ]
+    engine.get_columnar_store().clear()
+    app.config['COLUMNAR_ENGINE'] = True
+    try:
+        for page in pages[:4]: db_helper.bulk_write_scrobbles_to_db(page)
+        #loaded here, the remaining pages are appended as they are written
+        assert db_helper._columns() is not None
+        for page in pages[4:]: db_helper.bulk_write_scrobbles_to_db(page)
+        columns = db_helper._columns()
+        assert len(columns) == db_helper.session.query(Scrobble).count()
+        assert columns.max_id == max(s.id for s in db_helper.session.query(Scrobble.id))
+        for hour_buckets in (True, False):
+            app.config['ROLLUP_HOUR_BUCKETS'] = hour_buckets
+            from_columns = answers(db_helper, ranges)
+            app.config['COLUMNAR_ENGINE'] = False
+            from_sql = answers(db_helper, ranges)
+            app.config['COLUMNAR_ENGINE'] = True
+            assert from_columns == from_sql
+    finally:
+        app.config['COLUMNAR_ENGINE'] = False
+        app.config['ROLLUP_HOUR_BUCKETS'] = True
+        engine.get_columnar_store().clear()
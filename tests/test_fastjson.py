@@ -0,0 +1,37 @@
+import json
+import pytest
+from datetime import datetime, date
+from flask import jsonify as flask_jsonify
+
+from lastfm_visualizer.app import app
+from lib import fastjson
+
+
+PAYLOAD = {
+    "start": datetime(2019,1,23,5,30), "end": date(2019,1,25),
+    "scrobbles": [{"track": "Rumors (With Sofia Carson)", "artist": "R3hab", "date": datetime(2019,1,24,19,1,38)}],
+    "frequency": {"2019-01-24": 25, "2019-01-23": 154}, "emoji": "é\U0001f3b5",
+}
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_jsonify_matches_flask(fast):
+    if fast: pytest.importorskip('orjson')
+    app.config['FAST_JSON'] = fast
+    try:
+        with app.app_context():
+            r = fastjson.jsonify(PAYLOAD)
+            expected = flask_jsonify(PAYLOAD)
+            assert r.mimetype == expected.mimetype
+            assert json.loads(r.get_data()) == json.loads(expected.get_data())
+            assert list(json.loads(r.get_data())) == list(json.loads(expected.get_data()))
+            assert json.loads(r.get_data())["start"] == "Wed, 23 Jan 2019 05:30:00 GMT"
+    finally:
+        app.config['FAST_JSON'] = True
+
+
+def test_loads_decodes_bytes_once():
+    body = json.dumps({"recenttracks": {"track": [], "@attr": {"totalPages": "3"}}}).encode()
+    assert fastjson.loads(body) == json.loads(body)
+    with pytest.raises(ValueError):
+        fastjson.loads(b'<html>bad gateway</html>')
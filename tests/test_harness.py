@@ -0,0 +1,33 @@
+from benchmarks.harness import ENDPOINTS, compare, run
+from benchmarks.histories import History
+from benchmarks.mock_lastfm import MockLastFM
+
+
+def test_history_pages_are_newest_first_and_windowed():
+    history = History('someone', 250, catalog=100)
+    assert history.timestamps.tolist() == sorted(set(history.timestamps))
+    assert History('someone', 250, catalog=100).tracks == history.tracks
+    first = history.page(1, 200)["recenttracks"]
+    assert first["@attr"]["totalPages"] == "2" and len(first["track"]) == 200
+    assert int(first["track"][0]["date"]["uts"]) == history.timestamps[-1]
+    last = history.page(2, 200)["recenttracks"]["track"]
+    assert [ int(t["date"]["uts"]) for t in last ] == history.timestamps[:50].tolist()[::-1]
+    window = history.page(1, 200, history.timestamps[10], history.timestamps[19])["recenttracks"]
+    assert window["@attr"]["total"] == "10" and len(window["track"]) == 10
+
+
+def test_mock_lastfm_reports_unknown_users():
+    mock = MockLastFM([History('someone', 10)])
+    assert mock.respond({"method": "user.getRecentTracks", "user": "nobody"})[0] == 404
+    status, body = mock.respond({"method": "user.getRecentTracks", "user": "someone", "limit": "5"})
+    assert status == 200 and b'"totalPages": "2"' in body
+
+
+def test_harness_imports_every_scrobble_and_times_every_endpoint():
+    results = run(users=2, scrobbles=450, requests=3, db_path='tests/harness.db')
+    assert results["import"]["rows"] == 900
+    assert results["import"]["lastfm_requests"] == 6
+    assert set(results["endpoints"]) == set(ENDPOINTS)
+    assert all(e["requests"] == 3 and e["p50_ms"] <= e["p99_ms"] for e in results["endpoints"].values())
+    assert results["peak_rss_mb"] > 0 and "commit" in results
+    assert len(compare(results, results)) == len(ENDPOINTS) + 2
@@ -0,0 +1,35 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lib.httpclient import create_session, connection_stats
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_session_reuses_connections():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    session = create_session(pool_size=2)
+    try:
+        for _ in range(5):
+            assert session.get(f'http://127.0.0.1:{server.server_port}/', timeout=5).json() == {"ok": True}
+        stats = connection_stats(session)
+        assert stats == {"requests": 5, "connections": 1, "reused": 4}
+    finally:
+        session.close()
+        server.shutdown()
+        server.server_close()
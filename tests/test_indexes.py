@@ -0,0 +1,92 @@
+import pytest
+from datetime import datetime
+from sqlalchemy import event
+
+from lib.migrations import upgrade_schema
+from lib.models import db
+from tests.test_database import spread_page
+
+SCROBBLES_INDEX = 'ix_scrobbles_user_datetime_track'
+#frequency buckets are computed from the timestamps
+TIMESTAMP_INDEX = 'ix_scrobbles_user_timestamp'
+
+
+@pytest.fixture
+def db_helper(db_helper):
+    db_helper.bulk_write_scrobbles_to_db(spread_page())
+    return db_helper
+
+
+def range_query_statements(helper):
+    """the select statements on `scrobbles` issued by every range read of `DbHelper`"""
+    statements = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and 'scrobbles' in statement:
+            statements.append((statement, parameters))
+    engine = helper.session.get_bind()
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        start, end = datetime(2019,1,24,7,30), datetime(2019,1,27,13,5)
+        helper.get_scrobbles_in_period(start, end)
+        helper.get_top_tracks_for_period(start, end)
+        helper.get_top_albums_for_period(start, end)
+        helper.get_top_artists_for_period(start, end)
+        for unit in ('hours', 'days', 'weekdays', 'months', 'years'):
+            helper.get_track_count_in_period(start, end, unit)
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+    assert statements
+    return statements
+
+
+def table_accesses(helper, statement, parameters):
+    """(table, how it is accessed) for each table read by the statement's plan"""
+    cursor = helper.session.connection().connection.cursor()
+    if helper.session.get_bind().dialect.name == 'sqlite':
+        cursor.execute(f'EXPLAIN QUERY PLAN {statement}', parameters)
+        #(id, parent, notused, detail) with details like "SEARCH scrobbles USING INDEX ...",
+        #sqlite < 3.36 writes "SEARCH TABLE scrobbles USING ..."
+        details = [ row[3].split(' ') for row in cursor.fetchall() ]
+        details = [ d[:1] + d[2:] if len(d) > 2 and d[1] == 'TABLE' else d for d in details ]
+        return [ (d[1], ' '.join(d[2:])) for d in details if d[0] in ('SCAN', 'SEARCH') and len(d) > 1 ]
+    cursor.execute(f'EXPLAIN {statement}', parameters)
+    columns = [ c[0] for c in cursor.description ]
+    return [ (row['table'], f"{row['key']} {row['type']}") for row in (dict(zip(columns, r)) for r in cursor.fetchall()) ]
+
+
+def test_range_queries_use_a_user_range_index(db_helper):
+    for statement, parameters in range_query_statements(db_helper):
+        accesses = table_accesses(db_helper, statement, parameters)
+        scrobble_reads = [ how for table, how in accesses if table == 'scrobbles' ]
+        assert scrobble_reads, accesses
+        assert all(SCROBBLES_INDEX in how or TIMESTAMP_INDEX in how for how in scrobble_reads), accesses
+
+
+def test_rollup_refresh_of_a_page_seeks_to_its_range(db_helper):
+    statements = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('INSERT') and 'FROM scrobbles' in statement:
+            statements.append((statement, parameters))
+    engine = db_helper.session.get_bind()
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        db_helper.bulk_write_scrobbles_to_db(spread_page(start=1550000000, count=50))
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+    #the daily and the hourly recount
+    assert len(statements) == 2
+    for statement, parameters in statements:
+        accesses = table_accesses(db_helper, statement, parameters)
+        scrobble_reads = [ how for table, how in accesses if table == 'scrobbles' ]
+        assert scrobble_reads, accesses
+        #a range on the index's second column, not every row of the user
+        assert all((SCROBBLES_INDEX in how or TIMESTAMP_INDEX in how) and ('>' in how or how.endswith('range'))
+            for how in scrobble_reads), accesses
+
+
+def test_upgrade_schema_adds_missing_indexes(db_helper):
+    engine = db_helper.session.get_bind()
+    db.session.remove()
+    engine.execute(f'DROP INDEX {SCROBBLES_INDEX}' + (' ON scrobbles' if engine.dialect.name == 'mysql' else ''))
+    assert SCROBBLES_INDEX in upgrade_schema(engine)
+    assert upgrade_schema(engine) == []
@@ -0,0 +1,118 @@
+import sqlite3
+import time
+import pytest
+import responses
+
+from lastfm_visualizer.app import app
+from lib.jobs import JobQueue, MemoryJobStore, SQLiteJobStore, QUEUED, RUNNING, DONE, FAILED
+from tests.test_lastfm import paged_data_request_callback, scrobbles_per_page, stored_scrobbles, LF_API, LF_TEST_USERNAME
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryJobStore()
+    return SQLiteJobStore(str(tmp_path / 'jobs.db'), stale_after=60)
+
+
+def test_store_coalesces_jobs_per_user(store):
+    first, created = store.enqueue('alice')
+    again, created_again = store.enqueue('alice')
+    other, _ = store.enqueue('bob')
+    assert created and not created_again
+    assert again['id'] == first['id'] != other['id']
+
+    claimed = store.claim()
+    assert claimed['id'] == first['id'] and claimed['status'] == RUNNING
+    assert store.enqueue('alice')[0]['id'] == first['id']
+    store.update(first['id'], status=DONE)
+    assert store.enqueue('alice')[1]
+    assert store.claim()['id'] == other['id']
+
+
+def test_sqlite_store_reclaims_stale_running_jobs(tmp_path):
+    store = SQLiteJobStore(str(tmp_path / 'jobs.db'), stale_after=60)
+    job, _ = store.enqueue('alice')
+    store.claim()
+    assert store.claim() is None
+    store.stale_after = 0
+    assert store.claim()['id'] == job['id']
+    assert store.enqueue('alice')[1]
+
+
+def test_memory_store_never_reclaims_running_jobs():
+    store = MemoryJobStore()
+    job, _ = store.enqueue('alice')
+    store.claim()
+    #no heartbeat for ages, the worker running it is still this process's
+    store._jobs[job['id']]['updated'] = 0
+    assert store.claim() is None
+    assert store.enqueue('alice') == (store.get(job['id']), False)
+
+
+class LockedStore(MemoryJobStore):
+    """fails the first claims like a locked sqlite file"""
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def claim(self):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError('database is locked')
+        return super().claim()
+
+
+def test_worker_survives_store_errors():
+    store = LockedStore(failures=3)
+    queue = JobQueue(app, store, workers=1, poll_interval=0.01)
+    ran = []
+    queue.run_job = lambda job: ran.append(job['username'])
+    queue.submit('alice')
+    deadline = time.time() + 5
+    while not ran and time.time() < deadline:
+        time.sleep(0.01)
+    assert ran == ['alice'] and store.failures == 0
+
+
+def test_store_drops_finished_jobs_after_the_retention(store):
+    done, _ = store.enqueue('alice')
+    store.claim()
+    store.update(done['id'], status=DONE, finished=time.time())
+    failed, _ = store.enqueue('bob')
+    store.claim()
+    store.update(failed['id'], status=FAILED, finished=time.time())
+    queued, _ = store.enqueue('carol')
+    assert store.get(done['id']) and store.get(failed['id'])
+    store.retention = -1
+    store.claim()
+    assert store.get(done['id']) is None and store.get(failed['id']) is None
+    assert store.get(queued['id'])['status'] == RUNNING
+
+
+def wait_for_job(client, job_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = client.get(f'/scrobbles/{LF_TEST_USERNAME}/jobs/{job_id}').json
+        if job['status'] not in (QUEUED, RUNNING): return job
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+@responses.activate
+def test_post_update_runs_in_the_background(client):
+    app.extensions.pop('job_queue', None)
+    responses.add_callback(
+        responses.GET, f'{LF_API}/',
+        callback=paged_data_request_callback(3, {}),
+        content_type='application/json',
+    )
+    r = client.post(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    assert r.status_code == 202
+    job = wait_for_job(client, r.json['id'])
+    assert job['status'] == DONE, job['error']
+    assert job['pages_done'] == job['total_pages'] == 3
+    assert job['rows_written'] == scrobbles_per_page()*3 == stored_scrobbles()
+    assert job['eta'] == 0
+    assert client.get(f'/scrobbles/someoneelse/jobs/{job["id"]}').status_code == 404
@@ -0,0 +1,157 @@
+import json
+import responses
+from urllib.parse import urlparse, parse_qs
+
+from lastfm_visualizer.app import app
+from lib.lastfm import LastFMHelper
+from lib.models import Scrobble, db
+
+LF_TEST_USERNAME="testuser"
+LF_API = "http://ws.audioscrobbler.com/2.0"
+DUMMY_LF_DATA_PATH = 'tests/data.json'
+
+
+def paged_data_request_callback(total_pages, failures):
+    """serves data.json as `total_pages` pages (shifted a day apart), failing page n `failures[n]` times"""
+    with open(DUMMY_LF_DATA_PATH) as f:
+        body = json.load(f)
+    def callback(request):
+        page = int(parse_qs(urlparse(request.url).query)['page'][0])
+        if failures.get(page, 0) > 0:
+            failures[page] -= 1
+            return (500, {}, 'Internal Server Error')
+        resp_body = json.loads(json.dumps(body))
+        resp_body["recenttracks"]["@attr"]["page"] = str(page)
+        resp_body["recenttracks"]["@attr"]["totalPages"] = str(total_pages)
+        for track in resp_body["recenttracks"]["track"]:
+            track["date"]["uts"] = str(int(track["date"]["uts"]) - (page-1)*86400*30)
+        return (200, {'content-type': 'application/json'}, json.dumps(resp_body))
+    return callback
+
+
+def scrobbles_per_page():
+    with open(DUMMY_LF_DATA_PATH) as f:
+        tracks = json.load(f)["recenttracks"]["track"]
+    return len({ track["date"]["uts"] for track in tracks })
+
+
+def stored_scrobbles():
+    with app.app_context():
+        return db.session.query(Scrobble).count()
+
+
+@responses.activate
+def test_update_fetches_every_page(client):
+    responses.add_callback(
+        responses.GET, f'{LF_API}/',
+        callback=paged_data_request_callback(4, {}),
+        content_type='application/json',
+    )
+    r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    assert r.status_code == 200
+    assert stored_scrobbles() == scrobbles_per_page()*4
+    assert r.json["pages"] == 4
+    assert r.json["scrobbles"] == 181*4
+    assert r.json["new scrobbles"] == scrobbles_per_page()*4
+
+
+@responses.activate
+def test_update_retries_failed_pages(client):
+    responses.add_callback(
+        responses.GET, f'{LF_API}/',
+        callback=paged_data_request_callback(3, {2: 2, 3: 1}),
+        content_type='application/json',
+    )
+    r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    assert r.status_code == 200
+    assert stored_scrobbles() == scrobbles_per_page()*3
+
+
+@responses.activate
+def test_update_fails_once_retries_are_exhausted(client):
+    app.config['LASTFM_PAGE_RETRIES'] = 1
+    responses.add_callback(
+        responses.GET, f'{LF_API}/',
+        callback=paged_data_request_callback(3, {2: 5}),
+        content_type='application/json',
+    )
+    try:
+        r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    finally:
+        app.config['LASTFM_PAGE_RETRIES'] = 3
+    assert r.status_code == 500
+
+
+def requested_params(calls):
+    return [ {k: v[0] for k, v in parse_qs(urlparse(call.request.url).query).items()} for call in calls ]
+
+
+@responses.activate
+def test_update_syncs_from_the_newest_stored_scrobble(client):
+    responses.add_callback(
+        responses.GET, f'{LF_API}/',
+        callback=paged_data_request_callback(1, {}),
+        content_type='application/json',
+    )
+    client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    first_sync = len(responses.calls)
+    r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    assert r.status_code == 200
+    assert r.json["new scrobbles"] == 0
+    with open(DUMMY_LF_DATA_PATH) as f:
+        newest = max(int(t["date"]["uts"]) for t in json.load(f)["recenttracks"]["track"])
+    params = requested_params(responses.calls[first_sync:])[0]
+    assert int(params['from']) == newest - app.config['SYNC_OVERLAP_SECONDS']
+    assert params['to'].isdigit()
+
+
+@responses.activate
+def test_interrupted_update_resumes_from_the_last_committed_page(client):
+    failures = {3: 100}
+    responses.add_callback(
+        responses.GET, f'{LF_API}/',
+        callback=paged_data_request_callback(4, failures),
+        content_type='application/json',
+    )
+    app.config['LASTFM_PAGE_RETRIES'] = 0
+    try:
+        r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    finally:
+        app.config['LASTFM_PAGE_RETRIES'] = 3
+    assert r.status_code == 500
+    first_sync = requested_params(responses.calls)
+    failures[3] = 0
+    r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    assert r.status_code == 200
+    after = requested_params(responses.calls[len(first_sync):])
+    #the resumed pages, then a fresh sync from the newest stored scrobble up to now
+    fresh = [ p['page'] for p in after ].index('1')
+    resumed = after[:fresh]
+    assert resumed and {p['to'] for p in resumed} == {first_sync[0]['to']}
+    assert 'from' in after[fresh] and int(after[fresh]['to']) >= int(first_sync[0]['to'])
+    assert r.json["complete"]
+    assert stored_scrobbles() == scrobbles_per_page()*4
+
+
+@responses.activate
+def test_resume_that_uses_up_the_page_budget_is_not_complete(client):
+    failures = {3: 100}
+    responses.add_callback(
+        responses.GET, f'{LF_API}/',
+        callback=paged_data_request_callback(4, failures),
+        content_type='application/json',
+    )
+    app.config['LASTFM_PAGE_RETRIES'] = 0
+    try:
+        client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    finally:
+        app.config['LASTFM_PAGE_RETRIES'] = 3
+    failures[3] = 0
+    calls = len(responses.calls)
+    with app.app_context():
+        helper = LastFMHelper(username=LF_TEST_USERNAME)
+        summary = helper.get_or_update_user_scrobbles(max_pages=2)
+        assert summary["complete"] is False
+        assert len(responses.calls) - calls == 2
+        #the next update starts the fresh sync
+        assert helper.get_or_update_user_scrobbles()["complete"]
@@ -0,0 +1,96 @@
+import time as clock
+import pytest
+from datetime import datetime, time, timedelta
+
+from dateutil.tz import UTC
+
+from lastfm_visualizer.app import app
+from lib import leaderboards
+from lib.database import DbHelper
+from lib.models import Leaderboard, Scrobble, Track
+from tests.test_scrobbles_api import LF_TEST_USERNAME
+
+TRACKS = [("Song A","Album A","Artist A"),("Song B","Album B","Artist B"),("Song A","Album C","Artist A"),
+    ("Song C","Album A","Artist C"),("Song D","Album D","Artist D")]
+
+
+def recent_page(days=40, per_day=7, offset=0):
+    """plays spread over the last `days` days, tracks skewed so every window has a different ranking"""
+    now = int(clock.time()) - 60
+    page = []
+    for i in range(days * per_day):
+        title, album, artist = TRACKS[(i * i + offset) % len(TRACKS)]
+        page.append(Scrobble(track=Track(title=title, album=album, artist=artist), timestamp=now - i * 86400 // per_day))
+    return page
+
+
+def window_bounds(days):
+    first, last = leaderboards.window_days(days)
+    return datetime.combine(first, time.min), datetime.combine(last, time.max)
+
+
+@pytest.mark.parametrize('days', [7, 30, 365])
+def test_window_matches_the_period_queries(db_helper, days):
+    db_helper.bulk_write_scrobbles_to_db(recent_page())
+    start, end = window_bounds(days)
+    assert db_helper.get_top_tracks_for_window(days, 10) == db_helper.get_top_tracks_for_period(start, end, 10)
+    assert db_helper.get_top_albums_for_window(days, 10) == db_helper.get_top_albums_for_period(start, end, 10)
+    assert db_helper.get_top_artists_for_window(days, 10) == db_helper.get_top_artists_for_period(start, end, 10)
+
+
+def test_writes_update_built_windows(db_helper):
+    db_helper.bulk_write_scrobbles_to_db(recent_page(days=10))
+    db_helper.get_top_tracks_for_window(7)
+    #newer plays of other tracks, and older ones outside the week
+    db_helper.bulk_write_scrobbles_to_db(recent_page(days=20, per_day=11, offset=3))
+    start, end = window_bounds(7)
+    assert db_helper.get_top_tracks_for_window(7, 10) == db_helper.get_top_tracks_for_period(start, end, 10)
+    assert db_helper.get_top_albums_for_window(7, 10) == db_helper.get_top_albums_for_period(start, end, 10)
+
+
+def test_advancing_expires_days_like_a_rebuild(db_helper):
+    db_helper.bulk_write_scrobbles_to_db(recent_page())
+    session, user_id = db_helper.session, db_helper.user.id
+    today = leaderboards.window_days(1)[1]
+    assert leaderboards.advance(session, user_id, 7, today - timedelta(days=12))
+    assert not leaderboards.advance(session, user_id, 7, today - timedelta(days=12))
+    for moved in (3, 5, 12):
+        assert leaderboards.advance(session, user_id, 7, today - timedelta(days=12-moved))
+        advanced = { kind: leaderboards.top(session, user_id, 7, kind, 100) for kind in leaderboards.KINDS }
+        leaderboards.clear(session, user_id)
+        leaderboards.advance(session, user_id, 7, today - timedelta(days=12-moved))
+        assert advanced == { kind: leaderboards.top(session, user_id, 7, kind, 100) for kind in leaderboards.KINDS }
+        leaderboards.clear(session, user_id)
+        leaderboards.advance(session, user_id, 7, today - timedelta(days=12))
+
+
+def test_rebuilding_rollups_clears_the_windows(db_helper):
+    db_helper.bulk_write_scrobbles_to_db(recent_page(days=10))
+    db_helper.get_top_tracks_for_window(30)
+    assert db_helper.session.query(Leaderboard).count()
+    db_helper.refresh_rollups()
+    assert db_helper.session.query(Leaderboard).count() == 0
+
+
+def test_top_endpoints_accept_a_window(client):
+    with app.app_context():
+        helper = DbHelper(LF_TEST_USERNAME)
+        helper.add_user_to_db()
+        helper.bulk_write_scrobbles_to_db(recent_page())
+    start, end = window_bounds(30)
+    for endpoint in ('top-tracks', 'top-albums', 'top-artists'):
+        r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/{endpoint}', query_string={"window": "month", "limit": 3})
+        assert r.status_code == 200
+        assert (r.json["start"], r.json["end"]) == (f'{start.replace(tzinfo=UTC)}', f'{end.replace(tzinfo=UTC)}')
+        app.config['LEADERBOARDS'] = False
+        try:
+            off = client.get(f'/scrobbles/{LF_TEST_USERNAME}/{endpoint}', query_string={"window": "month", "limit": 3})
+        finally:
+            app.config['LEADERBOARDS'] = True
+        assert off.json == r.json
+
+
+def test_unknown_window_is_a_bad_request(client):
+    r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/top-tracks', query_string={"window": "decade"})
+    assert r.status_code == 400
+
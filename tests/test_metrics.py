@@ -0,0 +1,75 @@
+import json
+import responses
+
+from lastfm_visualizer.app import app
+from lib import metrics
+from tests.test_scrobbles_api import standard_data_request_callback, LF_API, LF_TEST_USERNAME
+
+TOP_TRACKS = '/scrobbles/<lf_username>/top-tracks'
+PERIOD = {"start": "2019-01-23", "end": "2019-01-25"}
+
+
+def scrape(client):
+    r = client.get('/metrics')
+    assert r.status_code == 200 and r.mimetype == 'text/plain'
+    return r.get_data(as_text=True)
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = metrics.Registry()
+    h = registry.histogram('latency_seconds', 'test latency', ('endpoint',), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 3):
+        h.observe(value, endpoint='/a"b')
+    lines = registry.render().splitlines()
+    assert lines[:2] == ['# HELP latency_seconds test latency', '# TYPE latency_seconds histogram']
+    assert lines[2:] == [
+        'latency_seconds_bucket{endpoint="/a\\"b",le="0.1"} 1',
+        'latency_seconds_bucket{endpoint="/a\\"b",le="1"} 3',
+        'latency_seconds_bucket{endpoint="/a\\"b",le="+Inf"} 4',
+        'latency_seconds_sum{endpoint="/a\\"b"} 4.25',
+        'latency_seconds_count{endpoint="/a\\"b"} 4',
+    ]
+
+
+@responses.activate
+def test_requests_sql_and_lastfm_fetches_are_measured(client):
+    responses.add_callback(
+        responses.GET, f'{LF_API}/?method=user.getRecentTracks&user={LF_TEST_USERNAME}',
+        callback=standard_data_request_callback,
+        content_type='application/json',
+    )
+    fetches, rows = metrics.LASTFM_FETCH_SECONDS.count(), metrics.INGESTION_ROWS.value()
+    served = metrics.REQUEST_SECONDS.count(endpoint=TOP_TRACKS, method='GET', status=200)
+    client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/top-tracks', data=json.dumps(PERIOD), content_type='application/json')
+    assert r.status_code == 200
+    assert metrics.LASTFM_FETCH_SECONDS.count() == fetches + 1
+    assert metrics.INGESTION_ROWS.value() > rows
+    assert metrics.REQUEST_SECONDS.count(endpoint=TOP_TRACKS, method='GET', status=200) == served + 1
+    text = scrape(client)
+    assert f'http_request_sql_statements_count{{endpoint="{TOP_TRACKS}"}}' in text
+    assert 'lastfm_page_bytes_bucket{le="+Inf"}' in text
+    assert 'ingestion_last_run_rows_per_second' in text
+    assert 'results_cache_misses' in text and 'track_interner_misses' in text
+    statements = [ line for line in text.splitlines() if line.startswith('sql_statements_total ') ]
+    assert statements and int(statements[0].split()[1]) > 0
+
+
+@responses.activate
+def test_profile_is_opt_in(client):
+    responses.add_callback(
+        responses.GET, f'{LF_API}/?method=user.getRecentTracks&user={LF_TEST_USERNAME}',
+        callback=standard_data_request_callback,
+        content_type='application/json',
+    )
+    client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    url = f'/scrobbles/{LF_TEST_USERNAME}/top-tracks?profile=1'
+    r = client.get(url, data=json.dumps(PERIOD), content_type='application/json')
+    assert r.status_code == 200 and r.is_json
+    app.config['PROFILE_REQUESTS'] = True
+    try:
+        r = client.get(url, data=json.dumps(PERIOD), content_type='application/json')
+    finally:
+        app.config['PROFILE_REQUESTS'] = False
+    assert r.mimetype == 'text/plain'
+    assert 'sql statements' in r.get_data(as_text=True) and 'cumulative' in r.get_data(as_text=True)
@@ -0,0 +1,43 @@
+import threading
+import pytest
+
+from lib.pipeline import IngestionPipeline
+
+
+def test_pipeline_writes_every_page_and_counts_stages():
+    written = []
+    pipeline = IngestionPipeline(
+        fetch=lambda page: list(range(page)),
+        parse=lambda raw: [ r*2 for r in raw ],
+        write=lambda rows: written.append(rows) or len(rows),
+        workers=3, queue_size=2)
+    stats = pipeline.run(range(1, 21))
+    assert sorted(len(rows) for rows in written) == list(range(1, 21))
+    assert stats.pages_fetched == stats.pages_written == 20
+    assert stats.rows_written == sum(range(1, 21))
+
+
+def test_pipeline_bounds_pages_in_flight():
+    in_flight, peak = [0], [0]
+    lock = threading.Lock()
+    def fetch(page):
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        return [page]
+    def write(rows):
+        with lock:
+            in_flight[0] -= 1
+        return 1
+    IngestionPipeline(fetch=fetch, parse=lambda raw: raw, write=write, workers=2, queue_size=3).run(range(50))
+    #queued pages + one being put by each worker + the one held by the writer
+    assert peak[0] <= 3 + 2 + 1
+
+
+def test_pipeline_raises_fetch_errors_on_the_writer():
+    def fetch(page):
+        if page == 5: raise ValueError("page 5 failed")
+        return [page]
+    pipeline = IngestionPipeline(fetch=fetch, parse=lambda raw: raw, write=len, workers=2, queue_size=1)
+    with pytest.raises(ValueError):
+        pipeline.run(range(10))
@@ -0,0 +1,76 @@
+import responses
+from datetime import datetime, timedelta
+
+from lastfm_visualizer.app import app
+from lib.database import DbHelper
+from lib.models import HourlyRollup, SyncCheckpoint, db
+from lib.scheduler import RefreshScheduler
+from tests.test_lastfm import paged_data_request_callback, scrobbles_per_page, stored_scrobbles, LF_API
+
+
+def add_user(name, last_update, recent_plays=0):
+    helper = DbHelper(name)
+    helper.add_user_to_db()
+    helper.user.last_update = last_update
+    if recent_plays:
+        db.session.add(HourlyRollup(user_id=helper.user.id, hour=int(datetime.now().timestamp())//3600 - 1, plays=recent_plays))
+    db.session.commit()
+    return helper
+
+
+def test_candidates_are_stale_users_by_staleness_and_activity(client):
+    now = datetime.now()
+    with app.app_context():
+        add_user('fresh', now)
+        add_user('stale', now - timedelta(hours=3))
+        add_user('stale_active', now - timedelta(hours=3), recent_plays=100)
+        add_user('very_stale', now - timedelta(days=2))
+        resuming = add_user('resuming', now)
+        resuming.start_sync(None, int(now.timestamp()))
+        names = [ name for name, _ in RefreshScheduler(stale_after=3600).candidates(now) ]
+        db.session.remove()
+    assert names == ['very_stale', 'stale_active', 'stale', 'resuming']
+
+
+@responses.activate
+def test_run_spreads_the_request_budget_over_users(client):
+    responses.add_callback(
+        responses.GET, f'{LF_API}/',
+        callback=paged_data_request_callback(4, {}),
+        content_type='application/json',
+    )
+    with app.app_context():
+        add_user('alice', None)
+        add_user('bob', datetime.now() - timedelta(days=1))
+        db.session.remove()
+        scheduler = RefreshScheduler(stale_after=3600, request_budget=3, user_pages=2)
+        first = scheduler.run()
+        assert [ (u["user"], u["pages"], u["complete"]) for u in first.users ] == [('alice', 2, False), ('bob', 1, False)]
+        assert (first.pages, first.partial, first.refreshed) == (3, 2, 0)
+
+        scheduler.request_budget = 10
+        second = scheduler.run()
+        #alice's resumed sync is done, but its pages left none for the scrobbles since it started
+        assert [ (u["user"], u["pages"], u["complete"]) for u in second.users ] == [('alice', 2, False), ('bob', 2, False)]
+        assert db.session.query(SyncCheckpoint).filter_by(finished=False).count() == 1
+        db.session.remove()
+    assert stored_scrobbles() == scrobbles_per_page()*4 + scrobbles_per_page()*3
+
+
+@responses.activate
+def test_retries_are_charged_to_the_request_budget(client):
+    failures = {2: 100}
+    responses.add_callback(
+        responses.GET, f'{LF_API}/',
+        callback=paged_data_request_callback(4, failures),
+        content_type='application/json',
+    )
+    with app.app_context():
+        add_user('alice', None)
+        add_user('bob', datetime.now() - timedelta(days=1))
+        db.session.remove()
+        run = RefreshScheduler(stale_after=3600, request_budget=4, user_pages=4).run()
+        #page 2's retries spend the budget with the other pages, nothing is left for bob
+        assert len(responses.calls) == run.requests == 4
+        assert [ (u["user"], u["requests"]) for u in run.users ] == [('alice', 4)]
+        assert (run.failed, run.deferred) == (1, 1)
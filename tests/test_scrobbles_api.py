@@ -1,4 +1,3 @@
-import os
 import pytest
 import json
 import responses
@@ -9,19 +8,6 @@ from lib.database import DbHelper
 LF_TEST_USERNAME="testuser"
 LF_API = "http://ws.audioscrobbler.com/2.0"
 DUMMY_LF_DATA_PATH = 'tests/data.json'
-TEST_DB = 'tests/testdb.db'
-
-
-
-@pytest.fixture
-def client():
-    app.config['TESTING'] = True
-    app.config['SQLALCHEMY_DATABASE_URI']=f'sqlite:///{TEST_DB}'
-    client = app.test_client()
-
-    yield client
-    if os.path.exists(TEST_DB):
-        os.remove(TEST_DB)
 
 
 def standard_data_request_callback(request):
@@ -67,7 +53,8 @@ def test_frequency_endpoint_returns_right_frequency(client):
         "end": "2019-01-25 00:00:00+00:00",
         "frequency": {
             "2019-01-23": 154,
-            "2019-01-24": 25
+            "2019-01-24": 25,
+            "2019-01-25": 0
         },
         "start": "2019-01-23 00:00:00+00:00"
     }
@@ -284,4 +271,95 @@ def test_scrobbles_endpoint_returns_scrobbles(client):
         ],
         "start": "2019-01-24 12:00:00+00:00"
     }
-    assert r.json == expected_result
\ No newline at end of file
+    assert r.json == expected_result
+
+@responses.activate
+def test_scrobbles_endpoint_keyset_pagination_walks_the_whole_range(client):
+    lf_endpoint = f'{LF_API}/?method=user.getRecentTracks&user={LF_TEST_USERNAME}'
+    responses.add_callback(
+        responses.GET, lf_endpoint,
+        callback=standard_data_request_callback,
+        content_type='application/json',
+    )
+    data = {
+        "start":"2019-01-24 12:00:00",
+        "end": "2019-01-24 12:30:00"
+    }
+    r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    everything = client.get(f'/scrobbles/{LF_TEST_USERNAME}',data=json.dumps(data),content_type='application/json').json
+    pages, cursor = [], None
+    while True:
+        page_data = dict(data, limit=3, **({"after": cursor} if cursor else {}))
+        r = client.get(f'/scrobbles/{LF_TEST_USERNAME}',data=json.dumps(page_data),content_type='application/json')
+        assert r.status_code == 200
+        assert len(r.json["scrobbles"]) <= 3
+        pages += r.json["scrobbles"]
+        cursor = r.json["next"]
+        if cursor is None: break
+    assert pages == list(reversed(everything["scrobbles"]))
+
+
+@pytest.mark.parametrize("params", [{"limit": 0}, {"limit": -1}, {"after": -5, "limit": 3}])
+def test_scrobbles_endpoint_rejects_non_positive_pages(client, params):
+    query = dict(params, start="2019-01-24 12:00:00", end="2019-01-24 12:30:00")
+    r = client.get(f'/scrobbles/{LF_TEST_USERNAME}', query_string=query)
+    assert r.status_code == 400
+
+
+@responses.activate
+def test_scrobbles_endpoint_streams_json_and_ndjson(client):
+    lf_endpoint = f'{LF_API}/?method=user.getRecentTracks&user={LF_TEST_USERNAME}'
+    responses.add_callback(
+        responses.GET, lf_endpoint,
+        callback=standard_data_request_callback,
+        content_type='application/json',
+    )
+    data = {
+        "start":"2019-01-24 12:00:00",
+        "end": "2019-01-24 12:30:00"
+    }
+    r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+    everything = client.get(f'/scrobbles/{LF_TEST_USERNAME}',data=json.dumps(data),content_type='application/json').json
+
+    r = client.get(f'/scrobbles/{LF_TEST_USERNAME}',data=json.dumps(dict(data, stream="json")),content_type='application/json')
+    assert r.status_code == 200
+    assert json.loads(r.get_data(as_text=True)) == dict(everything, next=None)
+
+    r = client.get(f'/scrobbles/{LF_TEST_USERNAME}',data=json.dumps(dict(data, stream="ndjson", limit=5)),content_type='application/json')
+    lines = [ json.loads(line) for line in r.get_data(as_text=True).splitlines() ]
+    assert r.mimetype == 'application/x-ndjson'
+    assert lines[:-1] == list(reversed(everything["scrobbles"]))[:5]
+    assert lines[-1]["next"] is not None
+
+
+@responses.activate
+@pytest.mark.parametrize("scale,tz", [("days", None), ("months", None), ("hours", None), ("days", "Asia/Tokyo")])
+def test_summary_endpoint_matches_the_separate_endpoints(client, scale, tz):
+    lf_endpoint = f'{LF_API}/?method=user.getRecentTracks&user={LF_TEST_USERNAME}'
+    responses.add_callback(
+        responses.GET, lf_endpoint,
+        callback=standard_data_request_callback,
+        content_type='application/json',
+    )
+    data = {
+        "start":"2019-01-23 10:00:00",
+        "end": "2019-01-25",
+        "limit": 4,
+        "scale": scale
+    }
+    if tz: data["tz"] = tz
+    r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/update')
+
+    summary = client.get(f'/scrobbles/{LF_TEST_USERNAME}/summary',data=json.dumps(data),content_type='application/json')
+    assert summary.status_code == 200
+    for endpoint, key in (('top-tracks', 'top tracks'), ('top-albums', 'top albums'), ('top-artists', 'top artists'), ('frequency', 'frequency')):
+        r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/{endpoint}',data=json.dumps(data),content_type='application/json')
+        assert summary.json[key] == r.json[key]
+    assert summary.json["start"] == "2019-01-23 10:00:00+00:00"
+
+
+@pytest.mark.parametrize("limit", [0, -1])
+def test_summary_endpoint_rejects_non_positive_limits(client, limit):
+    query = {"start": "2019-01-23", "end": "2019-01-25", "limit": limit}
+    r = client.get(f'/scrobbles/{LF_TEST_USERNAME}/summary', query_string=query)
+    assert r.status_code == 400